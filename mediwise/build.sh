@@ -10,4 +10,9 @@ pip install -r requirements.txt
 python manage.py collectstatic --no-input
 
 # Apply database migrations to Neon (PostgreSQL)
-python manage.py migrate
\ No newline at end of file
+python manage.py migrate
+
+# Create the shared cache table (no-op if it exists or Redis is configured)
+python manage.py createcachetable
+
+# The web service is started with ./start.sh (ASGI, needed by the live event streams)
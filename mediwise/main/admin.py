@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Users, Patient, MediAdmin, Pharmacist, Doctor,AuditLog,Medicine
+from .models import Users, Patient, MediAdmin, Pharmacist, Doctor,AuditLog,Medicine,DrugAlias,StockHold,PharmacyOrder,OutboxEvent
 
 
 # Register your models here.
@@ -11,5 +11,7 @@ admin.site.register(Pharmacist)
 admin.site.register(Doctor)
 admin.site.register(AuditLog)
 admin.site.register(Medicine)
-
-
+admin.site.register(DrugAlias)
+admin.site.register(StockHold)
+admin.site.register(PharmacyOrder)
+admin.site.register(OutboxEvent)
\ No newline at end of file
@@ -0,0 +1,399 @@
+"""Prescription-to-inventory availability resolution.
+
+``resolve_availability`` maps every prescription line to its canonical
+drug name (via the ``DrugAlias`` synonym table) and matches all lines
+against ``Medicine.normalized_name``, or against ``normalized_brand`` for
+lines written by brand, in one indexed equality query. The
+result is an ``AvailabilityMatrix`` of prescription line x pharmacy, with
+the matching stock rows in each cell. Rows carry ``available_quantity``:
+stock minus units under an active checkout hold.
+
+``cached_availability`` memoizes a matrix in the shared cache until the
+inventory version moves (holds are journaled too), the date changes, a
+hold on one of its rows lapses or an alias re-maps one of its lines.
+
+``stock_summary`` reports in-stock totals for a batch of drug names, and
+``stock_bitmap`` answers "which pharmacies stock all of these drugs" with a
+vectorized AND over per-drug pharmacy bitsets.
+"""
+import hashlib
+import threading
+
+import numpy as np
+from django.core.cache import cache
+from django.db.models import Count, Min, Q, Sum
+from django.utils import timezone
+
+from .holds import active_holds, next_hold_expiry, with_available_stock
+from .models import Medicine, StockHold, canonical_drug_names, normalize_drug_name
+
+
+def normalize_strength(strength):
+    return normalize_drug_name(strength) or None
+
+
+class AvailabilityMatrix:
+    """Medicine x pharmacy availability for a set of prescription lines.
+
+    ``cells`` maps each line key ``(canonical_name, strength)`` to
+    ``{pharmacist_id: [Medicine, ...]}`` and ``pharmacies`` maps pharmacist
+    ids to the ``Pharmacist`` rows seen.
+    """
+
+    def __init__(self, canonical):
+        self.canonical = canonical
+        self.keys = []
+        self.cells = {}
+        self.pharmacies = {}
+        self.generic_names = set()  # line names matched by generic name, not only by brand
+
+    def canonical_name(self, name):
+        """Canonical drug name for a line name as resolved by this matrix"""
+        normalized = normalize_drug_name(name)
+        return self.canonical.get(normalized, normalized)
+
+    def line_key(self, name, strength=None):
+        return (self.canonical_name(name), normalize_strength(strength))
+
+    def add_line(self, name, strength=None):
+        key = self.line_key(name, strength)
+        if key[0] and key not in self.cells:
+            self.keys.append(key)
+            self.cells[key] = {}
+
+    def add(self, key, medicine):
+        if medicine.normalized_name == key[0]:
+            self.generic_names.add(key[0])
+        self.pharmacies[medicine.pharmacist_id] = medicine.pharmacist
+        self.cells[key].setdefault(medicine.pharmacist_id, []).append(medicine)
+
+    def offers(self, name, strength=None, in_stock=False):
+        """All medicine rows matching a line, optionally only those in stock"""
+        rows = [
+            medicine
+            for medicines in self.cells.get(self.line_key(name, strength), {}).values()
+            for medicine in medicines
+        ]
+        if in_stock:
+            rows = [medicine for medicine in rows if medicine.available_quantity > 0]
+        return rows
+
+    def stocked_at(self, name, strength=None):
+        """Ids of pharmacies holding non-zero stock for a line"""
+        return {
+            pharmacist_id
+            for pharmacist_id, medicines in self.cells.get(self.line_key(name, strength), {}).items()
+            if any(medicine.available_quantity > 0 for medicine in medicines)
+        }
+
+    def stocked_at_all(self, lines):
+        """Ids of pharmacies holding stock for every line, strength included.
+
+        The stock bitmap narrows the candidates by generic name; each line's
+        strength and held units, and lines matched only by brand, are then
+        checked against this matrix.
+        """
+        lines = [line for line in lines if self.canonical_name(line.get('name'))]
+        pharmacy_ids = stock_bitmap.pharmacies_stocking_all(
+            self.canonical_name(line['name']) for line in lines
+            if self.canonical_name(line['name']) in self.generic_names
+        )
+        for line in lines:
+            pharmacy_ids &= self.stocked_at(line['name'], line.get('strength'))
+        return pharmacy_ids
+
+    def medicine_ids(self):
+        return {
+            medicine.id
+            for row in self.cells.values()
+            for medicines in row.values()
+            for medicine in medicines
+        }
+
+
+def resolve_availability(lines, pharmacist=None):
+    """Match prescription lines against the catalog in a single query.
+
+    Args:
+        lines: Iterable of dicts with a ``name`` (generic or brand) and
+            optional ``strength``
+        pharmacist: Restrict matching to one pharmacy (default: all)
+
+    Returns:
+        AvailabilityMatrix keyed by ``(canonical_name, strength)``
+    """
+    lines = list(lines)
+    canonical = canonical_drug_names(line.get('name') for line in lines)
+    matrix = AvailabilityMatrix(canonical)
+    for line in lines:
+        matrix.add_line(line.get('name'), line.get('strength'))
+
+    if not matrix.keys:
+        return matrix
+
+    query = Q()
+    for name, strength in matrix.keys:
+        line_query = Q(normalized_name=name) | Q(normalized_brand=name)
+        if strength:
+            line_query &= Q(strength__icontains=strength)
+        query |= line_query
+
+    medicines = with_available_stock(Medicine.objects.filter(
+        expiry_date__gt=timezone.now().date()
+    ).filter(query))
+    if pharmacist:
+        medicines = medicines.filter(pharmacist=pharmacist)
+
+    for medicine in medicines.select_related('pharmacist').order_by('generic_name', 'brand_name', 'id'):
+        for name, strength in matrix.keys:
+            if name in (medicine.normalized_name, medicine.normalized_brand) and (
+                strength is None or strength in medicine.strength.lower()
+            ):
+                matrix.add((name, strength), medicine)
+
+    return matrix
+
+
+AVAILABILITY_CACHE_KEY = 'availability:%s:%s'
+AVAILABILITY_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def cached_availability(lines, pharmacist=None):
+    """``resolve_availability`` served from a versioned snapshot when nothing it depends on changed.
+
+    The common case costs the inventory version and alias lookups and one
+    cache read instead of the catalog query.
+    """
+    from .inventory import inventory_version
+
+    lines = list(lines)
+    signature = sorted({
+        (normalize_drug_name(line.get('name')), normalize_strength(line.get('strength')))
+        for line in lines
+    })
+    scope = pharmacist.id if pharmacist else 'all'
+    key = AVAILABILITY_CACHE_KEY % (scope, hashlib.sha1(repr(signature).encode()).hexdigest())
+
+    # Read before resolving: a write in between only makes the snapshot look older
+    version = inventory_version(pharmacist.id if pharmacist else None)
+    canonical = canonical_drug_names(line.get('name') for line in lines)
+    now = timezone.now()
+    snapshot = cache.get(key)
+    if (
+        snapshot
+        and snapshot['version'] == version
+        and snapshot['date'] == now.date()
+        and snapshot['canonical'] == canonical
+        and (snapshot['valid_until'] is None or now < snapshot['valid_until'])
+    ):
+        return snapshot['matrix']
+
+    matrix = resolve_availability(lines, pharmacist=pharmacist)
+    # Units held on these rows come back without a journal entry when the hold lapses
+    valid_until = active_holds().filter(medicine_id__in=matrix.medicine_ids()).aggregate(
+        expires_at=Min('expires_at')
+    )['expires_at'] if matrix.keys else None
+    cache.set(key, {
+        'version': version,
+        'date': now.date(),
+        'canonical': canonical,
+        'valid_until': valid_until,
+        'matrix': matrix,
+    }, timeout=AVAILABILITY_CACHE_TIMEOUT)
+    return matrix
+
+
+def stock_summary(names):
+    """In-stock totals for a batch of drug names (generic or brand).
+
+    All names are resolved through the synonym table and aggregated over
+    ``Medicine.normalized_name`` in a single grouped query. Names with no
+    canonical match fall back to a substring match on generic or brand
+    name (one more query for all of them). Units under an active checkout
+    hold are not counted.
+
+    Returns:
+        dict mapping each given name to ``in_stock``, ``total_stock`` and
+        ``pharmacy_count``
+    """
+    names = [name for name in names if name]
+    canonical = canonical_drug_names(names)
+    keys = {name: canonical.get(normalize_drug_name(name), normalize_drug_name(name)) for name in names}
+
+    totals = {}
+    if any(keys.values()):
+        rows = _in_stock(Medicine.objects.filter(normalized_name__in=set(keys.values()))).values(
+            'normalized_name'
+        ).annotate(
+            total_stock=Sum('available_quantity'),
+            pharmacy_count=Count('pharmacist', distinct=True),
+        ).order_by()
+        totals = {row['normalized_name']: row for row in rows}
+
+    unmatched = {key for key in keys.values() if key and key not in totals}
+    if unmatched:
+        totals.update(_substring_totals(unmatched))
+
+    summary = {}
+    for name, key in keys.items():
+        row = totals.get(key)
+        summary[name] = {
+            'in_stock': row is not None,
+            'total_stock': row['total_stock'] if row else 0,
+            'pharmacy_count': row['pharmacy_count'] if row else 0,
+        }
+    return summary
+
+
+def _in_stock(medicines):
+    return with_available_stock(medicines.filter(
+        quantity__gt=0,
+        expiry_date__gt=timezone.now().date(),
+    )).filter(available_quantity__gt=0)
+
+
+def _substring_totals(names):
+    """Stock totals for names contained in a row's generic or brand name"""
+    query = Q()
+    for name in names:
+        query |= Q(generic_name__icontains=name) | Q(brand_name__icontains=name)
+    rows = list(_in_stock(Medicine.objects.filter(query)).values_list(
+        'generic_name', 'brand_name', 'pharmacist_id', 'available_quantity'
+    ))
+
+    totals = {}
+    for name in names:
+        matches = [
+            (pharmacist_id, available_quantity)
+            for generic_name, brand_name, pharmacist_id, available_quantity in rows
+            if name in normalize_drug_name(generic_name) or name in normalize_drug_name(brand_name)
+        ]
+        if matches:
+            totals[name] = {
+                'total_stock': sum(quantity for _, quantity in matches),
+                'pharmacy_count': len({pharmacist_id for pharmacist_id, _ in matches}),
+            }
+    return totals
+
+
+class StockBitmapIndex:
+    """Per-drug bitsets over pharmacies holding non-expired rows with available stock.
+
+    Each canonical drug name maps to a boolean NumPy array with one slot
+    per pharmacy, so the pharmacies carrying every item of a prescription
+    are a single ``logical_and`` over a handful of arrays, independent of
+    catalog size. Rows count when their ``available_quantity`` (stock net
+    of active holds, as in ``resolve_availability``) is positive.
+
+    The index is built with one query per day (expiry moves with the date)
+    and in between patched from the inventory journal: only the medicines
+    written, held or released since the last lookup are re-read, plus those
+    whose holds have lapsed since ``next_hold_expiry``.
+    """
+
+    # Past this many pending journal entries a rebuild is cheaper
+    MAX_INCREMENTAL_CHANGES = 500
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._date = None
+        self._watermark = None
+        self._stocked = {}   # medicine id -> (canonical name, pharmacist id) for rows counted
+        self._counts = {}    # (canonical name, pharmacist id) -> rows counted
+        self._position = {}  # pharmacist id -> bit position
+        self._pharmacy_ids = np.empty(0, dtype=np.int64)
+        self._bitmaps = {}
+        self._next_hold_expiry = None
+
+    @staticmethod
+    def _stocked_rows(today, medicines=None):
+        medicines = Medicine.objects.all() if medicines is None else medicines
+        return with_available_stock(medicines.filter(
+            expiry_date__gt=today, quantity__gt=0
+        )).filter(available_quantity__gt=0).values_list('id', 'normalized_name', 'pharmacist_id')
+
+    def _build(self, today):
+        from .inventory import InventoryWatermark
+
+        # Taken first: writes committed during the build are applied again, harmlessly
+        watermark = InventoryWatermark()
+        watermark.reset()
+        self._next_hold_expiry = next_hold_expiry()
+        rows = list(self._stocked_rows(today))
+        pharmacy_ids = sorted({pharmacist_id for _, _, pharmacist_id in rows})
+
+        self._position = {pharmacist_id: index for index, pharmacist_id in enumerate(pharmacy_ids)}
+        self._pharmacy_ids = np.array(pharmacy_ids, dtype=np.int64)
+        self._stocked, self._counts, self._bitmaps = {}, {}, {}
+        for medicine_id, name, pharmacist_id in rows:
+            self._count(medicine_id, name, pharmacist_id)
+        self._date, self._watermark = today, watermark
+
+    def _count(self, medicine_id, name, pharmacist_id):
+        self._stocked[medicine_id] = (name, pharmacist_id)
+        key = (name, pharmacist_id)
+        self._counts[key] = self._counts.get(key, 0) + 1
+        bitmap = self._bitmaps.get(name)
+        if bitmap is None:
+            bitmap = self._bitmaps[name] = np.zeros(len(self._pharmacy_ids), dtype=bool)
+        bitmap[self._position[pharmacist_id]] = True
+
+    def _uncount(self, medicine_id):
+        entry = self._stocked.pop(medicine_id, None)
+        if entry is None:
+            return
+        self._counts[entry] -= 1
+        if not self._counts[entry]:
+            del self._counts[entry]
+            self._bitmaps[entry[0]][self._position[entry[1]]] = False
+
+    def _lapsed_holds(self):
+        """Ids of medicines whose holds expired since the last check"""
+        now = timezone.now()
+        if self._next_hold_expiry is None or now < self._next_hold_expiry:
+            return set()
+        lapsed = set(StockHold.objects.filter(
+            expires_at__gte=self._next_hold_expiry, expires_at__lte=now
+        ).values_list('medicine_id', flat=True))
+        self._next_hold_expiry = next_hold_expiry(now)
+        return lapsed
+
+    def _catch_up(self):
+        changed = self._watermark.changed_medicines(self.MAX_INCREMENTAL_CHANGES)
+        if changed is None:
+            self._build(self._date)
+            return
+        if changed and self._next_hold_expiry is None:
+            # The changes may include the only active holds
+            self._next_hold_expiry = next_hold_expiry()
+        changed |= self._lapsed_holds()
+        if not changed:
+            return
+        rows = list(self._stocked_rows(self._date, Medicine.objects.filter(id__in=changed)))
+        if any(pharmacist_id not in self._position for _, _, pharmacist_id in rows):
+            # A pharmacy's first stock needs a new slot in every bitmap
+            self._build(self._date)
+            return
+        for medicine_id in changed:
+            self._uncount(medicine_id)
+        for medicine_id, name, pharmacist_id in rows:
+            self._count(medicine_id, name, pharmacist_id)
+
+    def pharmacies_stocking_all(self, canonical_names):
+        """Ids of pharmacies with stock of every given canonical drug name"""
+        names = set(canonical_names)
+        if not names:
+            return set()
+        today = timezone.now().date()
+        with self._lock:
+            if today != self._date:
+                self._build(today)
+            else:
+                self._catch_up()
+            if any(name not in self._bitmaps for name in names):
+                return set()
+            mask = np.logical_and.reduce([self._bitmaps[name] for name in names])
+            return set(self._pharmacy_ids[mask].tolist())
+
+
+stock_bitmap = StockBitmapIndex()
@@ -0,0 +1,232 @@
+"""Cheapest-basket optimizer for filling a prescription across pharmacies.
+
+Prescription lines are resolved once (``resolve_availability``) into a
+line x pharmacy price matrix holding the cheapest in-stock offer that
+covers the requested quantity. The best single pharmacy is a column sum.
+Two- and three-pharmacy splits are searched as partitions of the lines:
+every subset of lines is priced at every pharmacy with one matrix
+product, and a branch-and-bound over the partitions prunes on the
+per-line minimum price. The work grows with the number of pharmacies
+only through that product, so large catalogs stay cheap.
+"""
+from decimal import Decimal
+
+import numpy as np
+
+from .availability import resolve_availability
+
+MAX_SPLIT_PHARMACIES = 3
+
+# Longer prescriptions fall back to a greedy split (the exact search is
+# exponential in the number of lines, not in the number of pharmacies)
+MAX_EXACT_LINES = 12
+
+# Pharmacies priced per matrix product in the subset search
+SUBSET_CHUNK = 256
+
+
+class BasketPlan:
+    """One way of buying every line: a pharmacy (or set of them) per line"""
+
+    def __init__(self, total, assignments):
+        self.total = total
+        self.assignments = assignments  # list of dicts: line, pharmacist, medicine, quantity, cost
+
+    @property
+    def pharmacies(self):
+        seen = {}
+        for assignment in self.assignments:
+            seen.setdefault(assignment['pharmacist'].id, assignment['pharmacist'])
+        return list(seen.values())
+
+    def __len__(self):
+        return len(self.pharmacies)
+
+
+class BasketOptions:
+    """Result of ``optimize_basket``: best single pharmacy and best split"""
+
+    def __init__(self, single=None, split=None, missing=None):
+        self.single = single
+        self.split = split
+        self.missing = missing or []
+
+    @property
+    def savings(self):
+        if self.single and self.split:
+            return self.single.total - self.split.total
+        return None
+
+
+def _price_matrix(availability, lines):
+    """Cheapest covering offer per (line, pharmacy) as a float cost matrix"""
+    pharmacy_ids = sorted(availability.pharmacies)
+    position = {pharmacist_id: index for index, pharmacist_id in enumerate(pharmacy_ids)}
+    costs = np.full((len(lines), len(pharmacy_ids)), np.inf)
+    picks = {}
+
+    for row, line in enumerate(lines):
+        quantity = line['quantity']
+        for medicine in availability.offers(line['name'], line.get('strength'), in_stock=True):
+            if medicine.available_quantity < quantity:
+                continue
+            column = position[medicine.pharmacist_id]
+            cost = float(medicine.price) * quantity
+            if cost < costs[row, column]:
+                costs[row, column] = cost
+                picks[(row, column)] = medicine
+
+    return pharmacy_ids, costs, picks
+
+
+def _subset_costs(costs):
+    """Cheapest single pharmacy for every subset of lines.
+
+    Subsets are bitmasks over the rows of ``costs``. One matrix product of
+    the subset membership matrix with the price matrix prices every
+    subset at every pharmacy; the per-subset minimum and its column are
+    kept. Pharmacies are processed in chunks to bound memory.
+    """
+    lines, pharmacies = costs.shape
+    masks = np.arange(1 << lines)
+    membership = ((masks[:, None] >> np.arange(lines)) & 1).astype(float)
+    best = np.full(len(masks), np.inf)
+    where = np.zeros(len(masks), dtype=np.int64)
+    for start in range(0, pharmacies, SUBSET_CHUNK):
+        totals = membership @ costs[:, start:start + SUBSET_CHUNK]
+        columns = totals.argmin(axis=1)
+        values = totals[masks, columns]
+        better = values < best
+        best[better] = values[better]
+        where[better] = columns[better] + start
+    return masks, membership, best, where
+
+
+def _best_split(costs, max_size):
+    """Cheapest set of at most ``max_size`` columns covering every row.
+
+    Returns ``(total, columns)``; a total of ``inf`` means no such set.
+    Any split assigns each line to one pharmacy, so it is a partition of
+    the lines into at most ``max_size`` groups, each bought at its
+    cheapest pharmacy. The search fixes the group holding the first line,
+    cheapest lower bound first, and prunes every group whose cost plus the
+    per-line minimum of the remaining lines cannot beat the incumbent.
+    """
+    finite = np.isfinite(costs)
+    # Any plan leaving a line unfilled costs more than every complete plan
+    penalty = costs[finite].sum() + 1.0
+    costs = np.where(finite, costs, penalty)
+    lines = costs.shape[0]
+
+    if lines > MAX_EXACT_LINES:
+        return _greedy_split(costs, max_size, penalty)
+
+    masks, membership, best, where = _subset_costs(costs)
+    lower = membership @ costs.min(axis=1)
+    full = len(masks) - 1
+
+    best_total, best_groups = best[full], (full,)
+    if max_size > 1:
+        first = masks[(masks & 1) == 1]
+        first = first[first != full]
+        bounds = best[first] + lower[full ^ first]
+        order = np.argsort(bounds, kind='stable')
+        for group, bound in zip(first[order], bounds[order]):
+            if bound >= best_total:
+                break
+            rest = full ^ group
+            if best[group] + best[rest] < best_total:
+                best_total, best_groups = best[group] + best[rest], (group, rest)
+            if max_size < 3:
+                continue
+            # Split the remainder in two, keeping its lowest line in the first part
+            low = rest & -rest
+            seconds = masks[((masks & rest) == masks) & ((masks & low) != 0) & (masks != rest)]
+            if not seconds.size:
+                continue
+            totals = best[group] + best[seconds] + best[rest ^ seconds]
+            index = int(np.argmin(totals))
+            if totals[index] < best_total:
+                best_total, best_groups = totals[index], (group, seconds[index], rest ^ seconds[index])
+
+    if best_total >= penalty:
+        return np.inf, ()
+    return best_total, tuple(dict.fromkeys(int(where[group]) for group in best_groups))
+
+
+def _greedy_split(costs, max_size, penalty):
+    """Greedy fallback for prescriptions too long for the exact search"""
+    columns = [int(np.argmin(costs.sum(axis=0)))]
+    current = costs[:, columns[0]]
+    while len(columns) < max_size:
+        totals = np.minimum(current[:, None], costs).sum(axis=0)
+        column = int(np.argmin(totals))
+        if totals[column] >= current.sum():
+            break
+        columns.append(column)
+        current = np.minimum(current, costs[:, column])
+    if current.sum() >= penalty:
+        return np.inf, ()
+    return current.sum(), tuple(columns)
+
+
+def _plan(lines, pharmacy_ids, costs, picks, columns, pharmacies):
+    assignments = []
+    total = Decimal('0.00')
+    for row, line in enumerate(lines):
+        column = min(columns, key=lambda column: costs[row, column])
+        medicine = picks[(row, column)]
+        cost = medicine.price * line['quantity']
+        total += cost
+        assignments.append({
+            'line': line,
+            'pharmacist': pharmacies[pharmacy_ids[column]],
+            'medicine': medicine,
+            'quantity': line['quantity'],
+            'cost': cost,
+        })
+    return BasketPlan(total, assignments)
+
+
+def optimize_basket(lines, availability=None, max_pharmacies=MAX_SPLIT_PHARMACIES):
+    """Find the cheapest way to buy every prescription line.
+
+    Args:
+        lines: Iterable of dicts with ``name``, optional ``strength`` and
+            optional ``quantity`` (units, default 1)
+        availability: A matrix from ``resolve_availability`` for the same
+            lines, to avoid resolving them again
+        max_pharmacies: Largest number of pharmacies a split may use
+
+    Returns:
+        BasketOptions with the cheapest single-pharmacy plan and, when it
+        is strictly cheaper, the cheapest split over 2..max_pharmacies
+        pharmacies. Lines nobody can fill are listed in ``missing`` and
+        left out of both plans.
+    """
+    lines = [dict(line, quantity=max(int(line.get('quantity') or 1), 1)) for line in lines]
+    if availability is None:
+        availability = resolve_availability(lines)
+
+    pharmacy_ids, costs, picks = _price_matrix(availability, lines)
+    fillable = np.isfinite(costs).any(axis=1) if costs.size else np.zeros(len(lines), dtype=bool)
+    missing = [line for line, ok in zip(lines, fillable) if not ok]
+    lines = [line for line, ok in zip(lines, fillable) if ok]
+    costs = costs[fillable]
+    rows = {int(old_row): new_row for new_row, old_row in enumerate(np.flatnonzero(fillable))}
+    picks = {(rows[row], column): medicine for (row, column), medicine in picks.items() if row in rows}
+
+    options = BasketOptions(missing=missing)
+    if not lines:
+        return options
+
+    single_totals = costs.sum(axis=0)
+    single_column = int(np.argmin(single_totals))
+    if np.isfinite(single_totals[single_column]):
+        options.single = _plan(lines, pharmacy_ids, costs, picks, (single_column,), availability.pharmacies)
+
+    split_total, split_columns = _best_split(costs, max_pharmacies)
+    if len(split_columns) > 1 and split_total < single_totals[single_column]:
+        options.split = _plan(lines, pharmacy_ids, costs, picks, split_columns, availability.pharmacies)
+
+    return options
@@ -0,0 +1,168 @@
+"""Set-based cart writes.
+
+``upsert_cart_items`` merges any number of lines into a patient's cart with
+one query to resolve the medicines, one to read the rows already in the
+cart and a single ``INSERT ... ON CONFLICT (patient, medicine) DO UPDATE``,
+relying on the ``unique_cart_patient_medicine`` constraint.
+
+``cart_summary`` serves each patient's item count, totals and Rx-pending
+flag from the cache for page chrome such as the cart badge. Every cart
+write calls ``refresh_cart_summary``, which recomputes the summary once the
+transaction commits. The summary is display-only: the cart page and
+checkout price the rows they load.
+"""
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Q, Sum
+from django.utils import timezone
+
+from .holds import with_available_stock
+from .models import Cart, Medicine
+
+CART_SUMMARY_KEY = 'cart:summary:%s'
+
+# Summaries are written through on every cart change in the shared cache;
+# the timeout only drops those of idle carts
+CART_SUMMARY_TIMEOUT = 60 * 60 * 24
+
+GST_RATE = Decimal('0.18')
+
+
+def _load_cart_summary(patient_id):
+    totals = Cart.objects.filter(patient_id=patient_id).aggregate(
+        count=Count('id'),
+        subtotal=Sum(ExpressionWrapper(
+            F('quantity') * F('medicine__price'),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        )),
+        rx_pending=Count('id', filter=Q(requires_prescription=True, added_from_prescription=False)),
+    )
+    subtotal = (totals['subtotal'] or Decimal('0')).quantize(Decimal('0.01'))
+    gst_amount = round(subtotal * GST_RATE, 2)
+    return {
+        'count': totals['count'],
+        'subtotal': subtotal,
+        'gst_amount': gst_amount,
+        'total_amount': subtotal + gst_amount,
+        'rx_pending': totals['rx_pending'] > 0,
+    }
+
+
+def cart_summary(patient_id):
+    """Item count, subtotal, GST, total and Rx-pending flag for a patient's cart"""
+    key = CART_SUMMARY_KEY % patient_id
+    summary = cache.get(key)
+    if summary is None:
+        summary = _load_cart_summary(patient_id)
+        cache.set(key, summary, timeout=CART_SUMMARY_TIMEOUT)
+    return summary
+
+
+def refresh_cart_summary(patient_id):
+    """Write the cart summary through after a cart change (once committed)"""
+    def write():
+        cache.set(CART_SUMMARY_KEY % patient_id, _load_cart_summary(patient_id), timeout=CART_SUMMARY_TIMEOUT)
+    transaction.on_commit(write)
+
+
+def refresh_cart_summaries_for_medicine(medicine_id):
+    """Refresh the summary of every cart holding a medicine (price change or delete).
+
+    When deleting, call it inside the same transaction before the delete:
+    the cascade removes the cart rows that identify the affected patients,
+    and the refreshes only run once the delete has committed.
+    """
+    for patient_id in Cart.objects.filter(medicine_id=medicine_id).values_list('patient_id', flat=True).distinct():
+        refresh_cart_summary(patient_id)
+
+
+class CartMergeResult:
+    """Outcome of ``upsert_cart_items``.
+
+    ``added`` and ``updated`` hold the ``Cart`` rows written; ``skipped``
+    holds ``(line, reason)`` pairs for lines that were not written.
+    """
+
+    def __init__(self):
+        self.added = []
+        self.updated = []
+        self.skipped = []
+
+    @property
+    def written(self):
+        return self.added + self.updated
+
+
+def upsert_cart_items(patient, lines, increment=False):
+    """Add or update several cart lines in one statement.
+
+    Args:
+        patient: Patient whose cart is written
+        lines: Iterable of dicts with ``medicine_id``, ``quantity`` and an
+            optional ``added_from_prescription`` flag
+        increment: Add ``quantity`` to a line already in the cart instead of
+            replacing it
+
+    Returns:
+        CartMergeResult
+    """
+    result = CartMergeResult()
+    requested = {}
+    for line in lines:
+        entry = requested.get(line['medicine_id'])
+        if entry is None:
+            requested[line['medicine_id']] = dict(line)
+        else:
+            entry['quantity'] += line['quantity']
+            entry['added_from_prescription'] = entry.get('added_from_prescription') or line.get('added_from_prescription')
+
+    medicines = with_available_stock(
+        Medicine.objects.filter(id__in=requested), exclude_patient=patient
+    ).in_bulk()
+    existing = {
+        item.medicine_id: item
+        for item in Cart.objects.filter(patient=patient, medicine_id__in=requested)
+    }
+
+    today = timezone.now().date()
+    rows = []
+    for medicine_id, line in requested.items():
+        medicine = medicines.get(medicine_id)
+        if medicine is None:
+            result.skipped.append((line, 'not_found'))
+            continue
+        if medicine.expiry_date <= today:
+            result.skipped.append((line, 'expired'))
+            continue
+        if medicine.available_quantity <= 0:
+            result.skipped.append((line, 'out_of_stock'))
+            continue
+
+        current = existing.get(medicine_id)
+        quantity = line['quantity']
+        if increment and current:
+            quantity += current.quantity
+        item = Cart(
+            patient=patient,
+            medicine=medicine,
+            quantity=quantity,
+            requires_prescription=medicine.medicine_type == 'Rx',
+            added_from_prescription=bool(line.get('added_from_prescription') or (current and current.added_from_prescription)),
+        )
+        rows.append(item)
+        (result.updated if current else result.added).append(item)
+
+    if rows:
+        conflict_target = {}
+        if connection.features.supports_update_conflicts_with_target:
+            conflict_target['unique_fields'] = ['patient', 'medicine']
+        Cart.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            update_fields=['quantity', 'requires_prescription', 'added_from_prescription'],
+            **conflict_target
+        )
+        refresh_cart_summary(patient.id)
+    return result
@@ -0,0 +1,49 @@
+"""Conditional GET for per-order detail endpoints.
+
+A view authorizes the request and reads a cheap version key for the
+resource (a single-row query of timestamps and counts) before anything
+else. ``conditional_response`` turns that key into a strong ETag, answers
+``304 Not Modified`` when the client already holds that version, and
+otherwise serves the rendered body from the cache, building it only on a
+miss. Cache keys embed the ETag, so a changed resource never hits a stale
+entry and old entries simply expire.
+"""
+import hashlib
+
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+
+DETAILS_CACHE_KEY = 'details:%s:%s'
+DETAILS_CACHE_TIMEOUT = 60 * 60
+
+
+def make_etag(*parts):
+    """Strong ETag for a version key made of the given values"""
+    return '"%s"' % hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def conditional_response(request, scope, etag, build, content_type='application/json'):
+    """Serve a versioned body, answering 304 when the client's copy is current.
+
+    Args:
+        request: The (already authorized) request
+        scope: Cache namespace naming the endpoint and principal, e.g.
+            ``'pharmacist-order:3:17'``; bodies are never shared across scopes
+        etag: ETag from ``make_etag`` for the current version
+        build: Callable returning the body (str) when it is not cached
+        content_type: Content type of the body
+    """
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        key = DETAILS_CACHE_KEY % (scope, etag.strip('"'))
+        body = cache.get(key)
+        if body is None:
+            body = build()
+            cache.set(key, body, timeout=DETAILS_CACHE_TIMEOUT)
+        response = HttpResponse(body, content_type=content_type)
+    response['ETag'] = etag
+    # Browsers keep the copy but must revalidate it on every open
+    response['Cache-Control'] = 'private, no-cache'
+    return response
@@ -1,17 +1,45 @@
-from .models import Cart, Notification
+"""Template context shared by every page.
 
+Values are callables, which templates call on first use, so a page that
+never shows the cart badge or notification count never loads it. Each
+value is computed at most once per request and reused by every template
+rendered for that request (``request_cart_summary`` and
+``request_notification_count`` give views the same memoized values).
+"""
+from .cart import cart_summary
+from .notifications import unread_count
 
-def cart_count(request):
+
+def _memoized(request, name, load):
+    """Value of ``load()``, computed on the first call for this request"""
+    memo = request.__dict__.setdefault('_context_memo', {})
+    if name not in memo:
+        memo[name] = load()
+    return memo[name]
+
+
+def request_cart_summary(request):
+    """Cart summary of the signed-in patient, or None"""
     patient_id = request.session.get('patient_id')
-    if patient_id:
-        count = Cart.objects.filter(patient_id=patient_id).count()
-        return {'cart_count': count}
-    return {'cart_count': 0}
+    if not patient_id:
+        return None
+    return _memoized(request, 'cart_summary', lambda: cart_summary(patient_id))
 
 
-def pharmacist_notifications(request):
+def request_notification_count(request):
+    """Unread notification count of the signed-in pharmacist (0 for anyone else)"""
     pharmacist_id = request.session.get('pharmacist_id')
-    if pharmacist_id:
-        count = Notification.objects.filter(pharmacist_id=pharmacist_id, is_read=False).count()
-        return {'pharmacist_notification_count': count}
-    return {'pharmacist_notification_count': 0}
+    if not pharmacist_id:
+        return 0
+    return _memoized(request, 'pharmacist_notification_count', lambda: unread_count(pharmacist_id=pharmacist_id))
+
+
+def cart_count(request):
+    def count():
+        summary = request_cart_summary(request)
+        return summary['count'] if summary else 0
+    return {'cart_count': count, 'cart_summary': lambda: request_cart_summary(request)}
+
+
+def pharmacist_notifications(request):
+    return {'pharmacist_notification_count': lambda: request_notification_count(request)}
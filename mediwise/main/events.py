@@ -0,0 +1,327 @@
+"""Server-sent event streams for live pages.
+
+Request code publishes an event to a named channel (a pharmacy's order
+queue, or one user's notifications) with ``publish``. On PostgreSQL the
+event is sent with ``pg_notify`` inside the caller's transaction, so the
+database delivers it when, and only if, that transaction commits, and to
+every server process: any web worker, the outbox dispatcher or a cron
+command can publish. Each process runs one listener thread on its own
+connection (``LISTEN``) and fans the events it receives out to the streams
+it serves. Other databases fall back to delivering within the publishing
+process after commit, which is enough for ``runserver``.
+
+Streams are async views and need the ASGI server (``start.sh``): an open
+stream is a coroutine waiting on an ``asyncio.Queue``, not a worker thread
+or a database poll. Under WSGI ``stream_response`` answers 503 rather than
+pin a worker.
+
+Event ids are ``<process>-<sequence>``. A reconnecting ``EventSource``
+served by the same process replays what it missed from the channel
+backlog; one that lands on another process, or that missed more than the
+backlog holds, gets a ``resync`` event and reloads its state.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection, connections, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL NOTIFY channel carrying every event
+NOTIFY_CHANNEL = 'mediwise_events'
+# NOTIFY payloads are limited to 8000 bytes
+MAX_NOTIFY_PAYLOAD = 7900
+# Seconds the listener waits before reconnecting after an error
+LISTEN_RETRY_SECONDS = 5
+# Seconds between keep-alive comments on an idle stream
+KEEPALIVE_SECONDS = 15
+# Events kept per channel for reconnecting clients
+BACKLOG_SIZE = 100
+# Channels whose backlog is kept (one per recently active pharmacy or user)
+MAX_BACKLOG_CHANNELS = 10000
+# Undelivered events buffered per connection before the oldest are dropped
+QUEUE_SIZE = 100
+# Milliseconds the browser waits before reconnecting
+RETRY_MS = 5000
+
+# Identifies this process in event ids
+PROCESS_TOKEN = uuid.uuid4().hex[:8]
+
+
+def pharmacist_channel(pharmacist_id):
+    return f'pharmacist:{pharmacist_id}'
+
+
+def notification_channel(role, recipient_id):
+    """Channel of one user's notifications; ``role`` is 'patient' or 'pharmacist'"""
+    return f'notifications:{role}:{recipient_id}'
+
+
+class Subscription:
+    """One open stream's queue, bound to the event loop that serves it"""
+
+    def __init__(self, channels, loop):
+        self.channels = channels
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    def put(self, message):
+        # Runs on the subscriber's loop; a stalled client loses its oldest events
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+
+class EventBroker:
+    """Thread-safe fan-out of received events to this process's subscriptions"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._subscriptions = {}
+        self._backlog = OrderedDict()
+
+    def subscribe(self, channels, last_event_id=None):
+        """Subscribe the running event loop to ``channels``.
+
+        A ``last_event_id`` from this process replays the newer events
+        still in the backlog; any other one queues a ``resync`` event.
+        """
+        subscription = Subscription(tuple(channels), asyncio.get_running_loop())
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions.setdefault(channel, set()).add(subscription)
+            if last_event_id is not None:
+                for message in self._missed(subscription.channels, last_event_id):
+                    subscription.put(message)
+        return subscription
+
+    def _missed(self, channels, last_event_id):
+        token, _, sequence = last_event_id.partition('-')
+        if token != PROCESS_TOKEN or not sequence.isdigit():
+            return [self._resync_message()]
+        sequence = int(sequence)
+        missed = []
+        for channel in channels:
+            backlog = self._backlog.get(channel, ())
+            if len(backlog) == BACKLOG_SIZE and backlog[0][0] > sequence + 1:
+                # Older events than the backlog holds were missed
+                return [self._resync_message()]
+            missed.extend(message for message in backlog if message[0] > sequence)
+        return sorted(missed)
+
+    def _resync_message(self):
+        return (next(self._ids), 'resync', '{}')
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscriptions = self._subscriptions.get(channel)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self._subscriptions[channel]
+
+    def deliver(self, channel, event, data):
+        """Hand an event to every current subscriber of ``channel`` (any thread)"""
+        with self._lock:
+            message = (next(self._ids), event, data if isinstance(data, str) else json.dumps(data))
+            backlog = self._backlog.get(channel)
+            if backlog is None:
+                backlog = self._backlog[channel] = deque(maxlen=BACKLOG_SIZE)
+                if len(self._backlog) > MAX_BACKLOG_CHANNELS:
+                    self._backlog.popitem(last=False)
+            else:
+                self._backlog.move_to_end(channel)
+            backlog.append(message)
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        self._send(subscriptions, message)
+        return message[0]
+
+    def resync_all(self):
+        """Tell every open stream to reload, after events may have been lost"""
+        with self._lock:
+            message = self._resync_message()
+            subscriptions = {s for group in self._subscriptions.values() for s in group}
+        self._send(subscriptions, message)
+
+    def _send(self, subscriptions, message):
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, message)
+            except RuntimeError:
+                # The stream's loop has closed; its response is gone
+                self.unsubscribe(subscription)
+
+    def subscriber_count(self, channel):
+        with self._lock:
+            return len(self._subscriptions.get(channel, ()))
+
+
+broker = EventBroker()
+
+
+def publish(channel, event, data):
+    """Publish an event to every process's subscribers once the current transaction commits.
+
+    Returns:
+        False if the event was too large to send (nothing is published)
+    """
+    if connection.vendor != 'postgresql':
+        transaction.on_commit(lambda: broker.deliver(channel, event, data))
+        return True
+    payload = json.dumps({'channel': channel, 'event': event, 'data': data})
+    if len(payload.encode()) > MAX_NOTIFY_PAYLOAD:
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_notify(%s, %s)", [NOTIFY_CHANNEL, payload])
+    return True
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _listen():
+    """Listener thread: deliver every NOTIFY on ``NOTIFY_CHANNEL`` to this process's streams"""
+    import psycopg
+
+    params = connections['default'].get_connection_params()
+    reconnecting = False
+    while True:
+        try:
+            with psycopg.connect(**params, autocommit=True) as listen_connection:
+                listen_connection.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                if reconnecting:
+                    # Events sent while the listener was down are lost
+                    broker.resync_all()
+                reconnecting = True
+                for notify in listen_connection.notifies():
+                    try:
+                        message = json.loads(notify.payload)
+                        broker.deliver(message['channel'], message['event'], message['data'])
+                    except (KeyError, ValueError):
+                        logger.warning("Ignored malformed event payload: %r", notify.payload)
+        except Exception:
+            logger.exception("Event listener lost its connection; retrying in %ss", LISTEN_RETRY_SECONDS)
+            time.sleep(LISTEN_RETRY_SECONDS)
+
+
+def ensure_listener():
+    """Start this process's listener thread (PostgreSQL only) if it isn't running"""
+    global _listener
+    if connection.vendor != 'postgresql' or _listener is not None:
+        return
+    with _listener_lock:
+        if _listener is None:
+            _listener = threading.Thread(target=_listen, name='event-listener', daemon=True)
+            _listener.start()
+
+
+def format_event(message):
+    event_id, event, data = message
+    if event_id is None:
+        # Keeps the client's Last-Event-ID where it was
+        return f"event: {event}\ndata: {data}\n\n"
+    return f"id: {PROCESS_TOKEN}-{event_id}\nevent: {event}\ndata: {data}\n\n"
+
+
+async def event_stream(subscription):
+    """Async iterator of SSE frames for a subscription; unsubscribes when the client goes"""
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+        while True:
+            try:
+                message = await asyncio.wait_for(subscription.queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            yield format_event(message)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def stream_response(request, channels, initial=()):
+    """``text/event-stream`` response subscribed to ``channels``, resuming after the client's Last-Event-ID.
+
+    Args:
+        initial: ``(event, data)`` pairs sent first on every connect, to
+            bring the page's state up to date
+    """
+    if not isinstance(request, ASGIRequest):
+        # A WSGI worker would be held for as long as the page stays open
+        return HttpResponse("Live updates need the ASGI server.", status=503, content_type='text/plain')
+
+    ensure_listener()
+    subscription = broker.subscribe(channels, request.headers.get('Last-Event-ID'))
+    for event, data in initial:
+        subscription.put((None, event, json.dumps(data)))
+    response = StreamingHttpResponse(event_stream(subscription), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Don't let a proxy buffer the stream
+    return response
+
+
+def _order_payload(pharmacy_order):
+    return {
+        'order_id': pharmacy_order.order_id,
+        'status': pharmacy_order.status,
+        'status_display': pharmacy_order.get_status_display(),
+        'total_amount': str(pharmacy_order.total_amount),
+        'item_count': pharmacy_order.item_count,
+    }
+
+
+def publish_new_orders(pharmacy_orders):
+    """Tell each pharmacy about its share of a newly placed order"""
+    for pharmacy_order in pharmacy_orders:
+        payload = _order_payload(pharmacy_order)
+        channel = pharmacist_channel(pharmacy_order.pharmacist_id)
+        row = render_to_string('pharmacist/order_row.html', {'pharmacy_order': pharmacy_order})
+        # An oversized row is left out; the page then just announces the order
+        if not publish(channel, 'order_created', {**payload, 'html': row}):
+            publish(channel, 'order_created', payload)
+
+
+def publish_status_changes(pharmacy_orders):
+    """Tell each pharmacy that its share of an order changed status"""
+    for pharmacy_order in pharmacy_orders:
+        publish(pharmacist_channel(pharmacy_order.pharmacist_id), 'order_status', _order_payload(pharmacy_order))
+
+
+def _notification_recipient(notification):
+    if notification.patient_id:
+        return 'patient', notification.patient_id
+    return 'pharmacist', notification.pharmacist_id
+
+
+def publish_notifications(notifications):
+    """Push newly created notifications to their recipients' streams"""
+    for notification in notifications:
+        channel = notification_channel(*_notification_recipient(notification))
+        payload = {
+            'id': notification.id,
+            'notification_type': notification.notification_type,
+            'title': notification.title,
+            'message': notification.message,
+            'related_id': notification.related_id,
+            'created_at': notification.created_at.isoformat(),
+        }
+        # An oversized message is left out; the card then shows the title only
+        if not publish(channel, 'notification', payload):
+            publish(channel, 'notification', {**payload, 'message': ''})
+
+
+def publish_unread_counts(role, counts):
+    """Push committed unread counts (``{recipient_id: count}``) to the recipients' streams"""
+    for recipient_id, count in counts.items():
+        publish(notification_channel(role, recipient_id), 'unread_count', {'unread_count': count})
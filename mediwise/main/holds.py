@@ -0,0 +1,121 @@
+"""Time-boxed stock holds between checkout and payment.
+
+``checkout`` places a ``StockHold`` for every cart line, valid for
+``STOCK_HOLD_TTL``. While a hold is active its units count against the
+medicine's available stock for everyone else, so contended items fail at
+checkout rather than after card details are entered. Payment consumes the
+patient's holds; expired ones are simply ignored by every query and are
+deleted in bulk by ``release_expired_holds`` (run by checkout and by the
+``release_stock_holds`` management command).
+
+Placing and releasing holds is journaled (``held`` / ``released``
+inventory changes), so indexes built on available stock re-read the
+affected medicines; ``next_hold_expiry`` tells them when a hold will lapse
+without a write.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F, IntegerField, Min, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .inventory import InsufficientStock, record_inventory_changes
+from .models import Medicine, StockHold
+
+STOCK_HOLD_TTL = timedelta(minutes=10)
+
+
+def active_holds(exclude_patient=None):
+    holds = StockHold.objects.filter(expires_at__gt=timezone.now())
+    if exclude_patient is not None:
+        holds = holds.exclude(patient=exclude_patient)
+    return holds
+
+
+def with_available_stock(medicines, exclude_patient=None):
+    """Annotate ``held_quantity`` and ``available_quantity`` (stock minus active holds)"""
+    held = active_holds(exclude_patient).filter(
+        medicine=OuterRef('pk')
+    ).order_by().values('medicine').annotate(total=Sum('quantity')).values('total')
+    return medicines.annotate(
+        held_quantity=Coalesce(Subquery(held, output_field=IntegerField()), Value(0)),
+    ).annotate(
+        available_quantity=F('quantity') - F('held_quantity'),
+    )
+
+
+def next_hold_expiry(now=None):
+    """Earliest expiry of the holds active at ``now``, or None"""
+    holds = StockHold.objects.filter(expires_at__gt=now or timezone.now())
+    return holds.aggregate(expires_at=Min('expires_at'))['expires_at']
+
+
+def _journal_holds(holds, action):
+    """Journal ``(medicine_id, pharmacist_id)`` pairs whose held units changed"""
+    changes = [(pharmacist_id, medicine_id, action, 0) for medicine_id, pharmacist_id in set(holds)]
+    if changes:
+        record_inventory_changes(changes)
+
+
+def held_quantities(medicine_ids, exclude_patient=None):
+    """Units under active hold per medicine id"""
+    rows = active_holds(exclude_patient).filter(
+        medicine_id__in=medicine_ids
+    ).order_by().values('medicine_id').annotate(total=Sum('quantity'))
+    return {row['medicine_id']: row['total'] for row in rows}
+
+
+def place_holds(patient, quantities):
+    """Replace the patient's holds with holds for ``quantities``.
+
+    Args:
+        patient: Patient checking out
+        quantities: Mapping of medicine id to units
+
+    Returns:
+        Expiry time of the new holds
+
+    Raises:
+        Medicine.DoesNotExist: A medicine no longer exists
+        InsufficientStock: Stock not already held by others is short
+    """
+    quantities = {medicine_id: quantity for medicine_id, quantity in quantities.items() if quantity > 0}
+    with transaction.atomic():
+        release_holds(patient)
+        # Serialize concurrent checkouts of the same medicines
+        locked = list(Medicine.objects.select_for_update().filter(id__in=quantities).order_by('id').values_list('id', 'pharmacist_id'))
+        if len(locked) != len(quantities):
+            raise Medicine.DoesNotExist('One or more medicines are no longer available.')
+
+        medicines = with_available_stock(Medicine.objects.filter(id__in=quantities), exclude_patient=patient)
+        short = [medicine for medicine in medicines if medicine.available_quantity < quantities[medicine.id]]
+        if short:
+            raise InsufficientStock(short)
+
+        expires_at = timezone.now() + STOCK_HOLD_TTL
+        StockHold.objects.bulk_create([
+            StockHold(patient=patient, medicine_id=medicine_id, quantity=quantity, expires_at=expires_at)
+            for medicine_id, quantity in quantities.items()
+        ])
+        _journal_holds(locked, 'held')
+    return expires_at
+
+
+def _release(holds):
+    with transaction.atomic():
+        released = list(holds.values_list('medicine_id', 'medicine__pharmacist_id'))
+        if released:
+            holds.delete()
+            _journal_holds(released, 'released')
+    return len(released)
+
+
+def release_holds(patient):
+    """Drop all of a patient's holds (payment done or checkout restarted)"""
+    return _release(StockHold.objects.filter(patient=patient))
+
+
+def release_expired_holds():
+    """Delete every expired hold; returns the number removed"""
+    return _release(StockHold.objects.filter(expires_at__lte=timezone.now()))
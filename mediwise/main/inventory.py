@@ -0,0 +1,307 @@
+"""Inventory change journal and version counters.
+
+Every write path that touches ``Medicine`` records an ``InventoryChange``
+through ``record_inventory_change``, which also advances the pharmacist's
+``InventoryVersion``. Anything derived from ``Medicine`` (availability
+snapshots, search indexes, dashboards, ...) can then be cached against
+these versions and brought up to date with ``inventory_changes_since``
+instead of rescanning the catalog.
+
+The global version is the id of the newest journal row; a pharmacy's
+version is its ``InventoryVersion.version``. Both are read through a short
+lived cache entry so hot paths do not pay a query on every call.
+
+Journal ids are allocated before commit, so a slow transaction can commit
+an entry below ids that are already visible. Processes that follow the
+journal therefore track an ``InventoryWatermark`` of per-pharmacy
+versions, which only ever become visible in order.
+"""
+import operator
+import time
+from functools import reduce
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Max, Q, Value, When
+from django.utils import timezone
+
+from .models import InventoryChange, InventoryVersion, Medicine
+
+GLOBAL_VERSION_KEY = 'inventory:version'
+PHARMACY_VERSION_KEY = 'inventory:version:%s'
+
+# Bounds how long another worker process can serve a version that has
+# already moved on; writes in this process invalidate the entry immediately.
+VERSION_CACHE_TIMEOUT = 5
+
+
+def _version_key(pharmacist_id=None):
+    if pharmacist_id is None:
+        return GLOBAL_VERSION_KEY
+    return PHARMACY_VERSION_KEY % pharmacist_id
+
+
+def _load_version(pharmacist_id=None):
+    if pharmacist_id is None:
+        return InventoryChange.objects.aggregate(head=Max('id'))['head'] or 0
+    return InventoryVersion.objects.filter(
+        pharmacist_id=pharmacist_id
+    ).values_list('version', flat=True).first() or 0
+
+
+def inventory_version(pharmacist_id=None):
+    """Current inventory version, globally or for a single pharmacy"""
+    key = _version_key(pharmacist_id)
+    version = cache.get(key)
+    if version is None:
+        version = _load_version(pharmacist_id)
+        cache.set(key, version, timeout=VERSION_CACHE_TIMEOUT)
+    return version
+
+
+def record_inventory_change(pharmacist_id, medicine_id, action, quantity_delta=0):
+    """Append a journal entry for a Medicine write and advance the versions.
+
+    Args:
+        pharmacist_id: Owner of the medicine
+        medicine_id: ID of the medicine written (capture it before deleting)
+        action: One of InventoryChange.ACTION_CHOICES
+        quantity_delta: Change in stock caused by the write
+
+    Returns:
+        The InventoryChange row
+    """
+    return record_inventory_changes([(pharmacist_id, medicine_id, action, quantity_delta)])[0]
+
+
+def record_inventory_changes(changes):
+    """Journal several Medicine writes at once.
+
+    Args:
+        changes: Iterable of ``(pharmacist_id, medicine_id, action,
+            quantity_delta)`` tuples
+
+    Returns:
+        The InventoryChange rows, in the order given
+    """
+    changes = list(changes)
+    pharmacist_ids = sorted({change[0] for change in changes})
+    with transaction.atomic():
+        InventoryVersion.objects.bulk_create(
+            [InventoryVersion(pharmacist_id=pharmacist_id) for pharmacist_id in pharmacist_ids],
+            ignore_conflicts=True,
+        )
+        counters = {
+            counter.pharmacist_id: counter
+            for counter in InventoryVersion.objects.select_for_update().filter(
+                pharmacist_id__in=pharmacist_ids
+            ).order_by('pharmacist_id')
+        }
+        entries = []
+        for pharmacist_id, medicine_id, action, quantity_delta in changes:
+            counter = counters[pharmacist_id]
+            counter.version += 1
+            entries.append(InventoryChange(
+                pharmacist_id=pharmacist_id,
+                medicine_id=medicine_id,
+                action=action,
+                quantity_delta=quantity_delta,
+                version=counter.version,
+            ))
+        now = timezone.now()
+        for counter in counters.values():
+            counter.updated_at = now
+        InventoryVersion.objects.bulk_update(counters.values(), ['version', 'updated_at'])
+        entries = InventoryChange.objects.bulk_create(entries)
+
+    # Drop rather than overwrite (a concurrent writer could otherwise leave an
+    # older version cached), and only once the surrounding transaction commits.
+    keys = [_version_key(pharmacist_id) for pharmacist_id in pharmacist_ids] + [GLOBAL_VERSION_KEY]
+    transaction.on_commit(lambda: cache.delete_many(keys))
+    return entries
+
+
+def remove_medicine(medicine):
+    """Delete a medicine row, journal the delete and refresh the carts that held it"""
+    from .cart import refresh_cart_summaries_for_medicine
+
+    medicine_id = medicine.id
+    with transaction.atomic():
+        # Affected carts are found before the cascade and refreshed after commit
+        refresh_cart_summaries_for_medicine(medicine_id)
+        medicine.delete()
+        record_inventory_change(medicine.pharmacist_id, medicine_id, 'deleted', -medicine.quantity)
+
+
+def return_stock(quantities):
+    """Put units back on the shelf (e.g. after a failed payment) in one UPDATE.
+
+    Args:
+        quantities: Mapping of medicine id to units to add back; medicines
+            deleted in the meantime are skipped
+    """
+    quantities = {medicine_id: quantity for medicine_id, quantity in quantities.items() if quantity > 0}
+    if not quantities:
+        return
+    returned = Case(
+        *[When(id=medicine_id, then=Value(quantity)) for medicine_id, quantity in quantities.items()],
+        output_field=IntegerField(),
+    )
+    with transaction.atomic():
+        Medicine.objects.filter(id__in=quantities).update(quantity=F('quantity') + returned)
+        record_inventory_changes(
+            (pharmacist_id, medicine_id, 'returned', quantities[medicine_id])
+            for medicine_id, pharmacist_id in Medicine.objects.filter(
+                id__in=quantities
+            ).values_list('id', 'pharmacist_id')
+        )
+
+
+class InsufficientStock(Exception):
+    """Raised by ``reserve_stock`` when a line cannot be covered"""
+
+    def __init__(self, medicines):
+        self.medicines = medicines
+        super().__init__(', '.join(medicine.brand_name for medicine in medicines))
+
+
+def reserve_stock(quantities, exclude_patient=None):
+    """Decrement stock for a whole order in one guarded UPDATE.
+
+    The rows are locked (``select_for_update``, in id order so concurrent
+    checkouts cannot deadlock) and then decremented by a single statement
+    whose WHERE clause requires enough stock on every row. If any row is
+    short, even because another checkout got there first on a database
+    without row locks, nothing is written. Units under other buyers'
+    active holds are read after the lock, so a hold placed concurrently
+    cannot be missed, and must be left in stock.
+
+    Args:
+        quantities: Mapping of medicine id to units to take
+        exclude_patient: The buyer, whose own holds this order consumes
+
+    Returns:
+        dict of medicine id to ``Medicine`` with ``quantity`` already reduced
+
+    Raises:
+        Medicine.DoesNotExist: A medicine no longer exists
+        InsufficientStock: One or more medicines are short
+    """
+    from .holds import held_quantities
+
+    quantities = {medicine_id: quantity for medicine_id, quantity in quantities.items() if quantity > 0}
+    with transaction.atomic():
+        medicines = {
+            medicine.id: medicine
+            for medicine in Medicine.objects.select_for_update().filter(
+                id__in=quantities
+            ).order_by('id')
+        }
+        if len(medicines) != len(quantities):
+            raise Medicine.DoesNotExist('One or more medicines are no longer available.')
+
+        # place_holds takes the same row locks, so no hold can appear after this read
+        held = held_quantities(quantities, exclude_patient=exclude_patient)
+        short = [
+            medicine for medicine in medicines.values()
+            if medicine.quantity - held.get(medicine.id, 0) < quantities[medicine.id]
+        ]
+        if short:
+            raise InsufficientStock(short)
+
+        wanted = Case(
+            *[When(id=medicine_id, then=Value(quantity)) for medicine_id, quantity in quantities.items()],
+            output_field=IntegerField(),
+        )
+        required = Case(
+            *[When(id=medicine_id, then=Value(quantity + held.get(medicine_id, 0))) for medicine_id, quantity in quantities.items()],
+            output_field=IntegerField(),
+        )
+        updated = Medicine.objects.filter(
+            id__in=quantities, quantity__gte=required
+        ).update(quantity=F('quantity') - wanted)
+        if updated != len(quantities):
+            raise InsufficientStock(list(medicines.values()))
+
+        for medicine in medicines.values():
+            medicine.quantity -= quantities[medicine.id]
+        record_inventory_changes(
+            (medicine.pharmacist_id, medicine.id, 'sold', -quantities[medicine.id])
+            for medicine in medicines.values()
+        )
+    return medicines
+
+
+def inventory_changes_since(version, pharmacist_id=None):
+    """Journal entries recorded after ``version``, oldest first.
+
+    The global form can miss an entry that commits after higher ids were
+    read; processes following the whole journal use ``InventoryWatermark``.
+    """
+    if pharmacist_id is None:
+        return InventoryChange.objects.filter(id__gt=version)
+    return InventoryChange.objects.filter(pharmacist_id=pharmacist_id, version__gt=version)
+
+
+def inventory_versions():
+    """Every pharmacy's inventory version, as ``{pharmacist_id: version}``.
+
+    Writers hold a pharmacy's ``InventoryVersion`` row lock until they
+    commit, so its version never exposes a gap the way journal ids can.
+    """
+    return dict(InventoryVersion.objects.values_list('pharmacist_id', 'version'))
+
+
+def inventory_changes_between(seen, current):
+    """Journal entries after the ``seen`` versions up to the ``current`` ones (both from ``inventory_versions``)"""
+    moved = [
+        Q(pharmacist_id=pharmacist_id, version__gt=seen.get(pharmacist_id, 0), version__lte=version)
+        for pharmacist_id, version in current.items()
+        if version > seen.get(pharmacist_id, 0)
+    ]
+    if not moved:
+        return InventoryChange.objects.none()
+    return InventoryChange.objects.filter(reduce(operator.or_, moved))
+
+
+class InventoryWatermark:
+    """How far a process-local index has applied the inventory journal.
+
+    The cheap global version tells when something changed; the
+    per-pharmacy versions say exactly what, including entries that
+    committed after higher journal ids. They are also re-read every
+    ``RECHECK_INTERVAL`` seconds so a late commit that left the global
+    version unchanged is still picked up.
+    """
+
+    RECHECK_INTERVAL = 30
+
+    def __init__(self):
+        self.head = None
+        self.versions = {}
+        self.checked_at = 0.0
+
+    def reset(self):
+        """Start from the current state; call before (re)loading the index"""
+        self.head = inventory_version()
+        self.versions = inventory_versions()
+        self.checked_at = time.monotonic()
+
+    def changed_medicines(self, limit):
+        """Ids of medicines written since the last call.
+
+        Returns None when more than ``limit`` entries are pending and a full
+        reload is cheaper; the watermark is then left for ``reset``.
+        """
+        head = inventory_version()
+        now = time.monotonic()
+        if head == self.head and now - self.checked_at < self.RECHECK_INTERVAL:
+            return set()
+        versions = inventory_versions()
+        changed = list(
+            inventory_changes_between(self.versions, versions).values_list('medicine_id', flat=True)[:limit + 1]
+        )
+        if len(changed) > limit:
+            return None
+        self.head, self.versions, self.checked_at = head, versions, now
+        return set(changed)
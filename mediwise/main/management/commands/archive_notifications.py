@@ -0,0 +1,19 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from main.notifications import NOTIFICATION_ARCHIVE_AFTER, archive_read_notifications
+
+
+class Command(BaseCommand):
+    help = "Move notifications read long ago into the archive table (schedule daily, e.g. from cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=NOTIFICATION_ARCHIVE_AFTER.days,
+            help="Archive notifications read more than this many days ago",
+        )
+
+    def handle(self, *args, **options):
+        archived = archive_read_notifications(older_than=timedelta(days=options['days']))
+        self.stdout.write(self.style.SUCCESS(f"Archived {archived} notification(s)."))
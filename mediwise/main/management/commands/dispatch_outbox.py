@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from main.outbox import dispatch_events, purge_dispatched_events
+
+
+class Command(BaseCommand):
+    help = "Turn pending outbox events into notifications and purge old dispatched events (schedule every minute, e.g. from cron)"
+
+    def handle(self, *args, **options):
+        dispatched = dispatch_events()
+        purged = purge_dispatched_events()
+        self.stdout.write(self.style.SUCCESS(f"Dispatched {dispatched} outbox event(s), purged {purged}."))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from main.holds import release_expired_holds
+
+
+class Command(BaseCommand):
+    help = "Delete expired stock holds (schedule every few minutes, e.g. from cron)"
+
+    def handle(self, *args, **options):
+        released = release_expired_holds()
+        self.stdout.write(self.style.SUCCESS(f"Released {released} expired stock hold(s)."))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from main.payments import settle_stale_payments
+
+
+class Command(BaseCommand):
+    help = "Fail payments whose capture was lost to a restart or crash (schedule every few minutes, e.g. from cron)"
+
+    def handle(self, *args, **options):
+        settled = settle_stale_payments()
+        self.stdout.write(self.style.SUCCESS(f"Failed {settled} stale payment(s)."))
@@ -0,0 +1,79 @@
+# Generated by Django 6.0.1 on 2026-10-18 10:00
+
+from django.db import migrations
+
+
+FTS_TABLE = 'main_medicine_fts'
+
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS main_medicine_generic_trgm ON main_medicine USING gin (generic_name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS main_medicine_brand_trgm ON main_medicine USING gin (brand_name gin_trgm_ops)",
+]
+
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS main_medicine_generic_trgm",
+    "DROP INDEX IF EXISTS main_medicine_brand_trgm",
+]
+
+SQLITE_FORWARD = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        generic_name, brand_name,
+        content='main_medicine', content_rowid='id', tokenize='trigram'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS main_medicine_fts_ai AFTER INSERT ON main_medicine BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, generic_name, brand_name)
+        VALUES (new.id, new.generic_name, new.brand_name);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS main_medicine_fts_ad AFTER DELETE ON main_medicine BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, generic_name, brand_name)
+        VALUES ('delete', old.id, old.generic_name, old.brand_name);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS main_medicine_fts_au AFTER UPDATE OF generic_name, brand_name ON main_medicine BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, generic_name, brand_name)
+        VALUES ('delete', old.id, old.generic_name, old.brand_name);
+        INSERT INTO {FTS_TABLE}(rowid, generic_name, brand_name)
+        VALUES (new.id, new.generic_name, new.brand_name);
+    END""",
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS main_medicine_fts_ai",
+    "DROP TRIGGER IF EXISTS main_medicine_fts_ad",
+    "DROP TRIGGER IF EXISTS main_medicine_fts_au",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+
+def _run(schema_editor, statements):
+    with schema_editor.connection.cursor() as cursor:
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def create_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        _run(schema_editor, POSTGRES_FORWARD)
+    elif vendor == 'sqlite':
+        _run(schema_editor, SQLITE_FORWARD)
+
+
+def drop_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        _run(schema_editor, POSTGRES_REVERSE)
+    elif vendor == 'sqlite':
+        _run(schema_editor, SQLITE_REVERSE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0059_alter_order_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 6.0.1 on 2026-10-18 10:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0060_medicine_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('pharmacist', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='inventory_version', to='main.pharmacist')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='InventoryChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('medicine_id', models.PositiveBigIntegerField(help_text='ID of the affected medicine (kept after the medicine is deleted)')),
+                ('action', models.CharField(choices=[('added', 'Added'), ('updated', 'Updated'), ('deleted', 'Deleted'), ('sold', 'Sold')], max_length=10)),
+                ('quantity_delta', models.IntegerField(default=0, help_text='Change in stock caused by this write')),
+                ('version', models.PositiveBigIntegerField(help_text='Pharmacist inventory version after this change')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('pharmacist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inventory_changes', to='main.pharmacist')),
+            ],
+            options={
+                'ordering': ['id'],
+                'constraints': [models.UniqueConstraint(fields=('pharmacist', 'version'), name='unique_inventory_change_version')],
+            },
+        ),
+    ]
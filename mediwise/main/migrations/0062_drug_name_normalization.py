@@ -0,0 +1,94 @@
+# Generated by Django 6.0.1 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+# Common synonyms and brands, keyed alias -> canonical generic name
+SEED_ALIASES = {
+    'acetaminophen': 'paracetamol',
+    'apap': 'paracetamol',
+    'dolo': 'paracetamol',
+    'dolo 650': 'paracetamol',
+    'crocin': 'paracetamol',
+    'calpol': 'paracetamol',
+    'tylenol': 'paracetamol',
+    'panadol': 'paracetamol',
+    'citrizen': 'cetirizine',
+    'cetrizine': 'cetirizine',
+    'zyrtec': 'cetirizine',
+    'brufen': 'ibuprofen',
+    'advil': 'ibuprofen',
+    'motrin': 'ibuprofen',
+    'amoxycillin': 'amoxicillin',
+    'mox': 'amoxicillin',
+    'glycomet': 'metformin',
+    'glucophage': 'metformin',
+    'pan 40': 'pantoprazole',
+    'pantocid': 'pantoprazole',
+    'azee': 'azithromycin',
+    'zithromax': 'azithromycin',
+    'albuterol': 'salbutamol',
+    'asthalin': 'salbutamol',
+    'ventolin': 'salbutamol',
+}
+
+
+def normalize(name):
+    return ' '.join((name or '').lower().split())
+
+
+def seed_and_backfill(apps, schema_editor):
+    DrugAlias = apps.get_model('main', 'DrugAlias')
+    Medicine = apps.get_model('main', 'Medicine')
+    PrescriptionMedicine = apps.get_model('main', 'PrescriptionMedicine')
+
+    DrugAlias.objects.bulk_create(
+        [DrugAlias(alias=alias, canonical_name=canonical) for alias, canonical in SEED_ALIASES.items()],
+        ignore_conflicts=True,
+    )
+
+    aliases = dict(DrugAlias.objects.values_list('alias', 'canonical_name'))
+
+    medicines = list(Medicine.objects.only('id', 'generic_name'))
+    for medicine in medicines:
+        name = normalize(medicine.generic_name)
+        medicine.normalized_name = aliases.get(name, name)
+    Medicine.objects.bulk_update(medicines, ['normalized_name'], batch_size=500)
+
+    prescription_medicines = list(PrescriptionMedicine.objects.only('id', 'drug_name_generic', 'drug_name_brand'))
+    for prescription_medicine in prescription_medicines:
+        name = normalize(prescription_medicine.drug_name_generic or prescription_medicine.drug_name_brand)
+        prescription_medicine.normalized_name = aliases.get(name, name)
+    PrescriptionMedicine.objects.bulk_update(prescription_medicines, ['normalized_name'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0061_inventoryversion_inventorychange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DrugAlias',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('alias', models.CharField(help_text='Normalized synonym or brand name, e.g. acetaminophen, dolo', max_length=200, unique=True)),
+                ('canonical_name', models.CharField(db_index=True, help_text='Normalized canonical generic name, e.g. paracetamol', max_length=200)),
+            ],
+            options={
+                'verbose_name_plural': 'Drug aliases',
+            },
+        ),
+        migrations.AddField(
+            model_name='medicine',
+            name='normalized_name',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='Canonical generic name used for indexed matching', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='prescriptionmedicine',
+            name='normalized_name',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='Canonical generic name used for indexed matching', max_length=200),
+        ),
+        migrations.RunPython(seed_and_backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0.1 on 2026-10-18 11:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0062_drug_name_normalization'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('medicine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_holds', to='main.medicine')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_holds', to='main.patient')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['medicine', 'expires_at'], name='stockhold_medicine_expiry_idx')],
+            },
+        ),
+    ]
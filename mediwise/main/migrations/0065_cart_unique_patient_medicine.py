@@ -0,0 +1,38 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_cart_rows(apps, schema_editor):
+    """Fold repeated (patient, medicine) cart rows into the oldest one"""
+    Cart = apps.get_model('main', 'Cart')
+    duplicates = Cart.objects.values('patient_id', 'medicine_id').annotate(
+        rows=Count('id')
+    ).filter(rows__gt=1).order_by()
+
+    for duplicate in duplicates:
+        items = list(Cart.objects.filter(
+            patient_id=duplicate['patient_id'], medicine_id=duplicate['medicine_id']
+        ).order_by('id'))
+        keep, extra = items[0], items[1:]
+        keep.quantity = sum(item.quantity for item in items)
+        keep.requires_prescription = any(item.requires_prescription for item in items)
+        keep.added_from_prescription = any(item.added_from_prescription for item in items)
+        keep.save(update_fields=['quantity', 'requires_prescription', 'added_from_prescription'])
+        Cart.objects.filter(id__in=[item.id for item in extra]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0064_pendingorder'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_cart_rows, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('patient', 'medicine'), name='unique_cart_patient_medicine'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0065_cart_unique_patient_medicine'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='failure_reason',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='gateway_reference',
+            field=models.CharField(blank=True, help_text='Reference returned by the payment backend', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='settled_at',
+            field=models.DateTimeField(blank=True, help_text='When the capture was confirmed or failed', null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='status',
+            field=models.CharField(choices=[('processing', 'Processing'), ('captured', 'Captured'), ('failed', 'Failed')], default='captured', help_text='Capture state reported by the payment backend', max_length=12),
+        ),
+        migrations.AlterField(
+            model_name='inventorychange',
+            name='action',
+            field=models.CharField(choices=[('added', 'Added'), ('updated', 'Updated'), ('deleted', 'Deleted'), ('sold', 'Sold'), ('returned', 'Returned')], max_length=10),
+        ),
+    ]
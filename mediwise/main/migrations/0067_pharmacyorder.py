@@ -0,0 +1,81 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:40
+
+import django.db.models.deletion
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum
+
+GST_RATE = Decimal('0.18')
+
+
+def route_existing_orders(apps, schema_editor):
+    """Stamp items with their pharmacy and build the per-pharmacy shares of past orders"""
+    Medicine = apps.get_model('main', 'Medicine')
+    OrderItem = apps.get_model('main', 'OrderItem')
+    PharmacyOrder = apps.get_model('main', 'PharmacyOrder')
+
+    OrderItem.objects.filter(pharmacist__isnull=True, medicine__isnull=False).update(
+        pharmacist_id=Subquery(Medicine.objects.filter(pk=OuterRef('medicine_id')).values('pharmacist_id')[:1])
+    )
+
+    shares = OrderItem.objects.filter(pharmacist__isnull=False).values(
+        'order_id', 'pharmacist_id', 'order__status', 'order__created_at'
+    ).annotate(
+        item_count=Count('id'),
+        subtotal=Sum(ExpressionWrapper(
+            F('quantity') * F('price_at_order'),
+            output_field=DecimalField(max_digits=10, decimal_places=2),
+        )),
+    ).order_by()
+
+    rows = []
+    for share in shares.iterator():
+        subtotal = (share['subtotal'] or Decimal('0')).quantize(Decimal('0.01'))
+        gst_amount = round(subtotal * GST_RATE, 2)
+        rows.append(PharmacyOrder(
+            order_id=share['order_id'],
+            pharmacist_id=share['pharmacist_id'],
+            status=share['order__status'],
+            created_at=share['order__created_at'],
+            item_count=share['item_count'],
+            subtotal=subtotal,
+            gst_amount=gst_amount,
+            total_amount=subtotal + gst_amount,
+        ))
+    PharmacyOrder.objects.bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0066_transaction_capture_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='pharmacist',
+            field=models.ForeignKey(blank=True, help_text='Pharmacy the item was sold by, kept if the medicine is later deleted', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='order_items', to='main.pharmacist'),
+        ),
+        migrations.CreateModel(
+            name='PharmacyOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('preparing', 'Preparing'), ('out_for_delivery', 'Out for Delivery'), ('ready_for_pickup', 'Ready for Pickup'), ('completed', 'Completed'), ('failed', 'Failed'), ('delayed', 'Delayed')], default='pending', max_length=20)),
+                ('item_count', models.PositiveIntegerField(default=0)),
+                ('subtotal', models.DecimalField(decimal_places=2, default=0.0, max_digits=10)),
+                ('gst_amount', models.DecimalField(decimal_places=2, default=0.0, max_digits=10)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0.0, max_digits=10)),
+                ('created_at', models.DateTimeField(help_text='Copied from the order so pharmacy queues sort without a join')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pharmacy_orders', to='main.order')),
+                ('pharmacist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pharmacy_orders', to='main.pharmacist')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['pharmacist', 'status'], name='pharmacyorder_status_idx'), models.Index(fields=['pharmacist', '-created_at'], name='pharmacyorder_created_idx')],
+                'constraints': [models.UniqueConstraint(fields=('order', 'pharmacist'), name='unique_pharmacy_order')],
+            },
+        ),
+        migrations.RunPython(route_existing_orders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0067_pharmacyorder'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='pharmacyorder',
+            name='pharmacyorder_status_idx',
+        ),
+        migrations.AddIndex(
+            model_name='pharmacyorder',
+            index=models.Index(fields=['pharmacist', 'status', '-created_at'], name='pharmacyorder_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0068_pharmacyorder_queue_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_type', models.CharField(choices=[('order_placed', 'Order Placed'), ('order_status_changed', 'Order Status Changed'), ('payment_failed', 'Payment Failed'), ('appointment_status_changed', 'Appointment Status Changed')], max_length=40)),
+                ('payload', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('dispatched_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, help_text='Why the event produced no notifications, if it failed')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['dispatched_at', 'id'], name='outboxevent_pending_idx')],
+            },
+        ),
+    ]
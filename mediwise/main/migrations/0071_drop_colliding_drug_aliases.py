@@ -0,0 +1,58 @@
+# Generated by Django 6.0.1 on 2026-10-18 14:00
+
+from django.db import migrations
+from django.db.models import F
+
+
+def normalize(name):
+    return ' '.join((name or '').lower().split())
+
+
+def drop_colliding_aliases(apps, schema_editor):
+    """Remove aliases that point to themselves or shadow another alias's canonical name, then re-match rows.
+
+    Curated synonyms (acetaminophen -> paracetamol) are kept even when a
+    pharmacy stocks the synonym as a generic name: mapping it is their point.
+    """
+    DrugAlias = apps.get_model('main', 'DrugAlias')
+    Medicine = apps.get_model('main', 'Medicine')
+    PrescriptionMedicine = apps.get_model('main', 'PrescriptionMedicine')
+
+    DrugAlias.objects.filter(alias=F('canonical_name')).delete()
+    canonical_names = DrugAlias.objects.values_list('canonical_name', flat=True)
+    DrugAlias.objects.filter(alias__in=list(canonical_names)).delete()
+
+    aliases = dict(DrugAlias.objects.values_list('alias', 'canonical_name'))
+
+    medicines = list(Medicine.objects.only('id', 'generic_name', 'normalized_name'))
+    changed = []
+    for medicine in medicines:
+        name = normalize(medicine.generic_name)
+        normalized_name = aliases.get(name, name)
+        if medicine.normalized_name != normalized_name:
+            medicine.normalized_name = normalized_name
+            changed.append(medicine)
+    Medicine.objects.bulk_update(changed, ['normalized_name'], batch_size=500)
+
+    prescription_medicines = list(PrescriptionMedicine.objects.only('id', 'drug_name_generic', 'drug_name_brand', 'normalized_name'))
+    changed = []
+    for prescription_medicine in prescription_medicines:
+        name = normalize(prescription_medicine.drug_name_generic or prescription_medicine.drug_name_brand)
+        normalized_name = aliases.get(name, name)
+        if prescription_medicine.normalized_name != normalized_name:
+            prescription_medicine.normalized_name = normalized_name
+            changed.append(prescription_medicine)
+    PrescriptionMedicine.objects.bulk_update(changed, ['normalized_name'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0070_notification_indexes_archive'),
+    ]
+
+    operations = [
+        # Irreversible by design: the deleted aliases were unusable, and
+        # rows re-matched without them are still valid after unapplying
+        migrations.RunPython(drop_colliding_aliases, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0.1 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0071_drop_colliding_drug_aliases'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='pharmacyorder',
+            index=models.Index(fields=['pharmacist', 'updated_at'], name='pharmacyorder_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0.1 on 2026-10-18 14:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0072_pharmacyorder_updated_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='pharmacyorder',
+            name='pharmacyorder_updated_idx',
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 6.0.1 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+def populate_normalized_brand(apps, schema_editor):
+    Medicine = apps.get_model('main', 'Medicine')
+    medicines = list(Medicine.objects.only('id', 'brand_name'))
+    for medicine in medicines:
+        medicine.normalized_brand = ' '.join((medicine.brand_name or '').lower().split())
+    Medicine.objects.bulk_update(medicines, ['normalized_brand'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0073_remove_pharmacyorder_updated_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='medicine',
+            name='normalized_brand',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='Normalized brand name, matched by prescription lines written by brand', max_length=200),
+        ),
+        migrations.RunPython(populate_normalized_brand, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0074_medicine_normalized_brand'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='inventorychange',
+            name='action',
+            field=models.CharField(choices=[('added', 'Added'), ('updated', 'Updated'), ('deleted', 'Deleted'), ('sold', 'Sold'), ('returned', 'Returned'), ('held', 'Held'), ('released', 'Released')], max_length=10),
+        ),
+    ]
@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 
 # Create your models here.
@@ -108,6 +110,77 @@ class Pharmacist(models.Model):
         return f"{self.first_name} {self.last_name}"
 
 
+def normalize_drug_name(name):
+    """Lower-case and collapse whitespace so names compare with plain equality"""
+    return ' '.join((name or '').lower().split())
+
+
+def canonical_drug_names(names):
+    """Map drug names to their canonical generic names with one DrugAlias lookup.
+
+    Returns a dict keyed by the normalized form of each name; names without an
+    alias map to themselves.
+    """
+    normalized = {normalize_drug_name(name) for name in names} - {''}
+    canonical = {name: name for name in normalized}
+    if normalized:
+        canonical.update(DrugAlias.objects.filter(alias__in=normalized).values_list('alias', 'canonical_name'))
+    return canonical
+
+
+def canonical_drug_name(name):
+    """Canonical generic name for a single drug, generic or brand"""
+    normalized = normalize_drug_name(name)
+    return canonical_drug_names([normalized]).get(normalized, '')
+
+
+class DrugAlias(models.Model):
+    """Synonym dictionary mapping drug synonyms and brand names to a canonical generic name.
+
+    Curated through the admin or data migrations only: saving an alias
+    re-points every matching row, so it is never created from free text.
+    """
+    alias = models.CharField(max_length=200, unique=True, help_text="Normalized synonym or brand name, e.g. acetaminophen, dolo")
+    canonical_name = models.CharField(max_length=200, db_index=True, help_text="Normalized canonical generic name, e.g. paracetamol")
+
+    class Meta:
+        verbose_name_plural = "Drug aliases"
+
+    def __str__(self):
+        return f"{self.alias} -> {self.canonical_name}"
+
+    def clean(self):
+        from django.core.exceptions import ValidationError
+        alias = normalize_drug_name(self.alias)
+        canonical_name = normalize_drug_name(self.canonical_name)
+        if alias == canonical_name:
+            raise ValidationError("An alias can't point to itself.")
+        # A canonical name re-pointed elsewhere would move every row already matched to it
+        if DrugAlias.objects.filter(canonical_name=alias).exclude(pk=self.pk).exists():
+            raise ValidationError({'alias': f"'{alias}' is already a canonical name."})
+        if DrugAlias.objects.filter(alias=canonical_name).exists():
+            raise ValidationError({'canonical_name': f"'{canonical_name}' is itself an alias; use its canonical name."})
+
+    def save(self, *args, **kwargs):
+        from django.db import transaction
+        from .inventory import record_inventory_changes
+
+        self.alias = normalize_drug_name(self.alias)
+        self.canonical_name = normalize_drug_name(self.canonical_name)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # Re-point rows that were normalized before this alias existed
+            medicines = Medicine.objects.filter(normalized_name=self.alias)
+            repointed = list(medicines.values_list('pharmacist_id', 'id'))
+            medicines.update(normalized_name=self.canonical_name)
+            PrescriptionMedicine.objects.filter(normalized_name=self.alias).update(normalized_name=self.canonical_name)
+            if repointed:
+                # Journaled so the availability and search indexes re-read them
+                record_inventory_changes(
+                    (pharmacist_id, medicine_id, 'updated', 0) for pharmacist_id, medicine_id in repointed
+                )
+
+
 class Medicine(models.Model):
     MEDICINE_TYPE_CHOICES = [
         ('OTC', 'Over-the-Counter'),
@@ -126,11 +199,72 @@ class Medicine(models.Model):
     quantity = models.PositiveIntegerField(default=0)
     price = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     medicine_type = models.CharField(max_length=3, choices=MEDICINE_TYPE_CHOICES, default='OTC')
+    normalized_name = models.CharField(max_length=200, db_index=True, blank=True, editable=False, help_text="Canonical generic name used for indexed matching")
+    normalized_brand = models.CharField(max_length=200, db_index=True, blank=True, editable=False, help_text="Normalized brand name, matched by prescription lines written by brand")
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return f"{self.brand_name} ({self.generic_name})"
 
+    def save(self, *args, **kwargs):
+        self.normalized_name = canonical_drug_name(self.generic_name)
+        self.normalized_brand = normalize_drug_name(self.brand_name)
+        super().save(*args, **kwargs)
+
+class InventoryVersion(models.Model):
+    """Monotonically increasing inventory version per pharmacist, advanced on every Medicine write"""
+    pharmacist = models.OneToOneField(Pharmacist, on_delete=models.CASCADE, related_name='inventory_version')
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.pharmacist.pharmacy_name} inventory v{self.version}"
+
+
+class InventoryChange(models.Model):
+    """Append-only journal of Medicine writes; the row id doubles as the global inventory version"""
+    ACTION_CHOICES = [
+        ('added', 'Added'),
+        ('updated', 'Updated'),
+        ('deleted', 'Deleted'),
+        ('sold', 'Sold'),
+        ('returned', 'Returned'),
+        ('held', 'Held'),
+        ('released', 'Released'),
+    ]
+
+    pharmacist = models.ForeignKey(Pharmacist, on_delete=models.CASCADE, related_name='inventory_changes')
+    medicine_id = models.PositiveBigIntegerField(help_text="ID of the affected medicine (kept after the medicine is deleted)")
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    quantity_delta = models.IntegerField(default=0, help_text="Change in stock caused by this write")
+    version = models.PositiveBigIntegerField(help_text="Pharmacist inventory version after this change")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        constraints = [
+            models.UniqueConstraint(fields=['pharmacist', 'version'], name='unique_inventory_change_version'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_action_display()} medicine #{self.medicine_id} (v{self.version})"
+
+class StockHold(models.Model):
+    """Units set aside for a patient between checkout and payment; ignored once expired"""
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='stock_holds')
+    medicine = models.ForeignKey(Medicine, on_delete=models.CASCADE, related_name='stock_holds')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['medicine', 'expires_at'], name='stockhold_medicine_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x medicine #{self.medicine_id} for {self.patient.first_name} until {self.expires_at}"
+
 class Cart(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='cart_items')
     medicine = models.ForeignKey(Medicine, on_delete=models.CASCADE)
@@ -140,6 +274,11 @@ class Cart(models.Model):
     added_from_prescription = models.BooleanField(default=False, help_text="Indicates if this medicine was added to cart from a prescription")
     added_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['patient', 'medicine'], name='unique_cart_patient_medicine'),
+        ]
+
     def __str__(self):
         return f"{self.patient.first_name}'s cart - {self.medicine.brand_name}"
         
@@ -174,9 +313,33 @@ class Order(models.Model):
     def __str__(self):
         return f"Order #{self.id} - {self.patient.first_name}"
 
+class PendingOrder(models.Model):
+    """Checkout snapshot awaiting payment, consumed once by its idempotency token"""
+    STATUS_CHOICES = (
+        ('open', 'Open'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    )
+    token = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='pending_orders')
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2)
+    gst_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    cart_items = models.JSONField(help_text="Cart lines at checkout: id, quantity, medicine_id, price")
+    hold_expires_at = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='open')
+    order = models.OneToOneField(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='pending_order')
+    failure_message = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Pending order {self.token} ({self.get_status_display()})"
+
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
     medicine = models.ForeignKey(Medicine, on_delete=models.SET_NULL, null=True, related_name='purchase_items')
+    pharmacist = models.ForeignKey(Pharmacist, on_delete=models.SET_NULL, null=True, blank=True, related_name='order_items', help_text="Pharmacy the item was sold by, kept if the medicine is later deleted")
     quantity = models.PositiveIntegerField()
     price_at_order = models.DecimalField(max_digits=10, decimal_places=2) # Store price in case it changes later
     # course_duration = models.CharField(max_length=50, blank=True, null=True, help_text="Expected duration of medicine course")  # Removed: course_duration is no longer used
@@ -188,11 +351,44 @@ class OrderItem(models.Model):
     def __str__(self):
         return f"{self.quantity}x {self.medicine.brand_name if self.medicine else 'Unknown Medicine'}"
 
+class PharmacyOrder(models.Model):
+    """One pharmacy's share of an order, routed when the order is placed"""
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='pharmacy_orders')
+    pharmacist = models.ForeignKey(Pharmacist, on_delete=models.CASCADE, related_name='pharmacy_orders')
+    status = models.CharField(max_length=20, choices=Order.ORDER_STATUS, default='pending')
+    item_count = models.PositiveIntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
+    gst_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
+    created_at = models.DateTimeField(help_text="Copied from the order so pharmacy queues sort without a join")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'pharmacist'], name='unique_pharmacy_order'),
+        ]
+        indexes = [
+            models.Index(fields=['pharmacist', 'status', '-created_at'], name='pharmacyorder_queue_idx'),
+            models.Index(fields=['pharmacist', '-created_at'], name='pharmacyorder_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Order #{self.order_id} at {self.pharmacist.pharmacy_name}"
+
 class Transaction(models.Model):
+    STATUS_CHOICES = (
+        ('processing', 'Processing'),
+        ('captured', 'Captured'),
+        ('failed', 'Failed'),
+    )
     order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='transaction')
     transaction_id = models.CharField(max_length=100, unique=True)
     payment_method = models.CharField(max_length=50, default='Card')
     amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=12, choices=STATUS_CHOICES, default='captured', help_text="Capture state reported by the payment backend")
+    gateway_reference = models.CharField(max_length=100, blank=True, help_text="Reference returned by the payment backend")
+    failure_reason = models.CharField(max_length=255, blank=True)
+    settled_at = models.DateTimeField(null=True, blank=True, help_text="When the capture was confirmed or failed")
     
     # Card details for payment portal
     card_name = models.CharField(max_length=100, blank=True, null=True)
@@ -401,10 +597,15 @@ class PrescriptionMedicine(models.Model):
     dosage_frequency = models.CharField(max_length=100, help_text="Dosage & Frequency (e.g., 1 tablet twice a day)")
     instructions = models.TextField(help_text="Instructions (The \"Sig\") Relation to food and specific timing")
     duration_days = models.IntegerField(null=True, blank=True, help_text="Duration of medicine course in days")
+    normalized_name = models.CharField(max_length=200, db_index=True, blank=True, editable=False, help_text="Canonical generic name used for indexed matching")
    
     def __str__(self):
         return f"{self.drug_name_generic} - Prescription #{self.prescription.id}"
 
+    def save(self, *args, **kwargs):
+        self.normalized_name = canonical_drug_name(self.drug_name_generic or self.drug_name_brand)
+        super().save(*args, **kwargs)
+
 
 class LabTest(models.Model):
     TEST_CATEGORIES = [
@@ -446,6 +647,18 @@ class Notification(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        indexes = [
+            # Unread, or read since a cutoff: main.notifications.visible_notifications and the unread counters
+            models.Index(fields=['patient', 'is_read', 'read_at'], name='notif_patient_read_idx'),
+            models.Index(fields=['pharmacist', 'is_read', 'read_at'], name='notif_pharm_read_idx'),
+            # Newest first per recipient
+            models.Index(fields=['patient', '-created_at'], name='notif_patient_created_idx'),
+            models.Index(fields=['pharmacist', '-created_at'], name='notif_pharm_created_idx'),
+            # Read long ago: archive_read_notifications
+            models.Index(fields=['is_read', 'read_at'], name='notif_archive_idx'),
+        ]
+    
     def __str__(self):
         if self.patient:
             return f"{self.title} - {self.patient.first_name} {self.patient.last_name}"
@@ -453,6 +666,43 @@ class Notification(models.Model):
             return f"{self.title} - Pharmacist"
         return self.title
 
+class NotificationArchive(models.Model):
+    """Notification read long ago, moved out of the live table by ``archive_read_notifications``"""
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='archived_notifications', null=True, blank=True)
+    pharmacist = models.ForeignKey(Pharmacist, on_delete=models.CASCADE, related_name='archived_notifications', null=True, blank=True)
+    notification_type = models.CharField(max_length=20, choices=Notification.NOTIFICATION_TYPES, default='general')
+    title = models.CharField(max_length=200)
+    message = models.TextField()
+    related_id = models.IntegerField(null=True, blank=True)
+    created_at = models.DateTimeField()
+    read_at = models.DateTimeField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.title} (archived)"
+
+class OutboxEvent(models.Model):
+    """Domain event saved with the change it describes, turned into notifications by ``main.outbox``"""
+    EVENT_TYPES = (
+        ('order_placed', 'Order Placed'),
+        ('order_status_changed', 'Order Status Changed'),
+        ('payment_failed', 'Payment Failed'),
+        ('appointment_status_changed', 'Appointment Status Changed'),
+    )
+    event_type = models.CharField(max_length=40, choices=EVENT_TYPES)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True, help_text="Why the event produced no notifications, if it failed")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['dispatched_at', 'id'], name='outboxevent_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_event_type_display()} #{self.id}"
+
 
 def lab_report_image_path(instance, filename):
     # File will be uploaded to MEDIA_ROOT/lab_reports/patient_<id>/<filename>
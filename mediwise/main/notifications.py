@@ -0,0 +1,171 @@
+"""Notification service.
+
+All notification writes go through this module so each recipient's unread
+counter stays current:
+
+* ``create_notifications`` inserts any number of notifications with one
+  ``bulk_create``;
+* ``mark_all_read`` marks a recipient's unread notifications read with one
+  set-based UPDATE;
+* both refresh the affected unread counters once the transaction commits,
+  with one grouped COUNT per recipient role.
+
+New notifications and refreshed counters are pushed to the recipient's
+open pages over their live event stream (``main.events``), whichever
+worker, thread or management command wrote them.
+
+``unread_count`` serves the counters from the cache, and
+``visible_notifications`` lists what a page shows (unread, or read within
+the last two days) in one query on the recipient's
+``(recipient, is_read, read_at)`` index.
+
+Notifications read more than ``NOTIFICATION_ARCHIVE_AFTER`` ago are moved
+to ``NotificationArchive`` by ``archive_read_notifications`` (run by the
+``archive_notifications`` management command), so the live table only
+holds what pages can still show.
+"""
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .events import publish_notifications, publish_unread_counts
+from .models import Notification, NotificationArchive
+
+UNREAD_COUNT_KEY = 'notifications:unread:%s:%s'
+# Every notification write refreshes the counter in the shared cache; the
+# timeout only drops those of inactive recipients
+UNREAD_COUNT_TIMEOUT = 60 * 60 * 24
+
+# Read notifications stay listed for this long
+READ_NOTIFICATION_WINDOW = timedelta(days=2)
+# Read notifications are archived after this long
+NOTIFICATION_ARCHIVE_AFTER = timedelta(days=30)
+NOTIFICATION_ARCHIVE_BATCH_SIZE = 1000
+
+
+def _recipient(patient_id=None, pharmacist_id=None):
+    if patient_id:
+        return 'patient', patient_id
+    if pharmacist_id:
+        return 'pharmacist', pharmacist_id
+    raise ValueError("A notification recipient needs a patient_id or pharmacist_id")
+
+
+def _load_unread_counts(role, ids):
+    counts = dict.fromkeys(ids, 0)
+    rows = Notification.objects.filter(
+        **{f'{role}_id__in': ids}, is_read=False
+    ).values_list(f'{role}_id').annotate(unread=Count('id')).order_by()
+    counts.update(rows)
+    return counts
+
+
+def refresh_unread_counts(patient_ids=(), pharmacist_ids=()):
+    """Recompute the unread counters of the given recipients once the transaction commits"""
+    recipients = {'patient': set(patient_ids), 'pharmacist': set(pharmacist_ids)}
+
+    def write():
+        for role, ids in recipients.items():
+            if ids:
+                counts = _load_unread_counts(role, ids)
+                cache.set_many(
+                    {UNREAD_COUNT_KEY % (role, pk): count for pk, count in counts.items()},
+                    timeout=UNREAD_COUNT_TIMEOUT,
+                )
+                publish_unread_counts(role, counts)
+    transaction.on_commit(write)
+
+
+def unread_count(patient_id=None, pharmacist_id=None):
+    """Number of unread notifications for a patient or pharmacist"""
+    role, pk = _recipient(patient_id, pharmacist_id)
+    key = UNREAD_COUNT_KEY % (role, pk)
+    count = cache.get(key)
+    if count is None:
+        count = _load_unread_counts(role, [pk])[pk]
+        cache.set(key, count, timeout=UNREAD_COUNT_TIMEOUT)
+    return count
+
+
+def create_notifications(notifications):
+    """Insert notifications in one statement and refresh their recipients' counters.
+
+    Args:
+        notifications: Unsaved ``Notification`` rows, each with a patient or pharmacist
+
+    Returns:
+        The created rows
+    """
+    notifications = Notification.objects.bulk_create(notifications)
+    publish_notifications(notifications)
+    refresh_unread_counts(
+        patient_ids={notification.patient_id for notification in notifications if notification.patient_id},
+        pharmacist_ids={notification.pharmacist_id for notification in notifications if notification.pharmacist_id},
+    )
+    return notifications
+
+
+def notify(**fields):
+    """Create a single notification (fields as for ``Notification``)"""
+    return create_notifications([Notification(**fields)])[0]
+
+
+def mark_all_read(patient_id=None, pharmacist_id=None):
+    """Mark every unread notification of a recipient read with one UPDATE.
+
+    Returns:
+        Number of notifications marked read
+    """
+    role, pk = _recipient(patient_id, pharmacist_id)
+    updated = Notification.objects.filter(**{f'{role}_id': pk}, is_read=False).update(
+        is_read=True, read_at=timezone.now()
+    )
+    if updated:
+        refresh_unread_counts(**{f'{role}_ids': [pk]})
+    return updated
+
+
+def visible_notifications(patient_id=None, pharmacist_id=None):
+    """A recipient's notifications that are unread or were read recently, newest first"""
+    role, pk = _recipient(patient_id, pharmacist_id)
+    return Notification.objects.filter(
+        Q(is_read=False) | Q(read_at__gte=timezone.now() - READ_NOTIFICATION_WINDOW),
+        **{f'{role}_id': pk},
+    ).order_by('-created_at')
+
+
+def archive_read_notifications(older_than=NOTIFICATION_ARCHIVE_AFTER, batch_size=NOTIFICATION_ARCHIVE_BATCH_SIZE):
+    """Move notifications read more than ``older_than`` ago into the archive.
+
+    Each batch is copied with one ``bulk_create`` and deleted with one
+    DELETE in the same transaction. Only read rows move, so unread
+    counters are unaffected.
+
+    Returns:
+        Number of notifications archived
+    """
+    cutoff = timezone.now() - older_than
+    archived = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                Notification.objects.filter(
+                    Q(read_at__lt=cutoff) | Q(read_at__isnull=True, created_at__lt=cutoff),
+                    is_read=True,
+                ).order_by('id').values(
+                    'id', 'patient_id', 'pharmacist_id', 'notification_type', 'title',
+                    'message', 'related_id', 'created_at', 'read_at',
+                )[:batch_size]
+            )
+            if not batch:
+                break
+            ids = [row.pop('id') for row in batch]
+            NotificationArchive.objects.bulk_create(NotificationArchive(**row) for row in batch)
+            Notification.objects.filter(id__in=ids).delete()
+        archived += len(batch)
+        if len(batch) < batch_size:
+            break
+    return archived
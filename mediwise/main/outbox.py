@@ -0,0 +1,226 @@
+"""Transactional outbox for notifications.
+
+Request code doesn't write notifications itself. ``record_event`` saves an
+``OutboxEvent`` describing what happened (an order placed, a status
+changed) in the same database transaction as the change, so an event
+exists exactly when its change committed. Once the transaction commits a
+background dispatcher is kicked; ``dispatch_events`` claims pending events
+in batches, builds their notifications and inserts them all with one
+``bulk_create``.
+
+Events left behind by a crash or a failed dispatch are picked up by the
+next kick or by the ``dispatch_outbox`` management command, which also
+purges dispatched events after ``OUTBOX_RETENTION``.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Notification, Order, OutboxEvent, Patient, Pharmacist
+from .notifications import create_notifications
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NOTIFICATION_OUTBOX = {
+    # Dispatch on a background thread (False dispatches inline after commit, e.g. for tests)
+    'ASYNC': True,
+    # Events claimed per dispatch transaction
+    'BATCH_SIZE': 500,
+}
+
+# Dispatched events are kept this long for inspection
+OUTBOX_RETENTION = timedelta(days=7)
+
+# Notification titles sent to patients when a pharmacy changes an order's status
+ORDER_STATUS_MESSAGES = {
+    'pending': 'Your order is being processed',
+    'preparing': 'Your order is being prepared',
+    'out_for_delivery': 'Your order is out for delivery',
+    'ready_for_pickup': 'Your order is ready for pickup at the store',
+    'completed': 'Your order has been completed',
+    'delayed': 'Your order has been delayed',
+    'failed': 'Your order could not be fulfilled'
+}
+
+
+def outbox_config():
+    return {**DEFAULT_NOTIFICATION_OUTBOX, **getattr(settings, 'NOTIFICATION_OUTBOX', {})}
+
+
+def record_event(event_type, payload):
+    """Save an event in the current transaction and dispatch it once that commits.
+
+    Args:
+        event_type: A key of ``OutboxEvent.EVENT_TYPES``
+        payload: JSON-serializable dict holding everything the notifications need
+    """
+    event = OutboxEvent.objects.create(event_type=event_type, payload=payload)
+    transaction.on_commit(kick_dispatcher)
+    return event
+
+
+def _order_placed(payload):
+    return [
+        Notification(
+            pharmacist_id=pharmacist_id,
+            notification_type='order_status',
+            title='New Order Received',
+            message=f"A new order #{payload['order_id']} has been placed for medicines from your pharmacy.",
+            related_id=payload['order_id']
+        )
+        for pharmacist_id in payload['pharmacist_ids']
+    ]
+
+
+def _order_status_changed(payload):
+    status = payload['status']
+    status_display = dict(Order.ORDER_STATUS)[status]
+    return [
+        Notification(
+            patient_id=patient_id,
+            notification_type='order_status',
+            title=ORDER_STATUS_MESSAGES.get(status, 'Order status updated'),
+            message=f'Your order #{order_id} status has been updated to {status_display}. Please check your order details for more information.',
+            related_id=order_id
+        )
+        for order_id, patient_id in payload['orders']
+    ]
+
+
+def _payment_failed(payload):
+    return [Notification(
+        patient_id=payload['patient_id'],
+        notification_type='order_status',
+        title='Payment Failed',
+        message=f"Payment for order #{payload['order_id']} could not be completed: {payload['reason']} The order has been cancelled.",
+        related_id=payload['order_id']
+    )]
+
+
+def _appointment_status_changed(payload):
+    return [Notification(
+        patient_id=payload['patient_id'],
+        notification_type='appointment',
+        title='Appointment Status Updated',
+        message=f"Your appointment with Dr. {payload['doctor_name']} has been updated from {payload['old_status']} to {payload['new_status']}.",
+        related_id=payload['appointment_id']
+    )]
+
+
+# Builds the unsaved notifications for an event's payload
+EVENT_HANDLERS = {
+    'order_placed': _order_placed,
+    'order_status_changed': _order_status_changed,
+    'payment_failed': _payment_failed,
+    'appointment_status_changed': _appointment_status_changed,
+}
+
+
+def _deliverable(notifications):
+    """Drop notifications for patients or pharmacists deleted since their event was recorded"""
+    patient_ids = set(Patient.objects.filter(
+        id__in={notification.patient_id for notification in notifications if notification.patient_id}
+    ).values_list('id', flat=True))
+    pharmacist_ids = set(Pharmacist.objects.filter(
+        id__in={notification.pharmacist_id for notification in notifications if notification.pharmacist_id}
+    ).values_list('id', flat=True))
+    return [
+        notification for notification in notifications
+        if notification.patient_id in patient_ids or notification.pharmacist_id in pharmacist_ids
+    ]
+
+
+def dispatch_events(batch_size=None):
+    """Turn pending events into notifications until none are left.
+
+    Each batch is claimed, converted and marked dispatched in one
+    transaction; concurrent dispatchers skip rows another has locked. An
+    event whose handler fails is marked dispatched with its ``error`` so it
+    can't block the rest of the outbox.
+
+    Returns:
+        Number of events dispatched
+    """
+    batch_size = batch_size or outbox_config()['BATCH_SIZE']
+    dispatched = 0
+    while True:
+        with transaction.atomic():
+            events = list(
+                OutboxEvent.objects.select_for_update(skip_locked=True)
+                .filter(dispatched_at__isnull=True).order_by('id')[:batch_size]
+            )
+            if not events:
+                break
+
+            notifications = []
+            errors = {}
+            for event in events:
+                try:
+                    notifications.extend(EVENT_HANDLERS[event.event_type](event.payload))
+                except Exception as e:
+                    logger.exception("Outbox event %s (%s) could not be dispatched", event.id, event.event_type)
+                    errors[event.id] = f"{e.__class__.__name__}: {e}"
+            create_notifications(_deliverable(notifications))
+
+            now = timezone.now()
+            OutboxEvent.objects.filter(
+                id__in=[event.id for event in events if event.id not in errors]
+            ).update(dispatched_at=now)
+            for event_id, error in errors.items():
+                OutboxEvent.objects.filter(id=event_id).update(dispatched_at=now, error=error)
+        dispatched += len(events)
+        if len(events) < batch_size:
+            break
+    return dispatched
+
+
+def purge_dispatched_events(older_than=OUTBOX_RETENTION):
+    """Delete events dispatched more than ``older_than`` ago; returns how many"""
+    deleted, _ = OutboxEvent.objects.filter(dispatched_at__lt=timezone.now() - older_than).delete()
+    return deleted
+
+
+_executor = None
+_kick_lock = threading.Lock()
+_kick_pending = False
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _kick_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox-dispatch')
+    return _executor
+
+
+def kick_dispatcher():
+    """Schedule a dispatch run; kicks arriving before it starts share that run"""
+    global _kick_pending
+    if not outbox_config()['ASYNC']:
+        dispatch_events()
+        return
+    with _kick_lock:
+        if _kick_pending:
+            return
+        _kick_pending = True
+    _get_executor().submit(_dispatch_in_worker)
+
+
+def _dispatch_in_worker():
+    global _kick_pending
+    # Clear the flag first so events committed during this run schedule another
+    with _kick_lock:
+        _kick_pending = False
+    try:
+        dispatch_events()
+    except Exception:
+        logger.exception("Outbox dispatch failed; pending events stay queued")
+    finally:
+        # Worker threads get their own DB connection; don't leak it
+        connection.close()
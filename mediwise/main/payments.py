@@ -0,0 +1,228 @@
+"""Payment backends and asynchronous capture.
+
+``process_payment`` records a ``Transaction`` in the ``processing`` state and
+hands the capture to ``start_capture``. Once the checkout transaction has
+committed the capture runs on a small worker pool, so the order is created
+and the patient redirected without waiting on the gateway. The outcome is
+applied by ``settle_payment``: a captured payment is confirmed; a declined
+or timed-out one fails the order and returns its stock.
+
+Captures run in the web process, so one lost to a restart or crash leaves
+its Transaction ``processing``. ``settle_stale_payments`` (run by the
+``settle_stale_payments`` management command) fails those as timed out once
+they are well past ``CAPTURE_TIMEOUT``.
+
+The backend is chosen by ``settings.PAYMENT_BACKEND``. The bundled
+``SimulatedPaymentBackend`` injects latency, declines and timeouts so
+checkout throughput can be load-tested without an external service.
+"""
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .inventory import return_stock
+from .models import Transaction
+from .outbox import record_event
+from .routing import set_order_status
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAYMENT_BACKEND = {
+    'BACKEND': 'main.payments.SimulatedPaymentBackend',
+    'OPTIONS': {},
+    # Seconds a capture may take before it is treated as failed
+    'CAPTURE_TIMEOUT': 10,
+    # Capture on the worker pool (False captures inline, e.g. for tests)
+    'ASYNC': True,
+    'WORKERS': 4,
+}
+
+# A capture still processing this long after its timeout has been lost
+STALE_CAPTURE_GRACE = timedelta(minutes=2)
+
+
+class PaymentResult:
+    """Outcome of a capture attempt"""
+    CAPTURED = 'captured'
+    DECLINED = 'declined'
+    TIMEOUT = 'timeout'
+
+    def __init__(self, status, reference='', message=''):
+        self.status = status
+        self.reference = reference
+        self.message = message
+
+    @property
+    def ok(self):
+        return self.status == self.CAPTURED
+
+
+class PaymentBackend:
+    """Interface for card payment gateways.
+
+    ``capture`` runs on a worker thread and may block, but must give up
+    after ``timeout`` seconds and return a ``PaymentResult``.
+    """
+
+    def capture(self, transaction_id, amount, card, timeout):
+        raise NotImplementedError
+
+
+class SimulatedPaymentBackend(PaymentBackend):
+    """Local stand-in for a card gateway.
+
+    Args:
+        latency: Mean capture time in seconds
+        jitter: Capture time varies uniformly by +/- this many seconds
+        failure_rate: Fraction of captures that are declined
+        timeout_rate: Fraction of captures that hang past the timeout
+        seed: Seed for reproducible runs
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, timeout_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def capture(self, transaction_id, amount, card, timeout):
+        with self._lock:
+            roll = self._random.random()
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+        if roll < self.timeout_rate or delay >= timeout:
+            time.sleep(timeout)
+            return PaymentResult(PaymentResult.TIMEOUT, message='Payment gateway timed out.')
+
+        time.sleep(delay)
+        if roll < self.timeout_rate + self.failure_rate:
+            return PaymentResult(PaymentResult.DECLINED, message='Card declined by issuer.')
+        return PaymentResult(PaymentResult.CAPTURED, reference=f"SIM-{uuid.uuid4().hex[:12].upper()}")
+
+
+_backend = None
+_executor = None
+_setup_lock = threading.Lock()
+
+
+def payment_config():
+    return {**DEFAULT_PAYMENT_BACKEND, **getattr(settings, 'PAYMENT_BACKEND', {})}
+
+
+def get_payment_backend():
+    """The configured backend instance (created once per process)"""
+    global _backend
+    if _backend is None:
+        with _setup_lock:
+            if _backend is None:
+                config = payment_config()
+                _backend = import_string(config['BACKEND'])(**config['OPTIONS'])
+    return _backend
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _setup_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=payment_config()['WORKERS'], thread_name_prefix='payment-capture')
+    return _executor
+
+
+def start_capture(payment, card):
+    """Capture a ``processing`` Transaction once the current DB transaction commits.
+
+    Args:
+        payment: The Transaction row
+        card: Dict with the cardholder ``name`` and full ``number``; kept in
+            memory for the capture only, never stored
+    """
+    config = payment_config()
+    job = partial(_capture, payment.pk, payment.transaction_id, payment.amount, card, config['CAPTURE_TIMEOUT'])
+    if config['ASYNC']:
+        transaction.on_commit(lambda: _get_executor().submit(_run_in_worker, job))
+    else:
+        transaction.on_commit(job)
+
+
+def _run_in_worker(job):
+    try:
+        job()
+    finally:
+        # Worker threads get their own DB connection; don't leak it
+        connection.close()
+
+
+def _capture(payment_pk, transaction_id, amount, card, timeout):
+    try:
+        result = get_payment_backend().capture(transaction_id, amount, card, timeout)
+    except Exception as e:
+        logger.exception("Payment capture for %s raised", transaction_id)
+        result = PaymentResult(PaymentResult.DECLINED, message=str(e) or 'Payment could not be processed.')
+    settle_payment(payment_pk, result)
+
+
+def settle_payment(payment_pk, result):
+    """Apply a capture outcome to its Transaction and Order (idempotent)"""
+    with transaction.atomic():
+        payment = Transaction.objects.select_for_update().select_related('order').get(pk=payment_pk)
+        if payment.status != 'processing':
+            return payment
+
+        payment.settled_at = timezone.now()
+        if result.ok:
+            payment.status = 'captured'
+            payment.gateway_reference = result.reference
+            payment.save(update_fields=['status', 'gateway_reference', 'settled_at'])
+            return payment
+
+        payment.status = 'failed'
+        payment.failure_reason = result.message[:255]
+        payment.save(update_fields=['status', 'failure_reason', 'settled_at'])
+
+        order = payment.order
+        set_order_status(order, 'failed')
+
+        quantities = {}
+        for medicine_id, quantity in order.items.exclude(medicine=None).values_list('medicine_id', 'quantity'):
+            quantities[medicine_id] = quantities.get(medicine_id, 0) + quantity
+        return_stock(quantities)
+
+        record_event('payment_failed', {
+            'order_id': order.id,
+            'patient_id': order.patient_id,
+            'reason': payment.failure_reason,
+        })
+    return payment
+
+
+def settle_stale_payments(grace=STALE_CAPTURE_GRACE):
+    """Fail Transactions whose capture was lost (worker restarted or crashed).
+
+    The card details are never stored, so a lost capture can't be retried;
+    it is settled as a timeout, which fails the order and returns its stock.
+
+    Returns:
+        Number of Transactions settled
+    """
+    cutoff = timezone.now() - timedelta(seconds=payment_config()['CAPTURE_TIMEOUT']) - grace
+    settled = 0
+    for payment_pk in Transaction.objects.filter(status='processing', timestamp__lt=cutoff).values_list('pk', flat=True):
+        payment = settle_payment(payment_pk, PaymentResult(
+            PaymentResult.TIMEOUT, message='Payment could not be confirmed by the gateway.'
+        ))
+        if payment.status == 'failed':
+            settled += 1
+    return settled
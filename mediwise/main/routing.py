@@ -0,0 +1,229 @@
+"""Per-pharmacy order routing.
+
+An order is split when it is placed: every ``OrderItem`` records the
+pharmacy that sold it and each pharmacy gets a ``PharmacyOrder`` with its
+own item count, totals and status. Pharmacy-side lists, counts and
+earnings read that one indexed table instead of joining
+Order -> OrderItem -> Medicine -> Pharmacist with ``DISTINCT``, and a cart
+spanning several pharmacies gives each of them only its own share.
+
+Pharmacies move their share through the fulfilment states with
+``set_order_status``, which rolls the shares up into ``Order.status``.
+Both paths push the change to the pharmacies' live order streams.
+
+``order_queue`` pages through a pharmacy's shares newest first with a
+keyset cursor on ``(created_at, id)``, and ``queue_stats`` counts them by
+status in one conditional aggregate, so the orders page costs the same
+however long the pharmacy's history grows.
+"""
+import base64
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .cart import GST_RATE
+from .events import publish_new_orders, publish_status_changes
+from .models import Order, OrderItem, PharmacyOrder
+
+# Fulfilment stages in order; a split order is only as far along as its slowest share
+STATUS_PROGRESS = {
+    'pending': 0,
+    'preparing': 1,
+    'out_for_delivery': 2,
+    'ready_for_pickup': 2,
+    'completed': 3,
+}
+
+ORDER_QUEUE_PAGE_SIZE = 25
+MAX_ORDER_QUEUE_PAGE_SIZE = 100
+
+
+def route_order(order, items):
+    """Save a new order's items and split the order by pharmacy.
+
+    Args:
+        order: The saved Order
+        items: Unsaved OrderItem rows with ``medicine`` set
+
+    Returns:
+        The created PharmacyOrder rows
+    """
+    shares = {}
+    for item in items:
+        item.order = order
+        item.pharmacist_id = item.medicine.pharmacist_id if item.medicine else None
+        if item.pharmacist_id is None:
+            continue
+        share = shares.get(item.pharmacist_id)
+        if share is None:
+            share = shares[item.pharmacist_id] = PharmacyOrder(
+                order=order,
+                pharmacist_id=item.pharmacist_id,
+                status=order.status,
+                created_at=order.created_at,
+                subtotal=0,
+            )
+        share.item_count += 1
+        share.subtotal += item.get_subtotal()
+
+    for share in shares.values():
+        share.gst_amount = round(share.subtotal * GST_RATE, 2)
+        share.total_amount = share.subtotal + share.gst_amount
+
+    OrderItem.objects.bulk_create(items)
+    pharmacy_orders = PharmacyOrder.objects.bulk_create(shares.values())
+    publish_new_orders(pharmacy_orders)
+    return pharmacy_orders
+
+
+def rollup_status(statuses):
+    """Order status implied by the statuses of its pharmacy shares"""
+    statuses = set(statuses)
+    if len(statuses) == 1:
+        return statuses.pop()
+    # Shares a pharmacy could not fill don't hold the rest of the order back
+    live = statuses - {'failed'}
+    if 'delayed' in live:
+        return 'delayed'
+    return min(live, key=lambda status: STATUS_PROGRESS.get(status, 0))
+
+
+def set_order_status(order, status, pharmacist=None):
+    """Move one pharmacy's share of an order, or the whole order, to ``status``.
+
+    Args:
+        order: The Order
+        status: A key of ``Order.ORDER_STATUS``
+        pharmacist: Pharmacy whose share changes (default: every share)
+
+    Returns:
+        The order's rolled-up status, also saved on ``order``
+    """
+    with transaction.atomic():
+        # Serialize pharmacies updating shares of the same order
+        Order.objects.select_for_update().filter(pk=order.pk).exists()
+        shares = PharmacyOrder.objects.filter(order=order)
+        if pharmacist is not None:
+            shares = shares.filter(pharmacist=pharmacist)
+        shares.update(status=status, updated_at=timezone.now())
+        publish_status_changes(shares)
+
+        statuses = list(PharmacyOrder.objects.filter(order=order).values_list('status', flat=True))
+        rolled_up = rollup_status(statuses) if statuses else status
+        if order.status != rolled_up:
+            order.status = rolled_up
+            order.save(update_fields=['status', 'updated_at'])
+    return order.status
+
+
+def set_orders_status(pharmacist, order_ids, status):
+    """Move a pharmacy's shares of several orders to ``status`` in one UPDATE.
+
+    Ownership is checked for the whole batch with one query; nothing is
+    changed unless every order has a share routed to ``pharmacist``.
+
+    Args:
+        pharmacist: Pharmacy whose shares change
+        order_ids: Ids of the orders
+        status: A key of ``Order.ORDER_STATUS``
+
+    Returns:
+        ``(pharmacy_orders, previous, not_owned)``: the updated shares with
+        ``order`` and its patient loaded, their statuses before the change
+        keyed by order id, and the ids that were not this pharmacy's (in
+        which case nothing was updated)
+    """
+    order_ids = set(order_ids)
+    with transaction.atomic():
+        # Lock the orders in id order, as set_order_status does, before touching their shares
+        list(Order.objects.select_for_update().filter(id__in=order_ids).order_by('id').values_list('id', flat=True))
+        pharmacy_orders = list(
+            PharmacyOrder.objects.filter(pharmacist=pharmacist, order_id__in=order_ids).select_related('order__patient')
+        )
+        not_owned = order_ids - {pharmacy_order.order_id for pharmacy_order in pharmacy_orders}
+        if not_owned or not pharmacy_orders:
+            return [], {}, sorted(not_owned)
+
+        previous = {pharmacy_order.order_id: pharmacy_order.status for pharmacy_order in pharmacy_orders}
+        now = timezone.now()
+        PharmacyOrder.objects.filter(id__in=[pharmacy_order.id for pharmacy_order in pharmacy_orders]).update(
+            status=status, updated_at=now
+        )
+        for pharmacy_order in pharmacy_orders:
+            pharmacy_order.status = status
+
+        # Roll every touched order up from all of its shares, one UPDATE per resulting status
+        statuses = {}
+        for order_id, share_status in PharmacyOrder.objects.filter(order_id__in=order_ids).values_list('order_id', 'status'):
+            statuses.setdefault(order_id, []).append(share_status)
+        changes = {}
+        for pharmacy_order in pharmacy_orders:
+            rolled_up = rollup_status(statuses[pharmacy_order.order_id])
+            if pharmacy_order.order.status != rolled_up:
+                pharmacy_order.order.status = rolled_up
+                changes.setdefault(rolled_up, []).append(pharmacy_order.order_id)
+        for rolled_up, ids in changes.items():
+            Order.objects.filter(id__in=ids).update(status=rolled_up, updated_at=now)
+
+        publish_status_changes(pharmacy_orders)
+    return pharmacy_orders, previous, []
+
+
+def encode_queue_cursor(pharmacy_order):
+    """Opaque cursor pointing just past ``pharmacy_order`` in queue order"""
+    position = f"{pharmacy_order.created_at.isoformat()}|{pharmacy_order.id}"
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_queue_cursor(cursor):
+    """``(created_at, id)`` from a cursor; raises ValueError if it is malformed"""
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (TypeError, UnicodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def order_queue(pharmacist, status=None, cursor=None, limit=ORDER_QUEUE_PAGE_SIZE):
+    """One page of a pharmacy's orders, newest first.
+
+    Args:
+        pharmacist: Pharmacy whose shares are listed
+        status: Only list shares in this status (default: all)
+        cursor: ``next_cursor`` of the previous page (default: first page)
+        limit: Page size, capped at ``MAX_ORDER_QUEUE_PAGE_SIZE``
+
+    Returns:
+        ``(pharmacy_orders, next_cursor)``; ``next_cursor`` is None on the last page
+
+    Raises:
+        ValueError: If ``cursor`` is malformed
+    """
+    limit = max(1, min(limit, MAX_ORDER_QUEUE_PAGE_SIZE))
+    pharmacy_orders = PharmacyOrder.objects.filter(pharmacist=pharmacist)
+    if status:
+        pharmacy_orders = pharmacy_orders.filter(status=status)
+    if cursor:
+        created_at, pk = decode_queue_cursor(cursor)
+        pharmacy_orders = pharmacy_orders.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+        )
+
+    page = list(
+        pharmacy_orders.select_related('order__patient').order_by('-created_at', '-id')[:limit + 1]
+    )
+    next_cursor = encode_queue_cursor(page[limit - 1]) if len(page) > limit else None
+    return page[:limit], next_cursor
+
+
+def queue_stats(pharmacist):
+    """Order counts by status for a pharmacy in a single query"""
+    return PharmacyOrder.objects.filter(pharmacist=pharmacist).aggregate(
+        total_orders=Count('id'),
+        pending_orders=Count('id', filter=Q(status='pending')),
+        successful_orders=Count('id', filter=Q(status='completed')),
+        failed_orders=Count('id', filter=Q(status='failed')),
+        delayed_orders=Count('id', filter=Q(status='delayed')),
+    )
@@ -0,0 +1,263 @@
+"""Medicine search across all pharmacies.
+
+A single ranked query over ``Medicine`` replaces the per-pharmacy scans the
+pharmacy finder used to run. On PostgreSQL the ``icontains`` predicates are
+served by the pg_trgm GIN indexes created in migration 0060; on SQLite the
+name match goes through the ``main_medicine_fts`` FTS5 table (trigram
+tokenizer), which is kept in sync with ``main_medicine`` by triggers.
+
+``typeahead_index`` serves keystroke-rate name completion from memory.
+"""
+import bisect
+import heapq
+import threading
+import time
+
+from django.db import connection
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .models import Medicine
+
+FTS_TABLE = 'main_medicine_fts'
+
+# The trigram tokenizer (and pg_trgm) cannot use the index for terms
+# shorter than three characters, so those fall back to a plain scan.
+MIN_INDEXED_TERM_LENGTH = 3
+
+# Rank buckets: lower is better
+RANK_EXACT = 0
+RANK_PREFIX = 1
+RANK_SUBSTRING = 2
+
+_fts_available = None
+
+
+def fts_available():
+    """Return True if the SQLite FTS5 shadow table exists on this database"""
+    global _fts_available
+    if _fts_available is None:
+        _fts_available = (
+            connection.vendor == 'sqlite'
+            and FTS_TABLE in connection.introspection.table_names()
+        )
+    return _fts_available
+
+
+def name_match(term):
+    """Build a Q object matching ``term`` against generic or brand name"""
+    if len(term) >= MIN_INDEXED_TERM_LENGTH and fts_available():
+        # Quote the term so FTS5 treats it as a literal substring
+        phrase = '"%s"' % term.replace('"', '""')
+        return Q(id__in=RawSQL(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s',
+            (phrase,),
+        ))
+    return Q(generic_name__icontains=term) | Q(brand_name__icontains=term)
+
+
+def match_rank(term):
+    """Expression ranking exact name matches above prefix and substring hits"""
+    return Case(
+        When(Q(generic_name__iexact=term) | Q(brand_name__iexact=term), then=Value(RANK_EXACT)),
+        When(Q(generic_name__istartswith=term) | Q(brand_name__istartswith=term), then=Value(RANK_PREFIX)),
+        default=Value(RANK_SUBSTRING),
+        output_field=IntegerField(),
+    )
+
+
+def search_medicines(term='', formulation=''):
+    """Return non-expired medicines matching the search, best matches first.
+
+    Args:
+        term: Free-text medicine name (generic or brand)
+        formulation: Optional formulation to filter on (case-insensitive)
+    """
+    term = (term or '').strip()
+    medicines = Medicine.objects.filter(
+        expiry_date__gt=timezone.now().date()
+    ).select_related('pharmacist')
+
+    if formulation:
+        medicines = medicines.filter(formulation__iexact=formulation)
+
+    if term:
+        medicines = medicines.filter(name_match(term)).annotate(
+            match_rank=match_rank(term)
+        ).order_by('match_rank', 'generic_name', 'brand_name')
+    else:
+        medicines = medicines.order_by('generic_name', 'brand_name')
+
+    return medicines
+
+
+def search_pharmacies(term='', formulation=''):
+    """Group matching medicines by pharmacy in a single query.
+
+    Returns a list of dicts with ``pharmacist``, ``medicines`` and
+    ``medicine_count`` keys, pharmacies holding the best-ranked match first.
+    """
+    grouped = {}
+    for medicine in search_medicines(term, formulation):
+        entry = grouped.get(medicine.pharmacist_id)
+        if entry is None:
+            entry = grouped[medicine.pharmacist_id] = {
+                'pharmacist': medicine.pharmacist,
+                'medicines': [],
+                'medicine_count': 0,
+            }
+        entry['medicines'].append(medicine)
+        entry['medicine_count'] += 1
+
+    # Dict insertion order follows the ranked query, so each pharmacy is
+    # positioned by its best match.
+    return list(grouped.values())
+
+
+class TypeaheadIndex:
+    """Process-local prefix index of medicine names for typeahead lookups.
+
+    Generic and brand names (and every word suffix inside them, so
+    "clav" finds "amoxicillin clavulanate") are kept in a sorted list and
+    searched with ``bisect``. The index is loaded once and then patched
+    from the inventory change journal (followed with an
+    ``InventoryWatermark``), so keystroke traffic is served from memory;
+    the database is only touched when the inventory moves.
+    """
+
+    # How often (seconds) a lookup may check the inventory version
+    REFRESH_INTERVAL = 2
+    # Past this many pending journal entries a full reload is cheaper
+    MAX_INCREMENTAL_CHANGES = 500
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._watermark = None
+        self._checked_at = 0.0
+        self._rows = {}      # medicine id -> (pharmacist id, quantity, expiry date, names)
+        self._names = {}     # lowered name -> {'display': str, 'medicine_ids': set}
+        self._keys = []      # sorted (search key, lowered name) pairs
+
+    @staticmethod
+    def _row(medicine):
+        names = {}
+        for name in (medicine.generic_name, medicine.brand_name):
+            name = ' '.join((name or '').split())
+            if name:
+                names.setdefault(name.lower(), name)
+        return (medicine.pharmacist_id, medicine.quantity, medicine.expiry_date, names)
+
+    @staticmethod
+    def _search_keys(name):
+        starts = [0] + [i + 1 for i, char in enumerate(name) if char == ' ']
+        return [name[start:] for start in starts]
+
+    def _add(self, medicine_id, row):
+        self._rows[medicine_id] = row
+        for name, display in row[3].items():
+            entry = self._names.get(name)
+            if entry is None:
+                entry = self._names[name] = {'display': display, 'medicine_ids': set()}
+                for key in self._search_keys(name):
+                    bisect.insort(self._keys, (key, name))
+            entry['medicine_ids'].add(medicine_id)
+
+    def _remove(self, medicine_id):
+        row = self._rows.pop(medicine_id, None)
+        if row is None:
+            return
+        for name in row[3]:
+            entry = self._names[name]
+            entry['medicine_ids'].discard(medicine_id)
+            if not entry['medicine_ids']:
+                del self._names[name]
+                for key in self._search_keys(name):
+                    index = bisect.bisect_left(self._keys, (key, name))
+                    if index < len(self._keys) and self._keys[index] == (key, name):
+                        del self._keys[index]
+
+    def _load(self):
+        from .inventory import InventoryWatermark
+
+        # Taken first: writes committed during the load are applied again, harmlessly
+        watermark = InventoryWatermark()
+        watermark.reset()
+        self._rows, self._names, self._keys = {}, {}, []
+        medicines = Medicine.objects.only(
+            'id', 'pharmacist_id', 'generic_name', 'brand_name', 'quantity', 'expiry_date'
+        )
+        for medicine in medicines.iterator():
+            row = self._row(medicine)
+            self._rows[medicine.id] = row
+            for name, display in row[3].items():
+                self._names.setdefault(name, {'display': display, 'medicine_ids': set()})['medicine_ids'].add(medicine.id)
+        self._keys = sorted(
+            (key, name) for name in self._names for key in self._search_keys(name)
+        )
+        self._watermark = watermark
+        self._loaded = True
+
+    def _catch_up(self):
+        changed = self._watermark.changed_medicines(self.MAX_INCREMENTAL_CHANGES)
+        if changed is None:
+            self._load()
+            return
+        if not changed:
+            return
+        medicines = Medicine.objects.filter(id__in=changed).only(
+            'id', 'pharmacist_id', 'generic_name', 'brand_name', 'quantity', 'expiry_date'
+        )
+        for medicine_id in changed:
+            self._remove(medicine_id)
+        for medicine in medicines:
+            self._add(medicine.id, self._row(medicine))
+
+    def refresh(self, force=False):
+        """Bring the index up to date with the inventory journal if it is due"""
+        now = time.monotonic()
+        if not force and self._loaded and now - self._checked_at < self.REFRESH_INTERVAL:
+            return
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            else:
+                self._catch_up()
+            self._checked_at = now
+
+    def lookup(self, prefix, limit=10):
+        """Top ``limit`` names starting with ``prefix``, most widely stocked first.
+
+        Returns a list of dicts with ``name`` and ``in_stock_pharmacies``.
+        """
+        prefix = ' '.join((prefix or '').lower().split())
+        if not prefix:
+            return []
+        self.refresh()
+
+        today = timezone.now().date()
+        with self._lock:
+            names = set()
+            index = bisect.bisect_left(self._keys, (prefix, ''))
+            while index < len(self._keys) and self._keys[index][0].startswith(prefix):
+                names.add(self._keys[index][1])
+                index += 1
+
+            matches = []
+            for name in names:
+                entry = self._names[name]
+                pharmacies = set()
+                for medicine_id in entry['medicine_ids']:
+                    pharmacist_id, quantity, expiry_date, _ = self._rows[medicine_id]
+                    if quantity > 0 and expiry_date > today:
+                        pharmacies.add(pharmacist_id)
+                matches.append((name != prefix, -len(pharmacies), name, entry['display'], len(pharmacies)))
+
+        return [
+            {'name': display, 'in_stock_pharmacies': count}
+            for _, _, _, display, count in heapq.nsmallest(limit, matches)
+        ]
+
+
+typeahead_index = TypeaheadIndex()
@@ -1,3 +1,324 @@
-from django.test import TestCase
+import json
+from datetime import date, timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from main import payments
+from main.holds import place_holds, release_expired_holds, release_holds, with_available_stock
+from main.inventory import InsufficientStock
+from main.models import (
+    Cart, Medicine, Notification, Order, OutboxEvent, Patient, PendingOrder, Pharmacist,
+    PharmacyOrder, StockHold, Transaction, Users
+)
+from main.outbox import dispatch_events, record_event
+from main.payments import SimulatedPaymentBackend
+from main.views import HOLD_LAPSED_MESSAGE
+
+CARD = {'card_name': 'Test Patient', 'card_number': '4111111111111111', 'card_cvv': '123'}
+
+
+def make_pharmacist(number):
+    return Pharmacist.objects.create(
+        user=Users.objects.create(role='pharmacist'),
+        pharmacy_name=f'Pharmacy {number}',
+        first_name='Test',
+        last_name=f'Pharmacist {number}',
+        password='x',
+        license_number=f'LIC-{number}',
+        phone_number='9000000000',
+        email=f'pharmacist{number}@example.com',
+        address='1 Main Road'
+    )
+
+
+def make_patient(number=1):
+    return Patient.objects.create(
+        user=Users.objects.create(role='patient'),
+        first_name='Test',
+        last_name=f'Patient {number}',
+        password='x',
+        email=f'patient{number}@example.com'
+    )
+
+
+def make_medicine(pharmacist, quantity=10):
+    return Medicine.objects.create(
+        pharmacist=pharmacist,
+        brand_name='Dolo 650',
+        generic_name='Paracetamol',
+        strength='650mg',
+        formulation='Tablet',
+        indications='Fever',
+        batch_number='B1',
+        manufacture_date=date.today(),
+        expiry_date=date.today() + timedelta(days=365),
+        quantity=quantity,
+        price=10
+    )
+
+
+@override_settings(PAYMENT_BACKEND={'ASYNC': False}, NOTIFICATION_OUTBOX={'ASYNC': False})
+class ProcessPaymentTests(TestCase):
+    def setUp(self):
+        # Captures succeed instantly instead of with the configured simulated latency
+        self.backend = payments._backend
+        payments._backend = SimulatedPaymentBackend()
+        self.addCleanup(setattr, payments, '_backend', self.backend)
+
+        self.medicine = make_medicine(make_pharmacist(1), quantity=5)
+        self.patient = make_patient()
+        Cart.objects.create(patient=self.patient, medicine=self.medicine, quantity=2)
+        session = self.client.session
+        session['patient_id'] = self.patient.id
+        session.save()
+
+        self.client.get(reverse('checkout'))
+        self.pending_order = PendingOrder.objects.get(patient=self.patient, status='open')
+
+    def pay(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('process_payment'), {**CARD, 'idempotency_token': str(self.pending_order.token)})
+
+    def test_checkout_holds_stock(self):
+        self.assertEqual(
+            list(StockHold.objects.filter(patient=self.patient).values_list('medicine_id', 'quantity')),
+            [(self.medicine.id, 2)]
+        )
+
+    def test_payment_places_order(self):
+        response = self.pay()
+
+        order = Order.objects.get(patient=self.patient)
+        self.assertRedirects(response, reverse('view_order_receipt', args=[order.id]), fetch_redirect_response=False)
+        self.medicine.refresh_from_db()
+        self.assertEqual(self.medicine.quantity, 3)
+        self.assertFalse(Cart.objects.filter(patient=self.patient).exists())
+        self.assertFalse(StockHold.objects.exists())
+        self.assertEqual(Transaction.objects.get(order=order).status, 'captured')
+
+    def test_insufficient_stock_rolls_back(self):
+        # Stock sold elsewhere (e.g. at the counter) after the holds were placed
+        Medicine.objects.filter(id=self.medicine.id).update(quantity=1)
+
+        response = self.pay()
+
+        self.assertRedirects(response, reverse('view_cart'), fetch_redirect_response=False)
+        self.medicine.refresh_from_db()
+        self.assertEqual(self.medicine.quantity, 1)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(Transaction.objects.exists())
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertTrue(Cart.objects.filter(patient=self.patient).exists())
+        self.assertFalse(StockHold.objects.exists())
+        self.pending_order.refresh_from_db()
+        self.assertEqual(self.pending_order.status, 'failed')
+        self.assertIn('Not enough stock', self.pending_order.failure_message)
+
+    def test_replayed_token_returns_same_receipt(self):
+        first = self.pay()
+        second = self.pay()
+
+        order = Order.objects.get(patient=self.patient)
+        receipt = reverse('view_order_receipt', args=[order.id])
+        self.assertRedirects(first, receipt, fetch_redirect_response=False)
+        self.assertRedirects(second, receipt, fetch_redirect_response=False)
+        self.medicine.refresh_from_db()
+        self.assertEqual(self.medicine.quantity, 3)
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(OutboxEvent.objects.filter(event_type='order_placed').count(), 1)
+
+    def test_replayed_failure_stays_failed(self):
+        Medicine.objects.filter(id=self.medicine.id).update(quantity=1)
+        self.pay()
+        Medicine.objects.filter(id=self.medicine.id).update(quantity=5)
+
+        response = self.pay()
+
+        self.assertRedirects(response, reverse('view_cart'), fetch_redirect_response=False)
+        self.assertFalse(Order.objects.exists())
+        self.medicine.refresh_from_db()
+        self.assertEqual(self.medicine.quantity, 5)
+
+    def test_payment_after_hold_lapsed_is_refused(self):
+        lapsed = timezone.now() - timedelta(seconds=1)
+        PendingOrder.objects.filter(pk=self.pending_order.pk).update(hold_expires_at=lapsed)
+        StockHold.objects.update(expires_at=lapsed)
+
+        response = self.pay()
+
+        self.assertRedirects(response, reverse('view_cart'), fetch_redirect_response=False)
+        self.assertFalse(Order.objects.exists())
+        self.medicine.refresh_from_db()
+        self.assertEqual(self.medicine.quantity, 5)
+        self.pending_order.refresh_from_db()
+        self.assertEqual(self.pending_order.status, 'failed')
+        self.assertEqual(self.pending_order.failure_message, HOLD_LAPSED_MESSAGE)
+
+
+class StockHoldTests(TestCase):
+    def setUp(self):
+        self.medicine = make_medicine(make_pharmacist(1), quantity=6)
+        self.patient = make_patient(1)
+        self.other_patient = make_patient(2)
+
+    def available(self, exclude_patient=None):
+        return with_available_stock(Medicine.objects.filter(id=self.medicine.id), exclude_patient).get().available_quantity
+
+    def test_hold_counts_against_other_buyers(self):
+        place_holds(self.patient, {self.medicine.id: 5})
+
+        self.assertEqual(self.available(), 1)
+        self.assertEqual(self.available(exclude_patient=self.patient), 6)
+        with self.assertRaises(InsufficientStock):
+            place_holds(self.other_patient, {self.medicine.id: 2})
+        self.assertFalse(StockHold.objects.filter(patient=self.other_patient).exists())
+
+    def test_placing_holds_replaces_previous_ones(self):
+        place_holds(self.patient, {self.medicine.id: 5})
+        place_holds(self.patient, {self.medicine.id: 2})
+
+        self.assertEqual(self.available(), 4)
+
+    def test_release_holds(self):
+        place_holds(self.patient, {self.medicine.id: 5})
+
+        self.assertEqual(release_holds(self.patient), 1)
+        self.assertEqual(self.available(), 6)
+
+    def test_expired_holds_are_ignored_and_released(self):
+        place_holds(self.patient, {self.medicine.id: 5})
+        place_holds(self.other_patient, {self.medicine.id: 1})
+        StockHold.objects.filter(patient=self.patient).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(self.available(), 5)
+        place_holds(make_patient(3), {self.medicine.id: 5})
+        self.assertEqual(release_expired_holds(), 1)
+        self.assertFalse(StockHold.objects.filter(patient=self.patient).exists())
+        self.assertEqual(StockHold.objects.count(), 2)
+
+
+@override_settings(NOTIFICATION_OUTBOX={'ASYNC': False})
+class BulkUpdateOrderStatusTests(TestCase):
+    def setUp(self):
+        self.pharmacist = make_pharmacist(1)
+        self.other_pharmacist = make_pharmacist(2)
+        self.patient = make_patient()
+        self.own_order = self.make_order(self.pharmacist)
+        self.shared_order = self.make_order(self.pharmacist, self.other_pharmacist)
+        self.other_order = self.make_order(self.other_pharmacist)
+
+        session = self.client.session
+        session['pharmacist_id'] = self.pharmacist.id
+        session.save()
+
+    def make_order(self, *pharmacists):
+        order = Order.objects.create(patient=self.patient, total_amount=10, status='pending')
+        for pharmacist in pharmacists:
+            PharmacyOrder.objects.create(order=order, pharmacist=pharmacist, created_at=order.created_at, total_amount=10)
+        return order
+
+    def post(self, order_ids, status):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                reverse('bulk_update_order_status'),
+                json.dumps({'order_ids': order_ids, 'status': status}),
+                content_type='application/json'
+            )
+
+    def share_status(self, order, pharmacist):
+        return PharmacyOrder.objects.get(order=order, pharmacist=pharmacist).status
+
+    def test_updates_own_shares_only(self):
+        response = self.post([self.own_order.id, self.shared_order.id], 'preparing')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(self.share_status(self.own_order, self.pharmacist), 'preparing')
+        self.assertEqual(self.share_status(self.shared_order, self.pharmacist), 'preparing')
+        self.assertEqual(self.share_status(self.shared_order, self.other_pharmacist), 'pending')
+        self.assertEqual(Notification.objects.filter(patient=self.patient).count(), 2)
+
+    def test_rejects_batch_with_other_pharmacys_order(self):
+        response = self.post([self.own_order.id, self.other_order.id], 'completed')
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()['order_ids'], [self.other_order.id])
+        self.assertEqual(self.share_status(self.own_order, self.pharmacist), 'pending')
+        self.assertEqual(self.share_status(self.other_order, self.other_pharmacist), 'pending')
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_rejects_unknown_order(self):
+        response = self.post([self.own_order.id, self.other_order.id + 1000], 'completed')
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.share_status(self.own_order, self.pharmacist), 'pending')
+
+    def test_requires_pharmacist(self):
+        self.client.session.flush()
+        self.client.cookies.clear()
+
+        response = self.post([self.own_order.id], 'completed')
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.share_status(self.own_order, self.pharmacist), 'pending')
+
+
+@override_settings(NOTIFICATION_OUTBOX={'ASYNC': False})
+class OutboxTests(TestCase):
+    def setUp(self):
+        self.pharmacist = make_pharmacist(1)
+        self.patient = make_patient()
+
+    def record_order_placed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return record_event('order_placed', {'order_id': 1, 'pharmacist_ids': [self.pharmacist.id]})
+
+    def test_event_is_dispatched_after_commit(self):
+        event = self.record_order_placed()
+
+        event.refresh_from_db()
+        self.assertIsNotNone(event.dispatched_at)
+        self.assertEqual(event.error, '')
+        self.assertEqual(Notification.objects.get(pharmacist=self.pharmacist).title, 'New Order Received')
+
+    def test_failed_dispatch_is_retried(self):
+        with mock.patch('main.outbox.create_notifications', side_effect=DatabaseError('connection lost')):
+            with self.assertRaises(DatabaseError):
+                self.record_order_placed()
+
+        event = OutboxEvent.objects.get()
+        self.assertIsNone(event.dispatched_at)
+        self.assertFalse(Notification.objects.exists())
+
+        self.assertEqual(dispatch_events(), 1)
+        event.refresh_from_db()
+        self.assertIsNotNone(event.dispatched_at)
+        self.assertEqual(Notification.objects.filter(pharmacist=self.pharmacist).count(), 1)
+        self.assertEqual(dispatch_events(), 0)
+
+    def test_failing_handler_does_not_block_other_events(self):
+        bad = OutboxEvent.objects.create(event_type='order_placed', payload={})
+        good = OutboxEvent.objects.create(event_type='payment_failed', payload={
+            'order_id': 1, 'patient_id': self.patient.id, 'reason': 'Card declined by issuer.'
+        })
+
+        with self.assertLogs('main.outbox', 'ERROR'):
+            self.assertEqual(dispatch_events(), 2)
+
+        bad.refresh_from_db()
+        good.refresh_from_db()
+        self.assertIsNotNone(bad.dispatched_at)
+        self.assertIn('KeyError', bad.error)
+        self.assertEqual(good.error, '')
+        self.assertTrue(Notification.objects.filter(patient=self.patient).exists())
+
+    def test_deleted_recipient_is_skipped(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            record_event('order_placed', {'order_id': 1, 'pharmacist_ids': [self.pharmacist.id, self.pharmacist.id + 1000]})
+
+        self.assertEqual(Notification.objects.count(), 1)
+        self.assertFalse(OutboxEvent.objects.filter(dispatched_at__isnull=True).exists())
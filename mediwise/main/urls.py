@@ -70,7 +70,10 @@ urlpatterns = [
     path('pharmacist/medicine/edit/<int:pk>/', views.edit_medicine, name='edit_medicine'),
     path('pharmacist/medicine/delete/<int:pk>/', views.delete_medicine, name='delete_medicine'),
     path('pharmacist/orders/', views.pharmacist_orders, name='pharmacist_orders'),
+    path('pharmacist/orders/queue/', views.pharmacist_order_queue, name='pharmacist_order_queue'),
+    path('events/stream/', views.live_events, name='live_events'),
     path('pharmacist/order/<int:order_id>/update-status/', views.update_order_status, name='update_order_status'),
+    path('pharmacist/orders/bulk-update-status/', views.bulk_update_order_status, name='bulk_update_order_status'),
     path('pharmacist/order/<int:order_id>/details/', views.pharmacist_order_details_ajax, name='pharmacist_order_details'),
 
     path('pharmacist/customers/', views.pharmacist_customers, name='pharmacist_customers'),
@@ -78,6 +81,8 @@ urlpatterns = [
     path('pharmacist/ratings-feedback/', views.pharmacist_ratings_feedback, name='pharmacist_ratings_feedback'),
     path('pharmacist/reminders/send/<int:order_item_id>/', views.send_refill_reminder, name='send_refill_reminder'),
     path('api/check_medicine_stock/', views.check_medicine_stock, name='check_medicine_stock'),
+    path('api/check_medicine_stock/bulk/', views.check_medicine_stock_bulk, name='check_medicine_stock_bulk'),
+    path('api/medicines/typeahead/', views.medicine_typeahead, name='medicine_typeahead'),
     path('api/update_doctor_status/', views.update_doctor_status, name='update_doctor_status'),
     path('test/doctor_status/', views.test_doctor_status, name='test_doctor_status'),
     path('doctor/set_leave/', views.set_doctor_leave, name='set_doctor_leave'),
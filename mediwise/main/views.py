@@ -1,7 +1,18 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.http import JsonResponse, HttpResponse
-from .models import MediAdmin, Patient, Users, Doctor, Pharmacist, Medicine, Cart,Transaction,OrderItem,Order, Appointment, Prescription, PrescriptionMedicine, LabTest, Notification, Review, Leave, AuditLog, LabReportImage, MedicalCondition, PastOperation
+from .models import MediAdmin, Patient, Users, Doctor, Pharmacist, Medicine, Cart,Transaction,OrderItem,Order, Appointment, Prescription, PrescriptionMedicine, LabTest, Notification, Review, Leave, AuditLog, LabReportImage, MedicalCondition, PastOperation, PendingOrder, PharmacyOrder
 from .forms import PatientRegistrationForm, PharmacistRegistrationForm, PatientProfileUpdateForm, DoctorRegistrationForm, PharmacistProfileUpdateForm, MedicineForm, LeaveForm
+from .search import search_pharmacies, typeahead_index
+from .availability import cached_availability, resolve_availability, stock_summary
+from .basket import optimize_basket
+from .inventory import InsufficientStock, record_inventory_change, remove_medicine, reserve_stock
+from .cart import GST_RATE, refresh_cart_summaries_for_medicine, refresh_cart_summary, upsert_cart_items
+from .payments import start_capture
+from .routing import ORDER_QUEUE_PAGE_SIZE, order_queue, queue_stats, route_order, set_order_status, set_orders_status
+from .conditional import conditional_response, make_etag
+from .notifications import mark_all_read, notify, unread_count, visible_notifications
+from .outbox import record_event
+from .holds import place_holds, release_expired_holds, release_holds
 from django.contrib import messages
 from django.core.mail import send_mail
 from django.conf import settings
@@ -11,6 +22,7 @@ from datetime import datetime, timedelta
 from django.core.files.storage import default_storage
 from ml.predictDisease import run_medical_assistant
 from google import genai
+import hashlib
 import json
 import os
 
@@ -97,6 +109,35 @@ def log_user_action(user, action, details=None, related_object=None, request=Non
         print(f"Error logging action: {e}")
 
 
+def log_user_actions(user, action, entries, request=None):
+    """Log several actions by one user in the audit log with a single INSERT
+    
+    Args:
+        user: Users object
+        action: Action type from AuditLog.ACTION_CHOICES
+        entries: Iterable of (details, related_object) pairs
+        request: HttpRequest object for IP and user agent
+    """
+    try:
+        ip_address = get_client_ip(request) if request else None
+        user_agent = request.META.get('HTTP_USER_AGENT', '') if request else None
+        AuditLog.objects.bulk_create([
+            AuditLog(
+                user=user,
+                action=action,
+                details=details,
+                ip_address=ip_address,
+                user_agent=user_agent,
+                related_object_id=related_object.id if related_object else None,
+                related_object_type=related_object.__class__.__name__ if related_object else None
+            )
+            for details, related_object in entries
+        ])
+    except Exception as e:
+        # Don't let logging errors break the application
+        print(f"Error logging actions: {e}")
+
+
 def get_client_ip(request):
     """Get client IP address from request"""
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
@@ -371,17 +412,17 @@ def admin_dashboard(request):
     # First get all orders that have reviews and are linked to pharmacists
     pharmacist_reviews = Review.objects.filter(
         review_type='order'
-    ).select_related('order__items__medicine__pharmacist').values(
-        'order__items__medicine__pharmacist'
+    ).values(
+        'order__pharmacy_orders__pharmacist'
     ).annotate(
         avg_rating=Avg('rating'),
         review_count=Count('id')
-    ).exclude(order__items__medicine__pharmacist__isnull=True).order_by('-avg_rating', '-review_count')[:5]
+    ).exclude(order__pharmacy_orders__pharmacist__isnull=True).order_by('-avg_rating', '-review_count')[:5]
     
     for ph in pharmacist_reviews:
-        if ph['order__items__medicine__pharmacist']:  # Make sure it's not null
+        if ph['order__pharmacy_orders__pharmacist']:  # Make sure it's not null
             try:
-                pharmacist = Pharmacist.objects.get(id=ph['order__items__medicine__pharmacist'])
+                pharmacist = Pharmacist.objects.get(id=ph['order__pharmacy_orders__pharmacist'])
                 top_pharmacists.append({
                     'pharmacist': pharmacist,
                     'avg_rating': ph['avg_rating'],
@@ -542,22 +583,13 @@ def patient_dashboard(request):
     active_prescriptions = active_prescriptions[:3]
     
     # Handle Notifications: Mark unread as read
-    unread_notifications = Notification.objects.filter(patient=user, is_read=False)
-    if unread_notifications.exists():
-        unread_notifications.update(is_read=True, read_at=timezone.now())
+    mark_all_read(patient_id=user.id)
     
     # Get all notifications for this patient, excluding those read more than 2 days ago
-    two_days_ago = timezone.now() - timedelta(days=2)
-    notifications = Notification.objects.filter(
-        patient=user
-    ).filter(
-        # Either not read yet, or read within the last 2 days
-        Q(is_read=False) | Q(read_at__gte=two_days_ago)
-    ).order_by('-created_at')
+    notifications = visible_notifications(patient_id=user.id)
     
     # Sidebar/Stat data
     recent_orders = Order.objects.filter(patient=user).order_by('-created_at')[:5]
-    cart_count = Cart.objects.filter(patient=user).count()
     
     # Calculate Health Score based on appointments and medicine orders
     from django.db.models import Count
@@ -597,7 +629,6 @@ def patient_dashboard(request):
         'active_prescriptions': active_prescriptions,
         'recent_orders': recent_orders,
         'notifications': notifications,
-        'cart_count': cart_count,
         'health_score': health_score,
         'health_progress_message': health_progress_message,
     }
@@ -668,75 +699,31 @@ def registered_pharmacies(request):
         expiry_date__gt=timezone.now().date()
     ).values_list('formulation', flat=True).distinct().order_by('formulation')
     
-    # If a formulation is selected OR medicine search is provided, get medicines for each pharmacy
+    # If a formulation is selected OR medicine search is provided, answer it with
+    # one ranked query across all pharmacies, grouped by pharmacy
     if selected_formulation or medicine_search:
-        pharmacies_with_medicines = []
-        for pharmacist in pharmacists:
-            # Build filter conditions
-            filter_kwargs = {
-                'pharmacist': pharmacist,
-                'expiry_date__gt': timezone.now().date()
-            }
-            
-            # Add formulation filter if selected
-            if selected_formulation:
-                filter_kwargs['formulation__iexact'] = selected_formulation
-            
-            # Add medicine search filter if provided - search by generic name from prescription
-            if medicine_search:
-                # Search for medicines matching the prescription's generic names across ALL pharmacies
-                # Include both Rx and OTC medicines
-                medicines = Medicine.objects.filter(
-                    pharmacist=pharmacist,
-                    expiry_date__gt=timezone.now().date()
-                ).filter(
-                    Q(generic_name__icontains=medicine_search) |
-                    Q(brand_name__icontains=medicine_search)
-                )
-                
-                # Only include pharmacies that have matching medicines
-                if medicines.exists():
-                    pharmacies_with_medicines.append({
-                        'pharmacist': pharmacist,
-                        'medicines': medicines,
-                        'medicine_count': medicines.count()
-                    })
-        pharmacies_data = pharmacies_with_medicines
+        pharmacies_data = search_pharmacies(medicine_search, selected_formulation)
     else:
         # No filter, show all pharmacies without medicines
         pharmacies_data = [{'pharmacist': pharmacist, 'medicines': [], 'medicine_count': 0} for pharmacist in pharmacists]
     
-    # Get cart count for the cart icon
-    cart_count = Cart.objects.filter(patient=user).count() if user else 0
-    
     # Get notifications for the patient, excluding those read more than 2 days ago
     from django.utils import timezone
     from datetime import timedelta
-    from .models import Notification
     
     # Mark all unread notifications as read and update their read_at timestamp
-    unread_notifications = Notification.objects.filter(patient=user, is_read=False)
-    for notification in unread_notifications:
-        notification.is_read = True
-        notification.read_at = timezone.now()
-        notification.save()
+    mark_all_read(patient_id=user.id)
     
     # Get all notifications for this patient, excluding those read more than 2 days ago
-    two_days_ago = timezone.now() - timedelta(days=2)
-    notifications = Notification.objects.filter(
-        patient=user
-    ).filter(
-        # Either not read yet, or read within the last 2 days
-        Q(is_read=False) | Q(read_at__gte=two_days_ago)
-    ).order_by('-created_at')
+    notifications = visible_notifications(patient_id=user.id)
     
     return render(request, 'patient/pharmacies.html', {
         'user': user,
         'pharmacies_data': pharmacies_data,
         'pharmacists': pharmacists,  # Keep for backward compatibility
         'notifications': notifications,
-        'cart_count': cart_count,
         'selected_formulation': selected_formulation,
+        'medicine_search': medicine_search,
         'all_formulations': all_formulations,
         'prescription_id': prescription_id,
         'prescription_medicine_names': list(prescription_medicine_names),
@@ -778,7 +765,7 @@ def pharmacy_medicines(request, pk):
             except Prescription.DoesNotExist:
                 # If specific prescription not found, return empty queryset
                 medicines = Medicine.objects.none()
-                prescription_med_names = set()
+                prescription_medicines = PrescriptionMedicine.objects.none()
         else:
             # Get all prescription medicines for this patient
             prescription_medicines = PrescriptionMedicine.objects.filter(
@@ -786,48 +773,28 @@ def pharmacy_medicines(request, pk):
             ).select_related('prescription')
         
         # Extract medicine names from prescriptions (both generic and brand names)
-        prescription_med_names = set()
         prescription_medicine_details = []  # Store detailed info about prescription medicines
         for prescription_medicine in prescription_medicines:
             if prescription_medicine.drug_name_generic:
-                prescription_med_names.add(prescription_medicine.drug_name_generic.lower())
                 prescription_medicine_details.append({
                     'name': prescription_medicine.drug_name_generic,
                     'type': 'generic'
                 })
             if prescription_medicine.drug_name_brand:
-                prescription_med_names.add(prescription_medicine.drug_name_brand.lower())
                 prescription_medicine_details.append({
                     'name': prescription_medicine.drug_name_brand,
                     'type': 'brand'
                 })
         
-        # Filter medicines that match prescription medicines using case-insensitive partial matching
-        if prescription_med_names:
-            from django.db.models import Q
-            q_objects = Q()
-            for med_name in prescription_med_names:
-                q_objects |= Q(generic_name__icontains=med_name)
-                q_objects |= Q(brand_name__icontains=med_name)
-            medicines = medicines.filter(q_objects).distinct()
-            
-            # Get the names of available medicines in this pharmacist's inventory
-            available_medicine_names = set()
-            for med in medicines:
-                available_medicine_names.add(med.generic_name.lower())
-                available_medicine_names.add(med.brand_name.lower())
+        # Match all prescription medicines against this pharmacist's inventory (one query, or its snapshot)
+        availability = cached_availability(prescription_medicine_details, pharmacist=pharmacist)
+        if availability.keys:
+            medicines = medicines.filter(id__in=availability.medicine_ids())
             
             # Identify which prescription medicines are not available
             unavailable_medicines = []
             for med_detail in prescription_medicine_details:
-                med_name_lower = med_detail['name'].lower()
-                # Check if this medicine name matches any available medicine
-                found = False
-                for avail_name in available_medicine_names:
-                    if avail_name and med_name_lower in avail_name or avail_name in med_name_lower:
-                        found = True
-                        break
-                if not found and med_name_lower.strip():
+                if med_detail['name'].strip() and not availability.offers(med_detail['name']):
                     unavailable_medicines.append(med_detail['name'])
             
             # Pass unavailable medicines to the template
@@ -847,9 +814,6 @@ def pharmacy_medicines(request, pk):
             Q(strength__icontains=search_term)
         ).distinct()
     
-    # Get cart count for the cart icon
-    cart_count = Cart.objects.filter(patient=user).count() if user else 0
-    
     # Get unavailable medicines if in prescription mode
     unavailable_prescription_medicines = getattr(request, 'unavailable_prescription_medicines', [])
     
@@ -857,7 +821,6 @@ def pharmacy_medicines(request, pk):
         'user': user,
         'pharmacist': pharmacist,
         'medicines': medicines,
-        'cart_count': cart_count,
         'search_term': request.GET.get('search', ''),
         'show_prescription_meds': bool(show_prescription_meds),
         'unavailable_prescription_medicines': unavailable_prescription_medicines,
@@ -916,7 +879,7 @@ def prescription_medicines_all_pharmacies(request):
         if not name_to_use:
             continue
             
-        criteria_key = (name_to_use.lower(), strength.lower() if strength else None)
+        criteria_key = (pm.normalized_name or name_to_use.lower(), strength.lower() if strength else None)
         if criteria_key not in seen_criteria:
             seen_criteria.add(criteria_key)
             search_criteria.append({
@@ -926,30 +889,16 @@ def prescription_medicines_all_pharmacies(request):
                 'instructions': pm.instructions
             })
     
-    # Search for these medicines across ALL pharmacies
+    # Resolve every prescription line against ALL pharmacies (one query, or its snapshot)
+    availability = cached_availability(search_criteria)
     medicines_with_pharmacies = []
     
     for criteria in search_criteria:
-        med_name = criteria['name']
         prescribed_strength = criteria['strength']
         
-        # Build query for name matching
-        name_query = Q(generic_name__icontains=med_name) | Q(brand_name__icontains=med_name)
-        
-        # Base results matching name and not expired
-        matching_medicines = Medicine.objects.filter(
-            expiry_date__gt=timezone.now().date()
-        ).filter(name_query)
-        
-        # Apply strength filter if prescribed
-        if prescribed_strength:
-            matching_medicines = matching_medicines.filter(strength__icontains=prescribed_strength)
-            
-        matching_medicines = matching_medicines.select_related('pharmacist').order_by('generic_name', 'brand_name')
-        
         # Group by unique medicine (generic + brand + pharmacist combination)
         medicine_pharmacy_map = {}
-        for med in matching_medicines:
+        for med in availability.offers(criteria['name'], prescribed_strength):
             med_key = f"{med.generic_name.lower()}_{med.brand_name.lower()}_{med.pharmacist.id}"
             
             if med_key not in medicine_pharmacy_map:
@@ -960,7 +909,7 @@ def prescription_medicines_all_pharmacies(request):
             
             medicine_pharmacy_map[med_key]['pharmacies'].append({
                 'pharmacist': med.pharmacist,
-                'quantity': med.quantity,
+                'quantity': med.available_quantity,
                 'price': med.price,
                 'strength': med.strength,
                 'formulation': med.formulation,
@@ -979,14 +928,22 @@ def prescription_medicines_all_pharmacies(request):
                     'pharmacies': data['pharmacies']
                 })
     
-    # Get cart count
-    cart_count = Cart.objects.filter(patient=user).count() if user else 0
+    # Pharmacies that can fill the whole prescription, at the prescribed strengths, in one visit
+    complete_pharmacy_ids = availability.stocked_at_all(search_criteria)
+    complete_pharmacies = sorted(
+        (availability.pharmacies[pharmacy_id] for pharmacy_id in complete_pharmacy_ids if pharmacy_id in availability.pharmacies),
+        key=lambda pharmacist: pharmacist.pharmacy_name
+    )
+    
+    # Cheapest single pharmacy vs cheapest 2-3 pharmacy split
+    basket = optimize_basket(search_criteria, availability=availability)
     
     return render(request, 'patient/prescription_medicines_all_pharmacies.html', {
         'user': user,
         'prescription': prescription,  # Can be None if showing all prescriptions
         'medicines_with_pharmacies': medicines_with_pharmacies,
-        'cart_count': cart_count,
+        'complete_pharmacies': complete_pharmacies,
+        'basket': basket,
     })
 
 def add_to_cart(request, medicine_id):
@@ -1013,14 +970,11 @@ def add_to_cart(request, medicine_id):
         # Verify if this prescription actually contains this medicine
         try:
             from .models import Prescription, PrescriptionMedicine
-            # Use flexible matching as in checkout
-            rx_medicine_name = medicine.generic_name.lower().strip()
+            # Synonyms and brands share a canonical name, so this is an indexed equality match
             pm_exists = PrescriptionMedicine.objects.filter(
                 prescription_id=prescription_id,
-                prescription__patient=patient
-            ).filter(
-                Q(drug_name_generic__icontains=rx_medicine_name) | 
-                Q(drug_name_brand__icontains=rx_medicine_name)
+                prescription__patient=patient,
+                normalized_name=medicine.normalized_name
             ).exists()
             
             if pm_exists:
@@ -1028,58 +982,28 @@ def add_to_cart(request, medicine_id):
         except (ValueError, Prescription.DoesNotExist):
             pass
 
+    # Insert or update the cart row in one statement
+    quantity_to_set = 5
+    if float(medicine.price) < 20:
+        quantity_to_set = max(quantity_to_set, 5)
+    result = upsert_cart_items(patient, [{
+        'medicine_id': medicine.id,
+        'quantity': quantity_to_set,
+        'added_from_prescription': is_from_prescription,
+    }])
+    
+    if result.skipped:
+        messages.error(request, "Medicine out of stock.")
+        return redirect('pharmacy_medicines', pk=medicine.pharmacist.id)
+    
     if medicine.medicine_type == 'Rx':
-        # Check if the medicine is already in the cart
-        existing_cart_item = Cart.objects.filter(patient=patient, medicine=medicine).first()
-        
-        if existing_cart_item:
-            # If item already exists, update its quantity
-            cart_item = existing_cart_item
-            cart_item.quantity = 5
-            if float(medicine.price) < 20:
-                cart_item.quantity = max(cart_item.quantity, 5)
-        else:
-            # If new item, create it with appropriate quantity
-            quantity_to_set = 5
-            if float(medicine.price) < 20:
-                quantity_to_set = max(quantity_to_set, 5)
-            cart_item = Cart.objects.create(patient=patient, medicine=medicine, quantity=quantity_to_set, requires_prescription=True)
-        
-        cart_item.requires_prescription = True
-        if is_from_prescription:
-            cart_item.added_from_prescription = True
-        cart_item.save()
-        
         if is_from_prescription:
             messages.success(request, f"{medicine.brand_name} added from your prescription.")
         else:
             messages.warning(request, f"{medicine.brand_name} is a prescription-only medicine. You will need to upload a prescription before checkout.")
-        return redirect('view_cart')
-    
-    # For OTC medicines, proceed normally
-    if medicine.quantity > 0:
-        # Check if the medicine is already in the cart
-        existing_cart_item = Cart.objects.filter(patient=patient, medicine=medicine).first()
-        
-        if existing_cart_item:
-            # If item already exists, update its quantity
-            cart_item = existing_cart_item
-            cart_item.quantity = 5
-            if float(medicine.price) < 20:
-                cart_item.quantity = max(cart_item.quantity, 5)
-        else:
-            # If new item, create it with appropriate quantity
-            quantity_to_set = 5
-            if float(medicine.price) < 20:
-                quantity_to_set = max(quantity_to_set, 5)
-            cart_item = Cart.objects.create(patient=patient, medicine=medicine, quantity=quantity_to_set)
-        
-        cart_item.save()
-        messages.success(request, f"{medicine.brand_name} added to cart.")
-        return redirect('view_cart')
     else:
-        messages.error(request, "Medicine out of stock.")
-        return redirect('pharmacy_medicines', pk=medicine.pharmacist.id)
+        messages.success(request, f"{medicine.brand_name} added to cart.")
+    return redirect('view_cart')
 
 def view_cart(request):
     from datetime import timedelta
@@ -1105,38 +1029,23 @@ def view_cart(request):
     
     # Remove expired items from cart
     if expired_cart_items:
-        for item in expired_cart_items:
-            item.delete()
+        Cart.objects.filter(id__in=[item.id for item in expired_cart_items]).delete()
+        refresh_cart_summary(patient.id)
         messages.warning(request, f"Removed {len(expired_cart_items)} expired medicine(s) from your cart.")
         
     cart_items = valid_cart_items
     
-    # Calculate subtotal
-    subtotal = 0
-    for item in cart_items:
-        subtotal += item.medicine.price * item.quantity
-    
-    # Calculate GST (18%)
-    gst_rate = Decimal('0.18')
-    gst_amount = round(subtotal * gst_rate, 2)
+    # Totals come from the rows shown, priced exactly as checkout will charge them
+    subtotal = sum((item.medicine.price * item.quantity for item in cart_items), Decimal('0'))
+    gst_amount = round(subtotal * GST_RATE, 2)
     total_amount = subtotal + gst_amount
     
     # Get cart count for the cart icon
-    cart_count = len(cart_items) if patient else 0
+    cart_count = len(cart_items)
 
-    unread_notifications = Notification.objects.filter(patient=patient, is_read=False)
-    for notification in unread_notifications:
-        notification.is_read = True
-        notification.read_at = timezone.now()
-        notification.save()
+    mark_all_read(patient_id=patient.id)
 
-    two_days_ago = timezone.now() - timedelta(days=2)
-    notifications = Notification.objects.filter(
-        patient=patient
-    ).filter(
-        # Either not read yet, or read within the last 2 days
-        Q(is_read=False) | Q(read_at__gte=two_days_ago)
-    ).order_by('-created_at')
+    notifications = visible_notifications(patient_id=patient.id)
     
     
     return render(request, 'patient/cart.html', {
@@ -1176,7 +1085,8 @@ def update_cart_quantity(request, item_id, action):
         else:
             cart_item.delete()
             messages.info(request, "Item removed from cart.")
-            
+    
+    refresh_cart_summary(patient_id)
     return redirect('view_cart')
 
 def update_cart_course_duration(request):
@@ -1214,6 +1124,7 @@ def remove_from_cart(request, item_id):
     if cart_item:
         medicine_name = cart_item.medicine.brand_name
         cart_item.delete()
+        refresh_cart_summary(patient_id)
         messages.info(request, f"{medicine_name} removed from cart.")
             
     return redirect('view_cart')
@@ -1239,12 +1150,23 @@ def checkout(request):
         messages.error(request, f"Prescription required for {first_rx_item.medicine.generic_name}. Please add this medicine from a valid prescription before proceeding to checkout.")
         return redirect('view_cart')
     
-    # Calculate total amount and verify stock
+    # Hold the stock for this cart until payment (fails fast if others hold it)
+    quantities = {}
+    for item in cart_items:
+        quantities[item.medicine_id] = quantities.get(item.medicine_id, 0) + item.quantity
+    release_expired_holds()
+    try:
+        hold_expires_at = place_holds(patient, quantities)
+    except InsufficientStock as e:
+        messages.error(request, f"Not enough stock for {e}.")
+        return redirect('view_cart')
+    except Medicine.DoesNotExist:
+        messages.error(request, "One or more medicines are no longer available.")
+        return redirect('view_cart')
+    
+    # Calculate total amount
     subtotal = 0
     for item in cart_items:
-        if item.medicine.quantity < item.quantity:
-            messages.error(request, f"Not enough stock for {item.medicine.brand_name}.")
-            return redirect('view_cart')
         subtotal += item.medicine.price * item.quantity
     
     # Calculate GST (assuming 18% standard rate for medicines)
@@ -1252,13 +1174,18 @@ def checkout(request):
     gst_amount = round(subtotal * GST_RATE, 2)
     total_amount = subtotal + gst_amount
     
-    # Store order details in session for payment processing
-    request.session['pending_order'] = {
-        'subtotal': float(subtotal),
-        'gst_amount': float(gst_amount),
-        'total_amount': float(total_amount),
-        'cart_items': [{'id': item.id, 'quantity': item.quantity, 'medicine_id': item.medicine.id, 'price': float(item.medicine.price)} for item in cart_items]
-    }
+    # Store order details server-side; the session only keeps the idempotency token
+    PendingOrder.objects.filter(patient=patient, status='open').delete()
+    pending_order = PendingOrder.objects.create(
+        patient=patient,
+        subtotal=subtotal,
+        gst_amount=gst_amount,
+        total_amount=total_amount,
+        hold_expires_at=hold_expires_at,
+        cart_items=[{'id': item.id, 'quantity': item.quantity, 'medicine_id': item.medicine.id, 'price': float(item.medicine.price)} for item in cart_items]
+    )
+    request.session['pending_order_token'] = str(pending_order.token)
+    request.session.pop('pending_order', None)
     
     # Redirect to payment portal
     return redirect('payment_portal')
@@ -1269,29 +1196,16 @@ def patient_records(request):
         return redirect('login')
     user = Patient.objects.filter(id=user_id).first()
     
-    # Get cart count for the cart icon
-    cart_count = Cart.objects.filter(patient=user).count() if user else 0
-    
     # Get notifications for the patient, excluding those read more than 2 days ago
     from django.utils import timezone
     from datetime import timedelta
-    from .models import Notification, LabReportImage
+    from .models import LabReportImage
     
     # Mark all unread notifications as read and update their read_at timestamp
-    unread_notifications = Notification.objects.filter(patient=user, is_read=False)
-    for notification in unread_notifications:
-        notification.is_read = True
-        notification.read_at = timezone.now()
-        notification.save()
+    mark_all_read(patient_id=user.id)
     
     # Get all notifications for this patient, excluding those read more than 2 days ago
-    two_days_ago = timezone.now() - timedelta(days=2)
-    notifications = Notification.objects.filter(
-        patient=user
-    ).filter(
-        # Either not read yet, or read within the last 2 days
-        Q(is_read=False) | Q(read_at__gte=two_days_ago)
-    ).order_by('-created_at')
+    notifications = visible_notifications(patient_id=user.id)
     
     # Get lab report images for this patient
     lab_reports = LabReportImage.objects.filter(patient=user).order_by('-uploaded_at')
@@ -1299,7 +1213,6 @@ def patient_records(request):
     return render(request, 'patient/records.html', {
         'user': user, 
         'notifications': notifications,
-        'cart_count': cart_count,
         'lab_reports': lab_reports
     })
 
@@ -1489,56 +1402,69 @@ def patient_orders(request):
     # Get notifications for the patient, excluding those read more than 2 days ago
     from django.utils import timezone
     from datetime import timedelta
-    from .models import Notification
     
     # Mark all unread notifications as read and update their read_at timestamp
-    unread_notifications = Notification.objects.filter(patient=patient, is_read=False)
-    for notification in unread_notifications:
-        notification.is_read = True
-        notification.read_at = timezone.now()
-        notification.save()
+    mark_all_read(patient_id=patient.id)
     
     # Get all notifications for this patient, excluding those read more than 2 days ago
-    two_days_ago = timezone.now() - timedelta(days=2)
-    notifications = Notification.objects.filter(
-        patient=patient
-    ).filter(
-        # Either not read yet, or read within the last 2 days
-        Q(is_read=False) | Q(read_at__gte=two_days_ago)
-    ).order_by('-created_at')
-    
-    # Get cart count for the cart icon
-    cart_count = Cart.objects.filter(patient=patient).count() if patient else 0
+    notifications = visible_notifications(patient_id=patient.id)
     
     return render(request, 'patient/orders.html', {
         'user': patient,
         'orders': orders,
         'notifications': notifications,
-        'cart_count': cart_count
     })
 
 def order_details_ajax(request, order_id):
-    """AJAX view to return order details for the modal"""
+    """AJAX view to return order details for the modal (304 when the patient's copy is current)"""
     from django.http import JsonResponse
+    from django.db.models import Count, Max
+    from django.middleware.csrf import get_token
+    from django.template.loader import render_to_string
     
-    try:
-        order = Order.objects.prefetch_related(
-            'items__medicine__pharmacist', 
-            'transaction', 
+    patient_id = request.session.get('patient_id')
+    if not patient_id:
+        return JsonResponse({'error': 'Not authenticated'}, status=401)
+    
+    # Ownership check and version key in one query, before any cache lookup
+    version = Order.objects.filter(id=order_id, patient_id=patient_id).annotate(
+        item_count=Count('items', distinct=True),
+        review_count=Count('reviews', distinct=True),
+        reviewed_at=Max('reviews__updated_at')
+    ).values_list(
+        'updated_at', 'item_count', 'review_count', 'reviewed_at',
+        'transaction__transaction_id', 'transaction__payment_method'
+    ).first()
+    if version is None:
+        return JsonResponse({'error': 'Order not found'}, status=404)
+    # Pharmacy and medicine rows keep no timestamp, so the fields the modal shows are part of the version
+    related = tuple(OrderItem.objects.filter(order_id=order_id).order_by('id').values_list(
+        'medicine__generic_name', 'pharmacist__pharmacy_name', 'pharmacist__address', 'pharmacist__phone_number'
+    ))
+    
+    # The modal embeds a CSRF token for its review form; any masking of the
+    # same secret stays valid, so the version only changes when the secret does
+    get_token(request)
+    csrf_secret = hashlib.sha1(request.META['CSRF_COOKIE'].encode()).hexdigest()
+    etag = make_etag('patient-order', order_id, *version, related, csrf_secret)
+    
+    def build():
+        order = Order.objects.select_related('transaction').prefetch_related(
+            'items__medicine',
+            'items__pharmacist',
             'reviews'
         ).get(id=order_id)
         
         # Add unique pharmacists for the order
         pharmacists_set = set()
         for item in order.items.all():
-            if item.medicine.pharmacist:
-                pharmacists_set.add(item.medicine.pharmacist)
+            if item.pharmacist:
+                pharmacists_set.add(item.pharmacist)
         order.unique_pharmacists = list(pharmacists_set)
         
         # Get the review for this order if it exists
-        order_review = None
-        if hasattr(order, 'reviews') and order.reviews.exists():
-            order_review = order.reviews.first()
+        reviews = list(order.reviews.all())
+        order_review = reviews[0] if reviews else None
         
         context = {
             'order': order,
@@ -1546,9 +1472,9 @@ def order_details_ajax(request, order_id):
             'is_completed': order.status == 'completed'
         }
         
-        return render(request, 'patient/order_details_modal.html', context)
-    except Order.DoesNotExist:
-        return JsonResponse({'error': 'Order not found'}, status=404)
+        return render_to_string('patient/order_details_modal.html', context, request=request)
+    
+    return conditional_response(request, f'patient-order:{patient_id}:{order_id}', etag, build, content_type='text/html; charset=utf-8')
 
 
 def submit_order_review(request, order_id):
@@ -1618,32 +1544,17 @@ def patient_prescriptions(request):
     # Get notifications for the patient, excluding those read more than 2 days ago
     from django.utils import timezone
     from datetime import timedelta
-    from .models import Notification
     
     # Mark all unread notifications as read and update their read_at timestamp
-    unread_notifications = Notification.objects.filter(patient=patient, is_read=False)
-    for notification in unread_notifications:
-        notification.is_read = True
-        notification.read_at = timezone.now()
-        notification.save()
+    mark_all_read(patient_id=patient.id)
     
     # Get all notifications for this patient, excluding those read more than 2 days ago
-    two_days_ago = timezone.now() - timedelta(days=2)
-    notifications = Notification.objects.filter(
-        patient=patient
-    ).filter(
-        # Either not read yet, or read within the last 2 days
-        Q(is_read=False) | Q(read_at__gte=two_days_ago)
-    ).order_by('-created_at')
-    
-    # Get cart count for the cart icon
-    cart_count = Cart.objects.filter(patient=patient).count() if patient else 0
+    notifications = visible_notifications(patient_id=patient.id)
     
     context = {
         'user': patient,
         'prescriptions': prescriptions,
         'notifications': notifications,
-        'cart_count': cart_count,
     }
     return render(request, 'patient/prescriptions.html', context)
 
@@ -1715,48 +1626,16 @@ def extract_medicines_from_prescription(prescription_upload):
 def check_medicine_availability(extracted_medicines, pharmacist=None):
     """Check availability of medicines in specified pharmacy or all pharmacies, excluding expired medicines.
     Returns detailed information about which pharmacies have which medicines."""
-    from .models import Medicine
     from decimal import Decimal
-    from django.utils import timezone
-    from collections import defaultdict
     
-    # If specific pharmacy is specified, check only that pharmacy
-    if pharmacist:
-        pharmacy_medicines = Medicine.objects.filter(
-            pharmacist=pharmacist,
-            expiry_date__gt=timezone.now().date()  # Only non-expired medicines
-        )
-        pharmacy_list = [pharmacist]
-    else:
-        # Check all pharmacies, excluding expired medicines
-        pharmacy_medicines = Medicine.objects.filter(
-            expiry_date__gt=timezone.now().date()  # Only non-expired medicines
-        ).select_related('pharmacist')
-        pharmacy_list = Pharmacist.objects.all()
-    
-    # Build a comprehensive medicine dictionary
-    # Structure: {medicine_name: [{pharmacy_info}, ...]}
-    medicine_dict = {}
-    for med in pharmacy_medicines:
-        key = med.generic_name.lower().strip()
-        if key not in medicine_dict:
-            medicine_dict[key] = []
-        
-        medicine_dict[key].append({
-            'medicine': med,
-            'stock': med.quantity,
-            'price': str(med.price),
-            'pharmacy_id': med.pharmacist.id,
-            'pharmacy_name': med.pharmacist.pharmacy_name
-        })
+    # Strength is informational for extracted medicines, so match on name only
+    availability = cached_availability(
+        [{'name': medicine['name']} for medicine in extracted_medicines],
+        pharmacist=pharmacist
+    )
     
     # Track pharmacy inventory for aggregation
-    pharmacy_inventory = defaultdict(lambda: {
-        'medicines': [],
-        'total_items': 0,
-        'total_price': Decimal('0'),
-        'has_all_medicines': False
-    })
+    pharmacy_inventory = {}
     
     available_medicines = []
     unavailable_medicines = []
@@ -1764,80 +1643,70 @@ def check_medicine_availability(extracted_medicines, pharmacist=None):
     
     # Process each medicine from the prescription
     for medicine in extracted_medicines:
-        med_name = medicine['name'].lower().strip()
         medicine_key = medicine['name']  # Original case for display
+        all_offers = availability.offers(medicine_key)
+        matching_offers = [offer for offer in all_offers if offer.available_quantity > 0]
         
-        if med_name in medicine_dict:
-            # Find all pharmacies with this medicine in stock
-            matching_pharmacies = []
-            for pharmacy_med in medicine_dict[med_name]:
-                if pharmacy_med['stock'] > 0:
-                    matching_pharmacies.append(pharmacy_med)
-                    
-                    # Add to available medicines list
-                    available_medicines.append({
-                        'name': pharmacy_med['medicine'].generic_name,
-                        'brand': pharmacy_med['medicine'].brand_name,
-                        'strength': pharmacy_med['medicine'].strength,
-                        'stock': pharmacy_med['stock'],
-                        'price': pharmacy_med['price'],
-                        'pharmacy_id': pharmacy_med['pharmacy_id'],
-                        'pharmacy_name': pharmacy_med['pharmacy_name'],
-                        'medicine_id': pharmacy_med['medicine'].id,
-                        'extracted_info': medicine
-                    })
-                    
-                    # Update pharmacy inventory tracking
-                    pharma_id = pharmacy_med['pharmacy_id']
-                    pharmacy_inventory[pharma_id]['medicines'].append(medicine_key)
-                    pharmacy_inventory[pharma_id]['total_items'] += 1
-                    try:
-                        pharmacy_inventory[pharma_id]['total_price'] += Decimal(pharmacy_med['price'])
-                    except:
-                        pass
+        for offer in matching_offers:
+            available_medicines.append({
+                'name': offer.generic_name,
+                'brand': offer.brand_name,
+                'strength': offer.strength,
+                'stock': offer.available_quantity,
+                'price': str(offer.price),
+                'pharmacy_id': offer.pharmacist_id,
+                'pharmacy_name': offer.pharmacist.pharmacy_name,
+                'medicine_id': offer.id,
+                'extracted_info': medicine
+            })
             
+            # Update pharmacy inventory tracking
+            inventory = pharmacy_inventory.setdefault(offer.pharmacist_id, {
+                'medicines': [],
+                'total_items': 0,
+                'total_price': Decimal('0'),
+                'has_all_medicines': False
+            })
+            inventory['medicines'].append(medicine_key)
+            inventory['total_items'] += 1
+            inventory['total_price'] += offer.price
+        
+        if all_offers:
             medicine_to_pharmacies[medicine_key] = [
-                {'pharmacy_id': p['pharmacy_id'], 'pharmacy_name': p['pharmacy_name']}
-                for p in matching_pharmacies
+                {'pharmacy_id': offer.pharmacist_id, 'pharmacy_name': offer.pharmacist.pharmacy_name}
+                for offer in matching_offers
             ]
-            
-            # If no pharmacy has this medicine in stock
-            if not matching_pharmacies:
-                unavailable_medicines.append({
-                    'name': medicine['name'],
-                    'reason': 'Out of stock in all pharmacies',
-                    'extracted_info': medicine,
-                    'available_pharmacies': []
-                })
-        else:
+        
+        # If no pharmacy has this medicine in stock
+        if not matching_offers:
             unavailable_medicines.append({
                 'name': medicine['name'],
-                'reason': 'Not available in any pharmacy',
+                'reason': 'Out of stock in all pharmacies' if all_offers else 'Not available in any pharmacy',
                 'extracted_info': medicine,
                 'available_pharmacies': []
             })
     
-    # Determine which pharmacies have ALL medicines from the prescription
-    total_unique_medicines = len(set([m['name'].lower().strip() for m in extracted_medicines]))
+    # Determine which pharmacies have ALL medicines from the prescription (bitmap AND)
+    prescribed_names = set([availability.canonical_name(m['name']) for m in extracted_medicines])
+    total_unique_medicines = len(prescribed_names)
+    complete_pharmacy_ids = availability.stocked_at_all([{'name': m['name']} for m in extracted_medicines])
     
     for pharma_id, inventory in pharmacy_inventory.items():
-        unique_medicines_at_pharmacy = len(set([m.lower().strip() for m in inventory['medicines']]))
-        inventory['has_all_medicines'] = (unique_medicines_at_pharmacy == total_unique_medicines)
+        inventory['unique_count'] = len(set([availability.canonical_name(m) for m in inventory['medicines']]))
+        inventory['has_all_medicines'] = pharma_id in complete_pharmacy_ids
     
-    # Add pharmacy summary information
+    # Add pharmacy summary information (pharmacies come from the resolver, no extra lookups)
     pharmacy_summary = []
     for pharma_id, inventory in pharmacy_inventory.items():
-        pharmacy_obj = Pharmacist.objects.filter(id=pharma_id).first()
-        if pharmacy_obj:
-            pharmacy_summary.append({
-                'pharmacy_id': pharma_id,
-                'pharmacy_name': inventory['medicines'][0] if inventory['medicines'] else '',
-                'medicines_available': inventory['medicines'],
-                'total_medicines_count': len(inventory['medicines']),
-                'has_all_medicines': inventory['has_all_medicines'],
-                'estimated_total_price': str(inventory['total_price']),
-                'completeness_percentage': round((len(inventory['medicines']) / total_unique_medicines * 100), 1) if total_unique_medicines > 0 else 0
-            })
+        pharmacy_summary.append({
+            'pharmacy_id': pharma_id,
+            'pharmacy_name': availability.pharmacies[pharma_id].pharmacy_name,
+            'medicines_available': inventory['medicines'],
+            'total_medicines_count': len(inventory['medicines']),
+            'has_all_medicines': inventory['has_all_medicines'],
+            'estimated_total_price': str(inventory['total_price']),
+            'completeness_percentage': round((inventory['unique_count'] / total_unique_medicines * 100), 1) if total_unique_medicines > 0 else 0
+        })
     
     # Sort pharmacies: those with all medicines first, then by completeness percentage
     pharmacy_summary.sort(key=lambda x: (-x['has_all_medicines'], -x['completeness_percentage']))
@@ -1909,7 +1778,6 @@ def upload_prescription(request, pharmacist_id=None):
     context = {
         'user': patient,
         'pharmacist': pharmacist,
-        'cart_count': Cart.objects.filter(patient=patient).count(),
     }
     
     return render(request, 'patient/upload_prescription.html', context)
@@ -1929,12 +1797,12 @@ def view_my_prescriptions(request):
     uploaded_prescriptions = PrescriptionUpload.objects.filter(patient=patient).select_related('pharmacist').order_by('-created_at')
     
     # Add medicine availability information - SEARCH ACROSS ALL PHARMACIES
+    # (served from availability snapshots until the inventory changes)
     for upload in uploaded_prescriptions:
         # Get extracted medicines
         upload.extracted_medicines = upload.extracted_medicines or []
         
-        # Check availability across ALL pharmacies (pass None to search all)
-        available_medicines, unavailable_medicines, pharmacy_summary, medicine_to_pharmacies = check_medicine_availability(upload.extracted_medicines, pharmacist=None)
+        available_medicines, unavailable_medicines, pharmacy_summary, medicine_to_pharmacies = check_medicine_availability(upload.extracted_medicines)
         upload.available_medicines = available_medicines
         upload.unavailable_medicines = unavailable_medicines
         upload.pharmacy_summary = pharmacy_summary
@@ -1943,7 +1811,6 @@ def view_my_prescriptions(request):
     context = {
         'user': patient,
         'uploaded_prescriptions': uploaded_prescriptions,
-        'cart_count': Cart.objects.filter(patient=patient).count(),
     }
     
     return render(request, 'patient/my_prescriptions.html', context)
@@ -1981,101 +1848,59 @@ def delete_prescription_upload(request, prescription_id):
     context = {
         'user': patient,
         'prescription': prescription,
-        'cart_count': Cart.objects.filter(patient=patient).count(),
     }
     
     return render(request, 'patient/delete_prescription.html', context)
 
 def add_all_prescription_medicines_to_cart(request, prescription_id):
-    """Add all available medicines from a prescription to the patient's cart"""
+    """Add the cheapest available medicines for every line of a prescription to the cart"""
     user_id = request.session.get('patient_id')
     if not user_id:
         return redirect('login')
     
     try:
         patient = Patient.objects.get(id=user_id)
-        prescription = PrescriptionUpload.objects.get(id=prescription_id, patient=patient)
-    except (Patient.DoesNotExist, PrescriptionUpload.DoesNotExist):
+        prescription = Prescription.objects.get(id=prescription_id, patient=patient)
+    except (Patient.DoesNotExist, Prescription.DoesNotExist):
         messages.error(request, "Prescription not found or you don't have permission to access it.")
-        return redirect('view_my_prescriptions')
+        return redirect('patient_prescriptions')
     
-    if request.method == 'POST':
-        from .models import Medicine, Cart
-        medicines_added = 0
-        medicines_skipped = 0
-        
-        # Get available medicines from the prescription
-        available_medicines = prescription.available_medicines or []
-        
-        for med_data in available_medicines:
-            try:
-                # Find the actual medicine object
-                medicine = Medicine.objects.get(
-                    generic_name=med_data['name'],
-                    pharmacist_id=med_data['pharmacy_id']
-                )
-                
-                # Check if medicine is already in cart
-                existing_cart_item = Cart.objects.filter(
-                    patient=patient,
-                    medicine=medicine
-                ).first()
-                
-                if existing_cart_item:
-                    # Update quantity if already exists
-                    existing_cart_item.quantity += 1
-                    existing_cart_item.save()
-                    medicines_added += 1
-                else:
-                    # Add new item to cart
-                    # Extract duration from prescription data if available
-                    duration = "7 days"  # Default duration
-                    if med_data.get('duration'):
-                        duration = med_data['duration']
-                    elif med_data.get('extracted_info') and med_data['extracted_info'].get('duration'):
-                        duration = med_data['extracted_info']['duration']
-                    
-                    # Extract quantity from prescription data if available
-                    quantity = 1  # Default quantity
-                    if med_data.get('extracted_info') and med_data['extracted_info'].get('quantity'):
-                        # Try to parse the quantity from the prescription string
-                        import re
-                        quantity_match = re.search(r'(\d+)', str(med_data['extracted_info']['quantity']))
-                        if quantity_match:
-                            quantity = int(quantity_match.group(1))
-                        else:
-                            # If no number found, default to 1
-                            quantity = 1
-                    
-                    Cart.objects.create(
-                        patient=patient,
-                        medicine=medicine,
-                        quantity=quantity,
-                        course_duration=duration,
-                        added_from_prescription=True  # Mark as added from prescription
-                    )
-                    medicines_added += 1
-                    
-            except Medicine.DoesNotExist:
-                medicines_skipped += 1
-                continue
-        
-        # Add success message
-        if medicines_added > 0:
-            messages.success(request, f"Successfully added {medicines_added} medicine(s) to your cart.")
-        if medicines_skipped > 0:
-            messages.warning(request, f"{medicines_skipped} medicine(s) could not be added to cart.")
-        
-        return redirect('view_my_prescriptions')
+    from django.urls import reverse
+    all_pharmacies_url = f"{reverse('prescription_medicines_all_pharmacies')}?prescription_id={prescription.id}"
+    if request.method != 'POST':
+        return redirect(all_pharmacies_url)
+    
+    lines = []
+    for pm in prescription.medicines.all():
+        name = (pm.drug_name_generic or pm.drug_name_brand or '').strip()
+        if name:
+            lines.append({'name': name, 'strength': pm.strength})
+    
+    # Buy every line where it is cheapest overall (one or a few pharmacies)
+    basket = optimize_basket(lines)
+    plan = basket.split or basket.single
+    assignments = plan.assignments if plan else []
+    result = upsert_cart_items(patient, [
+        {
+            'medicine_id': assignment['medicine'].id,
+            'quantity': assignment['quantity'],
+            'added_from_prescription': True,
+        }
+        for assignment in assignments
+    ], increment=True)
     
-    # If GET request, show confirmation page
-    context = {
-        'user': patient,
-        'prescription': prescription,
-        'cart_count': Cart.objects.filter(patient=patient).count(),
-    }
+    medicines_added = len(result.written)
+    medicines_skipped = len(basket.missing) + len(result.skipped)
+    
+    # Add success message
+    if medicines_added > 0:
+        messages.success(request, f"Successfully added {medicines_added} medicine(s) to your cart.")
+    if medicines_skipped > 0:
+        messages.warning(request, f"{medicines_skipped} medicine(s) could not be added to cart.")
     
-    return render(request, 'patient/add_prescription_medicines_to_cart.html', context)
+    if medicines_added == 0:
+        return redirect(all_pharmacies_url)
+    return redirect('view_cart')
 
 def pharmacist_prescription_uploads(request):
     """View prescriptions uploaded for this pharmacist"""
@@ -2102,18 +1927,12 @@ def pharmacist_prescription_uploads(request):
     all_prescriptions = list(pharmacy_prescriptions) + list(common_prescriptions)
     all_prescriptions.sort(key=lambda x: x.created_at, reverse=True)
     
-    # Get all medicines for this pharmacist
-    pharmacist_medicines = Medicine.objects.filter(pharmacist=pharmacist)
-    medicine_dict = {}
-    for med in pharmacist_medicines:
-        key = med.generic_name.lower().strip()
-        medicine_dict[key] = {
-            'medicine': med,
-            'stock': med.quantity,
-            'price': str(med.price),  # Convert Decimal to string for JSON serialization
-            'pharmacy_id': med.pharmacist.id,
-            'pharmacy_name': med.pharmacist.pharmacy_name
-        }
+    # Resolve the extracted medicines of every prescription against this
+    # pharmacist's inventory in one query
+    availability = resolve_availability(
+        [{'name': medicine['name']} for prescription in all_prescriptions for medicine in (prescription.extracted_medicines or [])],
+        pharmacist=pharmacist
+    )
     
     # Add medicine availability information (using actual extracted medicines)
     for prescription in all_prescriptions:
@@ -2124,16 +1943,17 @@ def pharmacist_prescription_uploads(request):
         extracted_medicines = prescription.extracted_medicines or []
         
         for medicine in extracted_medicines:
-            med_name = medicine['name'].lower().strip()
-            if med_name in medicine_dict:
+            offers = availability.offers(medicine['name'])
+            if offers:
+                match = offers[0]
                 prescription.medicine_matches.append({
-                    'name': medicine_dict[med_name]['medicine'].generic_name,
-                    'brand': medicine_dict[med_name]['medicine'].brand_name,
-                    'stock': medicine_dict[med_name]['stock'],
-                    'price': medicine_dict[med_name]['price'],
-                    'strength': medicine_dict[med_name]['medicine'].strength,
-                    'pharmacy_id': medicine_dict[med_name]['pharmacy_id'],
-                    'pharmacy_name': medicine_dict[med_name]['pharmacy_name'],
+                    'name': match.generic_name,
+                    'brand': match.brand_name,
+                    'stock': match.quantity,
+                    'price': str(match.price),  # Convert Decimal to string for JSON serialization
+                    'strength': match.strength,
+                    'pharmacy_id': pharmacist.id,
+                    'pharmacy_name': pharmacist.pharmacy_name,
                     'extracted_info': medicine
                 })
             else:
@@ -2442,28 +2262,14 @@ def patient_notifications(request):
     from django.utils import timezone
     from datetime import timedelta
     
-    unread_notifications = Notification.objects.filter(patient=patient, is_read=False)
-    for notification in unread_notifications:
-        notification.is_read = True
-        notification.read_at = timezone.now()
-        notification.save()
+    mark_all_read(patient_id=patient.id)
     
     # Get all notifications for this patient, excluding those read more than 2 days ago
-    two_days_ago = timezone.now() - timedelta(days=2)
-    notifications = Notification.objects.filter(
-        patient=patient
-    ).filter(
-        # Either not read yet, or read within the last 2 days
-        Q(is_read=False) | Q(read_at__gte=two_days_ago)
-    ).order_by('-created_at')
-    
-    # Get cart count for the cart icon
-    cart_count = Cart.objects.filter(patient=patient).count() if patient else 0
+    notifications = visible_notifications(patient_id=patient.id)
     
     context = {
         'user': patient,
         'notifications': notifications,
-        'cart_count': cart_count,
     }
     return render(request, 'patient/notifications.html', context)
 
@@ -2502,29 +2308,15 @@ def view_doctors(request):
             if appointment.doctor.id not in completed_appointments_map:
                 completed_appointments_map[str(appointment.doctor.id)] = appointment
     
-    # Get cart count for the cart icon
-    cart_count = Cart.objects.filter(patient=patient).count() if patient else 0
-    
     # Get notifications for the patient, excluding those read more than 2 days ago
     from django.utils import timezone
     from datetime import timedelta
-    from .models import Notification
     
     # Mark all unread notifications as read and update their read_at timestamp
-    unread_notifications = Notification.objects.filter(patient=patient, is_read=False)
-    for notification in unread_notifications:
-        notification.is_read = True
-        notification.read_at = timezone.now()
-        notification.save()
+    mark_all_read(patient_id=patient.id)
     
     # Get all notifications for this patient, excluding those read more than 2 days ago
-    two_days_ago = timezone.now() - timedelta(days=2)
-    notifications = Notification.objects.filter(
-        patient=patient
-    ).filter(
-        # Either not read yet, or read within the last 2 days
-        Q(is_read=False) | Q(read_at__gte=two_days_ago)
-    ).order_by('-created_at')
+    notifications = visible_notifications(patient_id=patient.id)
     
     # Get all unique specializations for the filter dropdown
     specializations = Doctor.objects.values_list('speciality', flat=True).distinct().order_by('speciality')
@@ -2535,7 +2327,6 @@ def view_doctors(request):
         'appointments': recent_appointments,
         'completed_appointments_map': completed_appointments_map,
         'notifications': notifications,
-        'cart_count': cart_count,
         'search_query': search_query,
         'specialization_filter': specialization_filter,
         'specializations': specializations,
@@ -2557,9 +2348,6 @@ def book_appointment(request, doctor_id):
         messages.error(request, f'Sorry, booking is currently unavailable for Dr. {doctor.first_name} {doctor.last_name}.')
         return redirect('view_doctors')
     
-    # Get cart count for the cart icon
-    cart_count = Cart.objects.filter(patient=patient).count() if patient else 0
-    
     if request.method == 'POST':
         appointment_date = request.POST.get('appointment_date')
         appointment_time = request.POST.get('appointment_time')
@@ -2617,7 +2405,6 @@ def book_appointment(request, doctor_id):
     context = {
         'user': patient,
         'doctor': doctor,
-        'cart_count': cart_count,
         'preferred_date': preferred_date,
         'today_time_over': today_time_over,
         'today_date': today_date,
@@ -2633,35 +2420,20 @@ def patient_appointments(request):
     patient = Patient.objects.get(id=user_id)
     appointments = Appointment.objects.filter(patient=patient).prefetch_related('reviews').order_by('-created_at')
     
-    # Get cart count for the cart icon
-    cart_count = Cart.objects.filter(patient=patient).count() if patient else 0
-    
     # Get notifications for the patient, excluding those read more than 2 days ago
     from django.utils import timezone
     from datetime import timedelta
-    from .models import Notification
     
     # Mark all unread notifications as read and update their read_at timestamp
-    unread_notifications = Notification.objects.filter(patient=patient, is_read=False)
-    for notification in unread_notifications:
-        notification.is_read = True
-        notification.read_at = timezone.now()
-        notification.save()
+    mark_all_read(patient_id=patient.id)
     
     # Get all notifications for this patient, excluding those read more than 2 days ago
-    two_days_ago = timezone.now() - timedelta(days=2)
-    notifications = Notification.objects.filter(
-        patient=patient
-    ).filter(
-        # Either not read yet, or read within the last 2 days
-        Q(is_read=False) | Q(read_at__gte=two_days_ago)
-    ).order_by('-created_at')
+    notifications = visible_notifications(patient_id=patient.id)
     
     context = {
         'user': patient,
         'appointments': appointments,
         'notifications': notifications,
-        'cart_count': cart_count
     }
     return render(request, 'patient/appointments.html', context)
 
@@ -2677,9 +2449,6 @@ def update_profile(request):
     except Patient.DoesNotExist:
         return redirect('login')
     
-    # Get cart count for the cart icon
-    cart_count = Cart.objects.filter(patient=patient).count() if patient else 0
-    
     if request.method == 'POST':
         # instance=patient populates the form with existing data and maps the POST data to it
         form = PatientProfileUpdateForm(request.POST, instance=patient)
@@ -2693,29 +2462,17 @@ def update_profile(request):
     # Get notifications for the patient, excluding those read more than 2 days ago
     from django.utils import timezone
     from datetime import timedelta
-    from .models import Notification
     
     # Mark all unread notifications as read and update their read_at timestamp
-    unread_notifications = Notification.objects.filter(patient=patient, is_read=False)
-    for notification in unread_notifications:
-        notification.is_read = True
-        notification.read_at = timezone.now()
-        notification.save()
+    mark_all_read(patient_id=patient.id)
     
     # Get all notifications for this patient, excluding those read more than 2 days ago
-    two_days_ago = timezone.now() - timedelta(days=2)
-    notifications = Notification.objects.filter(
-        patient=patient
-    ).filter(
-        # Either not read yet, or read within the last 2 days
-        Q(is_read=False) | Q(read_at__gte=two_days_ago)
-    ).order_by('-created_at')[:5]
+    notifications = visible_notifications(patient_id=patient.id)[:5]
     
     return render(request, 'patient/profile.html', {
         'form': form, 
         'user': patient,
         'notifications': notifications,
-        'cart_count': cart_count
     })
 
 
@@ -2768,32 +2525,32 @@ def pharmacist_dashboard(request):
     
     # Count today's orders for medicines from this pharmacist
     today = timezone.now().date()
-    today_orders = OrderItem.objects.filter(
-        medicine__pharmacist=pharmacist,
-        order__created_at__date=today
+    today_orders = PharmacyOrder.objects.filter(
+        pharmacist=pharmacist,
+        created_at__date=today
     ).count()
     
     # Calculate weekly sales for this pharmacist
     week_ago = timezone.now() - timedelta(days=7)
-    weekly_sales = OrderItem.objects.filter(
-        medicine__pharmacist=pharmacist,
-        order__created_at__gte=week_ago
-    ).aggregate(total=Sum('price_at_order'))['total'] or 0
+    weekly_sales = PharmacyOrder.objects.filter(
+        pharmacist=pharmacist,
+        created_at__gte=week_ago
+    ).aggregate(total=Sum('subtotal'))['total'] or 0
     
     # Get recent customers (patients who ordered medicines from this pharmacist recently)
-    recent_orders = OrderItem.objects.filter(
-        medicine__pharmacist=pharmacist
-    ).select_related('order__patient').order_by('-order__created_at')[:10]
+    recent_orders = PharmacyOrder.objects.filter(
+        pharmacist=pharmacist
+    ).select_related('order__patient').order_by('-created_at')[:10]
     
     # Extract unique patients from recent orders
     recent_customers = []
     seen_customers = set()
-    for order_item in recent_orders:
-        patient = order_item.order.patient
+    for pharmacy_order in recent_orders:
+        patient = pharmacy_order.order.patient
         customer_key = patient.id
         if customer_key not in seen_customers:
             # Determine how recent the visit was
-            days_diff = (timezone.now().date() - order_item.order.created_at.date()).days
+            days_diff = (timezone.now().date() - pharmacy_order.created_at.date()).days
             if days_diff == 0:
                 last_visit = 'Today'
             elif days_diff == 1:
@@ -2820,14 +2577,9 @@ def pharmacist_dashboard(request):
         ]
     }
     
-    # Get notification count for the pharmacist
-    from .models import Notification
-    pharmacist_notification_count = Notification.objects.filter(pharmacist=pharmacist, is_read=False).count()
-    
     context = {
         'pharmacist': pharmacist,
         'data': dashboard_data,
-        'pharmacist_notification_count': pharmacist_notification_count
     }
     return render(request, 'pharmacist/dashboard.html', context)
 
@@ -2866,44 +2618,46 @@ def pharmacist_earnings(request):
         start_date = None
         period_name = 'All Time'
     
-    # Build base query for orders (count ALL orders placed)
-    orders_query = Order.objects.filter(
-        items__medicine__pharmacist=pharmacist
-    ).distinct()
+    # Build base query for this pharmacy's share of orders (count ALL orders placed)
+    orders_query = PharmacyOrder.objects.filter(pharmacist=pharmacist)
     
     # Build base query for successful orders (for earnings calculation)
-    successful_orders_query = Order.objects.filter(
-        items__medicine__pharmacist=pharmacist,
-        status='completed'
-    ).distinct()
+    successful_orders_query = orders_query.filter(status='completed')
     
     if start_date:
         orders_query = orders_query.filter(created_at__date__gte=start_date)
         successful_orders_query = successful_orders_query.filter(created_at__date__gte=start_date)
     
-    # Calculate total orders (all orders placed)
-    total_orders = orders_query.count()
-    
-    # Calculate successful orders
-    successful_orders = successful_orders_query.count()
-    
-    # Calculate total earnings from successful orders only
-    total_earnings = successful_orders_query.aggregate(
-        total=Sum('total_amount')
-    )['total'] or 0
+    # Count all orders placed and successful ones, and total earnings from successful orders only, in one query
+    from django.db.models import Count
+    totals = orders_query.aggregate(
+        total_orders=Count('id'),
+        successful_orders=Count('id', filter=Q(status='completed')),
+        total_earnings=Sum('total_amount', filter=Q(status='completed')),
+    )
+    total_orders = totals['total_orders']
+    successful_orders = totals['successful_orders']
+    total_earnings = totals['total_earnings'] or 0
     
     # Calculate average order value (based on successful orders)
     avg_order_value = total_earnings / successful_orders if successful_orders > 0 else 0
     
     # Get earnings by day for chart (last 7 days) - only successful orders
+    from django.db.models.functions import TruncDate
+    week_start = today - timedelta(days=6)
+    daily_totals = dict(
+        PharmacyOrder.objects.filter(
+            pharmacist=pharmacist,
+            status='completed',
+            created_at__date__gte=week_start
+        ).annotate(day=TruncDate('created_at')).values('day').annotate(
+            total=Sum('total_amount')
+        ).order_by().values_list('day', 'total')
+    )
     earnings_by_day = []
     for i in range(6, -1, -1):
         day = today - timedelta(days=i)
-        day_earnings = Order.objects.filter(
-            items__medicine__pharmacist=pharmacist,
-            status='completed',
-            created_at__date=day
-        ).distinct().aggregate(total=Sum('total_amount'))['total'] or 0
+        day_earnings = daily_totals.get(day) or 0
         
         earnings_by_day.append({
             'date': day.strftime('%a'),
@@ -2913,8 +2667,8 @@ def pharmacist_earnings(request):
     
     # Get top selling medicines (from successful orders)
     top_medicines = OrderItem.objects.filter(
-        order__in=successful_orders_query,
-        medicine__pharmacist=pharmacist
+        order__in=successful_orders_query.values('order_id'),
+        pharmacist=pharmacist
     ).values(
         'medicine__brand_name',
         'medicine__generic_name'
@@ -2925,8 +2679,8 @@ def pharmacist_earnings(request):
     
     # Get recent transactions (from successful orders)
     recent_transactions = OrderItem.objects.filter(
-        order__in=successful_orders_query,
-        medicine__pharmacist=pharmacist
+        order__in=successful_orders_query.values('order_id'),
+        pharmacist=pharmacist
     ).select_related(
         'order', 'order__patient', 'medicine'
     ).order_by('-order__created_at')[:10]
@@ -2944,11 +2698,6 @@ def pharmacist_earnings(request):
         'recent_transactions': recent_transactions,
     }
     
-    # Get notification count for the pharmacist
-    from .models import Notification
-    pharmacist_notification_count = Notification.objects.filter(pharmacist=pharmacist, is_read=False).count()
-    context['pharmacist_notification_count'] = pharmacist_notification_count
-    
     return render(request, 'pharmacist/earnings.html', context)
 
 
@@ -2981,11 +2730,6 @@ def pharmacist_profile(request):
         'current_password': pharmacist.password if pharmacist.password else ''
     }
     
-    # Get notification count for the pharmacist
-    from .models import Notification
-    pharmacist_notification_count = Notification.objects.filter(pharmacist=pharmacist, is_read=False).count()
-    context['pharmacist_notification_count'] = pharmacist_notification_count
-    
     return render(request, 'pharmacist/profile.html', context)
 
 
@@ -3008,6 +2752,7 @@ def pharmacist_inventory(request):
             medicine = form.save(commit=False)
             medicine.pharmacist = pharmacist
             medicine.save()
+            record_inventory_change(pharmacist.id, medicine.id, 'added', medicine.quantity)
             messages.success(request, "Medicine added to inventory successfully!")
             return redirect('pharmacist_inventory')
     else:
@@ -3033,11 +2778,6 @@ def pharmacist_inventory(request):
         'soon': soon
     }
     
-    # Get notification count for the pharmacist
-    from .models import Notification
-    pharmacist_notification_count = Notification.objects.filter(pharmacist=pharmacist, is_read=False).count()
-    context['pharmacist_notification_count'] = pharmacist_notification_count
-    
     return render(request, 'pharmacist/inventory.html', context)
 
 def edit_medicine(request, pk):
@@ -3051,9 +2791,12 @@ def edit_medicine(request, pk):
         return redirect('pharmacist_inventory')
     
     if request.method == 'POST':
+        previous_quantity = medicine.quantity
         form = MedicineForm(request.POST, instance=medicine)
         if form.is_valid():
             form.save()
+            record_inventory_change(medicine.pharmacist_id, medicine.id, 'updated', medicine.quantity - previous_quantity)
+            refresh_cart_summaries_for_medicine(medicine.id)
             messages.success(request, "Medicine updated successfully!")
         else:
             messages.error(request, "Error updating medicine.")
@@ -3071,7 +2814,7 @@ def delete_medicine(request, pk):
         return redirect('pharmacist_inventory')
     
     if request.method == 'POST':
-        medicine.delete()
+        remove_medicine(medicine)
         messages.success(request, "Medicine deleted successfully!")
     
     return redirect('pharmacist_inventory')
@@ -3086,45 +2829,23 @@ def pharmacist_orders(request):
     except Pharmacist.DoesNotExist:
         return redirect('login')
     
-    # Get medicines belonging to this pharmacist
-    pharmacist_medicines = Medicine.objects.filter(pharmacist=pharmacist)
-    
-    # Get orders that contain these medicines through OrderItem
-    from django.db.models import Prefetch
-    orders = Order.objects.filter(
-        items__medicine__in=pharmacist_medicines
-    ).distinct().prefetch_related(
-        Prefetch('items', queryset=OrderItem.objects.select_related('medicine')),
-        'patient'
-    ).order_by('-created_at')
-    
-    # Calculate statistics
-    total_orders = orders.count()
-    pending_orders = orders.filter(status='pending').count()
-    successful_orders = orders.filter(status='completed').count()
-    failed_orders = orders.filter(status='failed').count()
-    delayed_orders = orders.filter(status='delayed').count()
+    # First page of this pharmacy's order queue; later pages come from pharmacist_order_queue
+    orders, next_cursor = order_queue(pharmacist)
     
     context = {
         'pharmacist': pharmacist,
         'orders': orders,
-        'total_orders': total_orders,
-        'pending_orders': pending_orders,
-        'successful_orders': successful_orders,
-        'failed_orders': failed_orders,
-        'delayed_orders': delayed_orders,
+        'next_cursor': next_cursor,
+        # Status counts in a single query
+        **queue_stats(pharmacist),
     }
     
-    # Get notification count for the pharmacist
-    from .models import Notification
-    pharmacist_notification_count = Notification.objects.filter(pharmacist=pharmacist, is_read=False).count()
-    context['pharmacist_notification_count'] = pharmacist_notification_count
-    
     return render(request, 'pharmacist/orders.html', context)
 
-def pharmacist_order_details_ajax(request, order_id):
-    """AJAX view to return order details for the pharmacist's modal"""
+def pharmacist_order_queue(request):
+    """AJAX view returning one page of the pharmacist's order queue"""
     from django.http import JsonResponse
+    from django.template.loader import render_to_string
     
     pharmacist_id = request.session.get('pharmacist_id')
     if not pharmacist_id:
@@ -3132,31 +2853,111 @@ def pharmacist_order_details_ajax(request, order_id):
     
     try:
         pharmacist = Pharmacist.objects.get(id=pharmacist_id)
-        # Fetch the order and ensure it has items from this pharmacist
-        order = Order.objects.prefetch_related(
-            'items__medicine__pharmacist', 
-            'patient'
-        ).get(id=order_id)
-        
-        # Verify permissions: does this order contain medicines from this pharmacist?
-        pharmacist_medicines = Medicine.objects.filter(pharmacist=pharmacist)
-        order_items = OrderItem.objects.filter(order=order, medicine__in=pharmacist_medicines)
-        
-        if not order_items.exists():
-            return JsonResponse({'success': False, 'error': 'Permission denied'}, status=403)
+    except Pharmacist.DoesNotExist:
+        return JsonResponse({'success': False, 'error': 'Pharmacist not found'}, status=404)
+    
+    status = request.GET.get('status') or None
+    if status and status not in dict(Order.ORDER_STATUS):
+        return JsonResponse({'success': False, 'error': 'Invalid status'}, status=400)
+    
+    try:
+        limit = int(request.GET.get('limit', ORDER_QUEUE_PAGE_SIZE))
+        orders, next_cursor = order_queue(pharmacist, status=status, cursor=request.GET.get('cursor'), limit=limit)
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Invalid cursor or limit'}, status=400)
+    
+    html = ''.join(
+        render_to_string('pharmacist/order_row.html', {'pharmacy_order': pharmacy_order})
+        for pharmacy_order in orders
+    )
+    
+    return JsonResponse({
+        'success': True,
+        'orders': [
+            {
+                'id': pharmacy_order.order_id,
+                'patient_name': f'{pharmacy_order.order.patient.first_name} {pharmacy_order.order.patient.last_name}',
+                'total_amount': str(pharmacy_order.total_amount),
+                'item_count': pharmacy_order.item_count,
+                'status': pharmacy_order.status,
+                'status_display': pharmacy_order.get_status_display(),
+                'delivery_mode': pharmacy_order.order.delivery_mode,
+                'created_at': pharmacy_order.created_at.isoformat(),
+            }
+            for pharmacy_order in orders
+        ],
+        'html': html,
+        'next_cursor': next_cursor,
+    })
+
+async def live_events(request):
+    """Server-sent events for the signed-in user's open pages: new notifications and unread counts,
+    plus new orders and status changes for a pharmacist.
+
+    Must be served over ASGI (see main/events.py).
+    """
+    from asgiref.sync import sync_to_async
+    from .events import notification_channel, pharmacist_channel, stream_response
+    
+    for role, model in (('pharmacist', Pharmacist), ('patient', Patient)):
+        recipient_id = await request.session.aget(f'{role}_id')
+        if recipient_id and await model.objects.filter(id=recipient_id).aexists():
+            break
+    else:
+        return JsonResponse({'success': False, 'error': 'Not authenticated'}, status=401)
+    
+    channels = [notification_channel(role, recipient_id)]
+    if role == 'pharmacist':
+        channels.append(pharmacist_channel(recipient_id))
+    # Sent on every connect, so a badge is right again after a reconnect
+    count = await sync_to_async(unread_count)(**{f'{role}_id': recipient_id})
+    # A reconnecting EventSource resumes after the last event it saw
+    return stream_response(request, channels, initial=[('unread_count', {'unread_count': count})])
+
+def pharmacist_order_details_ajax(request, order_id):
+    """AJAX view to return order details for the pharmacist's modal (304 when the copy is current)"""
+    from django.http import JsonResponse
+    from django.core.serializers.json import DjangoJSONEncoder
+    
+    pharmacist_id = request.session.get('pharmacist_id')
+    if not pharmacist_id:
+        return JsonResponse({'success': False, 'error': 'Not authenticated'}, status=401)
+    
+    # Verify permissions and read the version key in one query: this pharmacy's share of the order
+    version = PharmacyOrder.objects.filter(order_id=order_id, pharmacist_id=pharmacist_id).values_list(
+        'updated_at', 'item_count', 'order__updated_at',
+        'order__patient__first_name', 'order__patient__last_name', 'order__patient__email',
+        'order__patient__phone_number', 'order__patient__blood_group'
+    ).first()
+    if version is None:
+        if not Order.objects.filter(id=order_id).exists():
+            return JsonResponse({'success': False, 'error': 'Order or Pharmacist not found'}, status=404)
+        return JsonResponse({'success': False, 'error': 'Permission denied'}, status=403)
+    # Medicine rows keep no timestamp, so the fields the modal shows are part of the version
+    related = tuple(OrderItem.objects.filter(order_id=order_id, pharmacist_id=pharmacist_id).order_by('id').values_list(
+        'medicine__brand_name', 'medicine__generic_name', 'medicine__strength', 'medicine__formulation'
+    ))
+    
+    etag = make_etag('pharmacist-order', order_id, pharmacist_id, *version, related)
+    
+    def build():
+        pharmacy_order = PharmacyOrder.objects.select_related('order__patient').get(
+            order_id=order_id, pharmacist_id=pharmacist_id
+        )
+        order = pharmacy_order.order
         
         # Build the response data
         data = {
             'success': True,
             'order': {
                 'id': order.id,
-                'status_display': order.get_status_display(),
+                'status_display': pharmacy_order.get_status_display(),
                 'created_at': order.created_at.strftime('%b %d, %Y %H:%M'),
                 'delivery_mode_display': order.get_delivery_mode_display(),
                 'delivery_address': order.delivery_address or '',
                 'scheduled_delivery_date': order.scheduled_delivery_date.strftime('%b %d, %Y %H:%M') if order.scheduled_delivery_date else '',
-                'total_amount': str(order.total_amount),
-                'gst_amount': str(order.gst_amount),
+                'total_amount': str(pharmacy_order.total_amount),
+                'gst_amount': str(pharmacy_order.gst_amount),
                 'patient': {
                     'first_name': order.patient.first_name,
                     'last_name': order.patient.last_name,
@@ -3168,9 +2969,8 @@ def pharmacist_order_details_ajax(request, order_id):
             }
         }
         
-        # Add order items belonging to this pharmacist (or all if we want full visibility)
-        # The template shows all items in the order.
-        for item in order.items.all():
+        # Add the order items belonging to this pharmacist; other pharmacies' items are theirs to fill
+        for item in order.items.filter(pharmacist_id=pharmacist_id).select_related('medicine'):
             data['order']['items'].append({
                 'medicine': {
                     'brand_name': item.medicine.brand_name if item.medicine else 'Unknown',
@@ -3182,10 +2982,11 @@ def pharmacist_order_details_ajax(request, order_id):
                 'price_at_order': str(item.price_at_order),
                 'subtotal': str(item.get_subtotal())
             })
-            
-        return JsonResponse(data)
-    except (Order.DoesNotExist, Pharmacist.DoesNotExist):
-        return JsonResponse({'success': False, 'error': 'Order or Pharmacist not found'}, status=404)
+        
+        return json.dumps(data, cls=DjangoJSONEncoder)
+    
+    try:
+        return conditional_response(request, f'pharmacist-order:{pharmacist_id}:{order_id}', etag, build)
     except Exception as e:
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
 
@@ -3202,37 +3003,17 @@ def pharmacist_notifications(request):
     # Mark all unread notifications as read and update their read_at timestamp
     from django.utils import timezone
     from datetime import timedelta
-    from .models import Notification
     
-    unread_notifications = Notification.objects.filter(pharmacist=pharmacist, is_read=False)
-    for notification in unread_notifications:
-        notification.is_read = True
-        notification.read_at = timezone.now()
-        notification.save()
+    mark_all_read(pharmacist_id=pharmacist.id)
     
     # Get all notifications for this pharmacist, excluding those read more than 2 days ago
-    two_days_ago = timezone.now() - timedelta(days=2)
-    notifications = Notification.objects.filter(
-        pharmacist=pharmacist
-    ).filter(
-        # Either not read yet, or read within the last 2 days
-        Q(is_read=False) | Q(read_at__gte=two_days_ago)
-    ).order_by('-created_at')
-    
-    # Get cart count for the cart icon (for consistency with other views)
-    cart_count = Cart.objects.filter(patient__in=Patient.objects.all()).count()
+    notifications = visible_notifications(pharmacist_id=pharmacist.id)
     
     context = {
         'user': pharmacist,
         'notifications': notifications,
-        'cart_count': cart_count,
     }
     
-    # Get notification count for the pharmacist (already filtered in query above)
-    from .models import Notification
-    pharmacist_notification_count = Notification.objects.filter(pharmacist=pharmacist, is_read=False).count()
-    context['pharmacist_notification_count'] = pharmacist_notification_count
-    
     return render(request, 'pharmacist/notifications.html', context)
 
 def pharmacist_customers(request):
@@ -3246,8 +3027,8 @@ def pharmacist_customers(request):
         return redirect('login')
     
     # Get all patients who have ordered medicines from this pharmacist
-    customer_ids = OrderItem.objects.filter(
-        medicine__pharmacist=pharmacist
+    customer_ids = PharmacyOrder.objects.filter(
+        pharmacist=pharmacist
     ).values_list('order__patient', flat=True).distinct()
     
     patients = Patient.objects.filter(id__in=customer_ids)
@@ -3264,7 +3045,7 @@ def pharmacist_customers(request):
         # Get order items for this patient that have course duration
         order_items = OrderItem.objects.filter(
             order__patient=patient,
-            medicine__pharmacist=pharmacist
+            pharmacist=pharmacist
         ).select_related('medicine', 'order')
         
         # Also get related prescriptions for this patient
@@ -3277,18 +3058,9 @@ def pharmacist_customers(request):
             'patient_prescriptions': patient_prescriptions
         })
     
-    # Get cart count for the cart icon
-    cart_count = Cart.objects.filter(patient__in=Patient.objects.all()).count()  # Count for all patients
-    
-    # Get notification count for the pharmacist
-    from .models import Notification
-    pharmacist_notification_count = Notification.objects.filter(pharmacist=pharmacist, is_read=False).count()
-    
     return render(request, 'pharmacist/customers.html', {
         'user': pharmacist,
         'patient_data': patient_data,
-        'cart_count': cart_count,
-        'pharmacist_notification_count': pharmacist_notification_count
     })
 
 def pharmacist_customer_details_ajax(request, patient_id):
@@ -3307,7 +3079,7 @@ def pharmacist_customer_details_ajax(request, patient_id):
         # Get order items for this patient from this pharmacist
         order_items = OrderItem.objects.filter(
             order__patient=patient,
-            medicine__pharmacist=pharmacist
+            pharmacist=pharmacist
         ).select_related('medicine', 'order').order_by('-order__created_at')
         
         # Get unique orders
@@ -3425,7 +3197,7 @@ def send_refill_reminder(request, order_item_id):
                 else:
                     message = f'Your supply of {order_item.medicine.brand_name} is ending soon. As per your doctor\'s prescription, please consider ordering a refill.'
                 
-                Notification.objects.create(
+                notify(
                     patient=order_item.order.patient,
                     notification_type='refill_reminder',
                     title='Medicine Supply Ending Soon',
@@ -3532,6 +3304,9 @@ def submit_rating(request, appointment_id=None, order_id=None):
     else:
         return redirect('view_doctors')
 
+# Orders one bulk status update may change
+MAX_BULK_STATUS_ORDERS = 500
+
 def update_order_status(request, order_id):
     pharmacist_id = request.session.get('pharmacist_id')
     if not pharmacist_id:
@@ -3552,11 +3327,10 @@ def update_order_status(request, order_id):
         pharmacist = Pharmacist.objects.get(id=pharmacist_id)
         order = Order.objects.get(id=order_id)
         
-        # Verify that this order contains medicines from this pharmacist
-        pharmacist_medicines = Medicine.objects.filter(pharmacist=pharmacist)
-        order_items = OrderItem.objects.filter(order=order, medicine__in=pharmacist_medicines)
+        # Verify that part of this order was routed to this pharmacist
+        pharmacy_order = PharmacyOrder.objects.filter(order=order, pharmacist=pharmacist).first()
         
-        if not order_items.exists():
+        if pharmacy_order is None:
             if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
                 return JsonResponse({'success': False, 'error': 'Permission denied'}, status=403)
             # Only add messages for non-AJAX requests
@@ -3571,39 +3345,22 @@ def update_order_status(request, order_id):
             new_status = request.POST.get('status')
         
         if new_status and new_status in dict(Order.ORDER_STATUS).keys():
-            old_status = order.status
-            order.status = new_status
-            order.save()
-            
-            # Create notification for the patient about status change
-            from .models import Notification
-            
-            # Map status to user-friendly messages
-            status_messages = {
-                'pending': 'Your order is being processed',
-                'preparing': 'Your order is being prepared',
-                'out_for_delivery': 'Your order is out for delivery',
-                'ready_for_pickup': 'Your order is ready for pickup at the store',
-                'completed': 'Your order has been completed',
-                'delayed': 'Your order has been delayed',
-                'failed': 'Your order could not be fulfilled'
-            }
-            
-            notification_title = status_messages.get(new_status, f'Order status updated')
-            notification_message = f'Your order #{order.id} status has been updated to {order.get_status_display()}. Please check your order details for more information.'
-            
-            Notification.objects.create(
-                patient=order.patient,
-                notification_type='order_status',
-                title=notification_title,
-                message=notification_message,
-                related_id=order.id
-            )
+            # Only this pharmacy's share moves; the order status is rolled up from all shares
+            from django.db import transaction as db_transaction
+            old_status = pharmacy_order.status
+            pharmacy_order.status = new_status
+            with db_transaction.atomic():
+                set_order_status(order, new_status, pharmacist=pharmacist)
+                # The patient is notified from the outbox once the change commits
+                record_event('order_status_changed', {
+                    'status': new_status,
+                    'orders': [[order.id, order.patient_id]],
+                })
             
             # Track earnings when order becomes completed
             if old_status not in ['completed'] and new_status == 'completed':
-                # Calculate earnings for this order
-                order_earnings = order.total_amount
+                # Calculate earnings for this pharmacy's share of the order
+                order_earnings = pharmacy_order.total_amount
                 
                 # Log the successful order for earnings tracking
                 log_user_action(
@@ -3614,16 +3371,16 @@ def update_order_status(request, order_id):
                     request=request
                 )
                 
-                success_message = f"Order #{order.id} status updated to {order.get_status_display()}. Earnings of ₹{order_earnings} recorded."
+                success_message = f"Order #{order.id} status updated to {pharmacy_order.get_status_display()}. Earnings of ₹{order_earnings} recorded."
             else:
-                success_message = f"Order #{order.id} status updated to {order.get_status_display()}."
+                success_message = f"Order #{order.id} status updated to {pharmacy_order.get_status_display()}."
             
             # Return JSON response for AJAX requests
             if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
                 return JsonResponse({
                     'success': True,
                     'message': success_message,
-                    'new_status': order.get_status_display(),
+                    'new_status': pharmacy_order.get_status_display(),
                     'status_code': new_status
                 })
             
@@ -3648,6 +3405,94 @@ def update_order_status(request, order_id):
     
     return redirect('pharmacist_orders')
 
+def bulk_update_order_status(request):
+    """Move the pharmacist's share of many orders to one status in a single request.
+    
+    Expects JSON ``{"order_ids": [...], "status": "..."}`` (or form fields
+    ``order_ids`` and ``status``). Ownership of the whole batch is checked
+    with one query and the change is applied with one UPDATE; the patient
+    notifications go out as a single outbox event and audit entries are
+    inserted in bulk.
+    """
+    import json
+    
+    pharmacist_id = request.session.get('pharmacist_id')
+    if not pharmacist_id:
+        return JsonResponse({'success': False, 'error': 'Not authenticated'}, status=401)
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'Invalid method'}, status=405)
+    
+    try:
+        pharmacist = Pharmacist.objects.get(id=pharmacist_id)
+    except Pharmacist.DoesNotExist:
+        return JsonResponse({'success': False, 'error': 'Pharmacist not found'}, status=404)
+    
+    try:
+        if request.content_type == 'application/json':
+            data = json.loads(request.body)
+            order_ids = data.get('order_ids') or []
+            new_status = data.get('status')
+        else:
+            order_ids = request.POST.getlist('order_ids')
+            new_status = request.POST.get('status')
+        order_ids = {int(order_id) for order_id in order_ids}
+    except (ValueError, TypeError, AttributeError):
+        return JsonResponse({'success': False, 'error': 'Invalid request body'}, status=400)
+    
+    if new_status not in dict(Order.ORDER_STATUS):
+        return JsonResponse({'success': False, 'error': 'Invalid status selected'}, status=400)
+    if not order_ids:
+        return JsonResponse({'success': False, 'error': 'No orders selected'}, status=400)
+    if len(order_ids) > MAX_BULK_STATUS_ORDERS:
+        return JsonResponse({'success': False, 'error': f'At most {MAX_BULK_STATUS_ORDERS} orders can be updated at once'}, status=400)
+    
+    from django.db import transaction as db_transaction
+    
+    with db_transaction.atomic():
+        pharmacy_orders, previous, not_owned = set_orders_status(pharmacist, order_ids, new_status)
+        if not_owned:
+            return JsonResponse({
+                'success': False,
+                'error': "You don't have permission to update some of these orders.",
+                'order_ids': not_owned
+            }, status=403)
+        
+        record_event('order_status_changed', {
+            'status': new_status,
+            'orders': [[pharmacy_order.order_id, pharmacy_order.order.patient_id] for pharmacy_order in pharmacy_orders],
+        })
+    
+    status_display = dict(Order.ORDER_STATUS)[new_status]
+    
+    # Track earnings for orders that became completed
+    completed = [
+        pharmacy_order for pharmacy_order in pharmacy_orders
+        if new_status == 'completed' and previous[pharmacy_order.order_id] != 'completed'
+    ]
+    if completed:
+        log_user_actions(
+            pharmacist.user if hasattr(pharmacist, 'user') else None,
+            'order_completed',
+            [
+                (f'Order #{pharmacy_order.order_id} marked as completed. Earnings: ₹{pharmacy_order.total_amount}', pharmacy_order.order)
+                for pharmacy_order in completed
+            ],
+            request=request
+        )
+    
+    message = f"{len(pharmacy_orders)} order(s) updated to {status_display}."
+    if completed:
+        earnings = sum(pharmacy_order.total_amount for pharmacy_order in completed)
+        message += f" Earnings of ₹{earnings} recorded."
+    
+    return JsonResponse({
+        'success': True,
+        'message': message,
+        'order_ids': sorted(pharmacy_order.order_id for pharmacy_order in pharmacy_orders),
+        'new_status': status_display,
+        'status_code': new_status
+    })
+
 def pharmacist_ratings_feedback(request):
     from django.db.models import Avg
     pharmacist_id = request.session.get('pharmacist_id')
@@ -3656,16 +3501,12 @@ def pharmacist_ratings_feedback(request):
     
     pharmacist = Pharmacist.objects.get(id=pharmacist_id)
     
-    # Get all medicines from this pharmacist
-    pharmacist_medicines = Medicine.objects.filter(pharmacist=pharmacist)
-    
-    # Get all orders that contain medicines from this pharmacist
-    order_ids = OrderItem.objects.filter(medicine__in=pharmacist_medicines).values_list('order_id', flat=True).distinct()
-    orders = Order.objects.filter(id__in=order_ids).select_related('patient').order_by('-created_at')
+    # Get all orders routed to this pharmacist
+    order_ids = PharmacyOrder.objects.filter(pharmacist=pharmacist).values('order_id')
     
     # Get reviews for orders that contain medicines from this pharmacist
     reviews = Review.objects.filter(
-        order__in=orders,
+        order__in=order_ids,
         review_type='order'
     ).select_related('patient', 'order').order_by('-created_at')
     
@@ -3687,11 +3528,6 @@ def pharmacist_ratings_feedback(request):
         'positive_reviews': positive_reviews,
     }
     
-    # Get notification count for the pharmacist
-    from .models import Notification
-    pharmacist_notification_count = Notification.objects.filter(pharmacist=pharmacist, is_read=False).count()
-    context['pharmacist_notification_count'] = pharmacist_notification_count
-    
     return render(request, 'pharmacist/ratings_feedback.html', context)
 
 def pharmacist_restock(request):
@@ -3721,30 +3557,12 @@ def pharmacist_restock(request):
         expiry_date__gte=timezone.now().date()
     ).order_by('expiry_date')
     
-    # Get cart count for the cart icon
-    # Get patient_id from session to check if there's a patient logged in
-    patient_id = request.session.get('patient_id')
-    if patient_id:
-        try:
-            patient = Patient.objects.get(id=patient_id)
-            cart_count = Cart.objects.filter(patient=patient).count()
-        except Patient.DoesNotExist:
-            cart_count = 0
-    else:
-        cart_count = 0
-    
     context = {
         'user': pharmacist,
         'low_stock_medicines': low_stock_medicines,
         'expiry_alert_medicines': expiry_alert_medicines,
-        'cart_count': cart_count
     }
     
-    # Get notification count for the pharmacist
-    from .models import Notification
-    pharmacist_notification_count = Notification.objects.filter(pharmacist=pharmacist, is_read=False).count()
-    context['pharmacist_notification_count'] = pharmacist_notification_count
-    
     return render(request, 'pharmacist/restock.html', context)
 
 
@@ -3976,19 +3794,19 @@ def update_appointment_status(request, appointment_id):
         # Get valid status choices from the model
         valid_statuses = [choice[0] for choice in Appointment.STATUS_CHOICES]
         if new_status in valid_statuses:
+            from django.db import transaction as db_transaction
             old_status = appointment.status
             appointment.status = new_status
-            appointment.save()
-            
-            # Create notification for patient about status update
-            from .models import Notification
-            Notification.objects.create(
-                patient=appointment.patient,
-                notification_type='appointment',
-                title=f'Appointment Status Updated',
-                message=f'Your appointment with Dr. {doctor.first_name} {doctor.last_name} has been updated from {old_status} to {new_status}.',
-                related_id=appointment.id
-            )
+            with db_transaction.atomic():
+                appointment.save()
+                # The patient is notified from the outbox once the change commits
+                record_event('appointment_status_changed', {
+                    'appointment_id': appointment.id,
+                    'patient_id': appointment.patient_id,
+                    'doctor_name': f'{doctor.first_name} {doctor.last_name}',
+                    'old_status': old_status,
+                    'new_status': new_status,
+                })
             
             messages.success(request, f"Appointment status updated to {appointment.get_status_display()}.")
         else:
@@ -4649,26 +4467,8 @@ def check_medicine_stock(request):
             if not medicine_name:
                 return JsonResponse({'error': 'Medicine name is required'}, status=400)
             
-            # Check if any medicine with this generic name exists in the database
-            # and has quantity greater than 0 and is not expired
-            from django.utils import timezone
-            
-            # Check if any medicine matches the generic name, is in stock, and not expired
-            medicine_exists = Medicine.objects.filter(
-                generic_name__icontains=medicine_name,
-                quantity__gt=0,  # quantity greater than 0 means in stock
-                expiry_date__gt=timezone.now().date()  # not expired
-            ).exists()
-            
-            # Also check for medicines with matching brand name, in stock, and not expired
-            brand_exists = Medicine.objects.filter(
-                brand_name__icontains=medicine_name,
-                quantity__gt=0,
-                expiry_date__gt=timezone.now().date()  # not expired
-            ).exists()
-            
-            # If neither exists or both have zero quantity or are expired, consider it out of stock
-            out_of_stock = not (medicine_exists or brand_exists)
+            # Same match as the bulk endpoint: canonical name, else generic/brand substring
+            out_of_stock = not stock_summary([medicine_name])[medicine_name]['in_stock']
             
             return JsonResponse({
                 'medicine_name': medicine_name,
@@ -4684,6 +4484,66 @@ def check_medicine_stock(request):
     return JsonResponse({'error': 'Method not allowed'}, status=405)
 
 
+# Upper bound on names per bulk stock check (a long prescription is ~20 lines)
+MAX_BULK_STOCK_NAMES = 100
+
+
+def check_medicine_stock_bulk(request):
+    """Stock status for a list of medicine names in one round trip"""
+    if request.method == 'POST':
+        import json
+        try:
+            data = json.loads(request.body)
+            medicine_names = data.get('medicine_names')
+            
+            if not isinstance(medicine_names, list) or not medicine_names:
+                return JsonResponse({'error': 'medicine_names must be a non-empty list'}, status=400)
+            if len(medicine_names) > MAX_BULK_STOCK_NAMES:
+                return JsonResponse({'error': f'At most {MAX_BULK_STOCK_NAMES} medicine names per request'}, status=400)
+            
+            # Results echo each name as submitted; matching normalizes them
+            medicine_names = [str(name) for name in medicine_names]
+            summary = stock_summary(medicine_names)
+            empty = {'in_stock': False, 'total_stock': 0, 'pharmacy_count': 0}
+            
+            results = []
+            for medicine_name in medicine_names:
+                stock = summary.get(medicine_name, empty)
+                results.append({
+                    'medicine_name': medicine_name,
+                    'in_stock': stock['in_stock'],
+                    'out_of_stock': not stock['in_stock'],
+                    'total_stock': stock['total_stock'],
+                    'pharmacy_count': stock['pharmacy_count'],
+                })
+            
+            return JsonResponse({'results': results})
+            
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON data'}, status=400)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=500)
+    
+    return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+
+def medicine_typeahead(request):
+    """Typeahead suggestions for medicine names, served from the in-memory prefix index"""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    
+    query = request.GET.get('q', '').strip()
+    try:
+        limit = min(max(int(request.GET.get('limit', 8)), 1), 25)
+    except ValueError:
+        limit = 8
+    
+    return JsonResponse({
+        'query': query,
+        'results': typeahead_index.lookup(query, limit=limit)
+    })
+
+
 def update_doctor_status(request):
     if request.method == 'POST':
         import json
@@ -5186,7 +5046,7 @@ def pharmacy_details(request, pharmacist_id):
     low_stock_medicines = Medicine.objects.filter(pharmacist=pharmacist, quantity__lte=10).count()
     
     # Get total orders and revenue for this pharmacist's medicines
-    order_items = OrderItem.objects.filter(medicine__pharmacist=pharmacist)
+    order_items = OrderItem.objects.filter(pharmacist=pharmacist)
     total_orders = order_items.count()
     total_revenue = order_items.aggregate(total=Sum(F('quantity') * F('price_at_order')))['total'] or 0
     
@@ -5211,9 +5071,13 @@ def medication_management(request):
     if request.method == 'POST':
         action = request.POST.get('action')
         if action == 'delete':
-            medicine_id = request.POST.get('medicine_id')
-            Medicine.objects.filter(id=medicine_id).delete()
-            messages.success(request, "Medication removed successfully.")
+            medicine = Medicine.objects.filter(id=request.POST.get('medicine_id')).first()
+            if medicine:
+                # Journaled like a pharmacist's own delete, so indexes and carts follow
+                remove_medicine(medicine)
+                messages.success(request, "Medication removed successfully.")
+            else:
+                messages.error(request, "Medication not found.")
             return redirect('medication_management')
 
     from django.db.models import Sum, F
@@ -5639,15 +5503,17 @@ def payment_portal(request):
     except Patient.DoesNotExist:
         return redirect('login')
     
-    # Check if there's a pending order in session
-    pending_order = request.session.get('pending_order')
-    if not pending_order:
+    # Check if there's an open pending order for this session
+    pending_order = get_pending_order(patient, request.session.get('pending_order_token'))
+    if not pending_order or pending_order.status != 'open':
         messages.error(request, "No pending order found.")
         return redirect('view_cart')
+    if hold_lapsed(pending_order):
+        return fail_pending_order(request, pending_order, HOLD_LAPSED_MESSAGE)
     
     # Get pharmacist information from cart items for in-store pickup
     shop_location = None
-    cart_items_ids = [item['id'] for item in pending_order['cart_items']]
+    cart_items_ids = [item['id'] for item in pending_order.cart_items]
     
     # Fetch actual cart items from database
     cart_items = Cart.objects.filter(id__in=cart_items_ids, patient=patient)
@@ -5667,15 +5533,56 @@ def payment_portal(request):
     context = {
         'user': patient,
         'cart_items': cart_items,
-        'subtotal': pending_order['subtotal'],
-        'gst_amount': pending_order['gst_amount'],
-        'total_amount': pending_order['total_amount'],
+        'subtotal': pending_order.subtotal,
+        'gst_amount': pending_order.gst_amount,
+        'total_amount': pending_order.total_amount,
+        'idempotency_token': pending_order.token,
+        'hold_expires_at': pending_order.hold_expires_at,
         'shop_location': shop_location
     }
     
     return render(request, 'patient/payment_portal.html', context)
 
 
+def get_pending_order(patient, token):
+    """The patient's PendingOrder for an idempotency token, or None"""
+    import uuid
+    try:
+        token = uuid.UUID(str(token))
+    except ValueError:
+        return None
+    return PendingOrder.objects.filter(token=token, patient=patient).first()
+
+
+HOLD_LAPSED_MESSAGE = "Your reservation expired before payment. Please check out again."
+
+
+def hold_lapsed(pending_order):
+    """Whether the stock held for a pending order has been released by expiry"""
+    return pending_order.hold_expires_at is not None and pending_order.hold_expires_at <= timezone.now()
+
+
+def pending_order_outcome(request, pending_order):
+    """Replay the recorded result of an already processed pending order"""
+    request.session.pop('pending_order_token', None)
+    if pending_order.status == 'completed' and pending_order.order_id:
+        messages.info(request, "This payment has already been processed.")
+        return redirect('view_order_receipt', order_id=pending_order.order_id)
+    messages.error(request, pending_order.failure_message or "This order could not be completed. Please check out again.")
+    return redirect('view_cart')
+
+
+def fail_pending_order(request, pending_order, message):
+    """Record a failed payment attempt so replays get the same answer"""
+    PendingOrder.objects.filter(pk=pending_order.pk, status='open').update(
+        status='failed', failure_message=message[:255], completed_at=timezone.now()
+    )
+    release_holds(pending_order.patient_id)
+    request.session.pop('pending_order_token', None)
+    messages.error(request, message)
+    return redirect('view_cart')
+
+
 def process_payment(request):
     """Process the payment and create order"""
     import uuid
@@ -5693,12 +5600,21 @@ def process_payment(request):
     except Patient.DoesNotExist:
         return redirect('login')
     
-    # Get pending order from session
-    pending_order = request.session.get('pending_order')
+    # The payment form carries the checkout's idempotency token
+    token = request.POST.get('idempotency_token') or request.session.get('pending_order_token')
+    pending_order = get_pending_order(patient, token)
     if not pending_order:
         messages.error(request, "No pending order found.")
         return redirect('view_cart')
     
+    # A repeated submit gets the recorded outcome without touching inventory
+    if pending_order.status != 'open':
+        return pending_order_outcome(request, pending_order)
+    
+    # Others may have bought the units once the holds lapsed; checkout re-checks and re-holds them
+    if hold_lapsed(pending_order):
+        return fail_pending_order(request, pending_order, HOLD_LAPSED_MESSAGE)
+    
     # Get payment details
     card_name = request.POST.get('card_name', '').strip()
     card_number = request.POST.get('card_number', '').replace(' ', '')
@@ -5719,20 +5635,76 @@ def process_payment(request):
         messages.error(request, "Invalid CVV.")
         return redirect('payment_portal')
     
-    # Create Order
-    order = Order.objects.create(
-        patient=patient,
-        total_amount=Decimal(str(pending_order['total_amount'])),
-        gst_amount=Decimal(str(pending_order['gst_amount'])),
-        status='pending',  # Set status to successful upon successful payment
-    )
-    # Explicitly set and save delivery fields to ensure they are persisted
-    order.delivery_mode = delivery_mode
-    if delivery_mode == 'home_delivery':
-        order.delivery_address = delivery_address
-    else:
-        order.delivery_address = None
-    order.save()
+    from django.db import transaction as db_transaction
+    
+    # Units to take per medicine (a medicine can appear on several cart lines)
+    quantities = {}
+    for item_data in pending_order.cart_items:
+        quantities[item_data['medicine_id']] = quantities.get(item_data['medicine_id'], 0) + item_data['quantity']
+    
+    # Order, stock, items, payment, cart and notifications commit or fail together
+    try:
+        with db_transaction.atomic():
+            # Consume the pending order exactly once; a concurrent submit waits here and then finds it taken
+            claimed = PendingOrder.objects.filter(pk=pending_order.pk, status='open').update(
+                status='completed', completed_at=timezone.now()
+            )
+            if not claimed:
+                pending_order.refresh_from_db()
+                return pending_order_outcome(request, pending_order)
+            
+            # Units other patients still hold stay untouched; this patient's holds are consumed
+            medicines = reserve_stock(quantities, exclude_patient=patient)
+            release_holds(patient)
+            
+            order = Order.objects.create(
+                patient=patient,
+                total_amount=pending_order.total_amount,
+                gst_amount=pending_order.gst_amount,
+                status='pending',  # Set status to successful upon successful payment
+                delivery_mode=delivery_mode,
+                delivery_address=delivery_address if delivery_mode == 'home_delivery' else None,
+            )
+            
+            # Items are stamped with their pharmacy and the order is split into per-pharmacy shares
+            pharmacy_orders = route_order(order, [
+                OrderItem(
+                    medicine=medicines[item_data['medicine_id']],
+                    quantity=item_data['quantity'],
+                    price_at_order=Decimal(str(item_data['price']))
+                )
+                for item_data in pending_order.cart_items
+            ])
+            
+            # Create Transaction with card details; the backend captures it after commit
+            transaction = Transaction.objects.create(
+                order=order,
+                transaction_id=f"MW-{uuid.uuid4().hex[:8].upper()}",
+                amount=pending_order.total_amount,
+                card_name=card_name,
+                card_number=card_number[-4:].rjust(len(card_number), '*'),  # Store only last 4 digits
+                card_cvv='***',  # Don't store actual CVV
+                status='processing'
+            )
+            start_capture(transaction, {'name': card_name, 'number': card_number})
+            
+            # Clear cart items
+            cart_item_ids = [item['id'] for item in pending_order.cart_items]
+            Cart.objects.filter(id__in=cart_item_ids).delete()
+            refresh_cart_summary(patient.id)
+            
+            # Pharmacies whose medicines were ordered are notified from the outbox after commit
+            record_event('order_placed', {
+                'order_id': order.id,
+                'pharmacist_ids': [pharmacy_order.pharmacist_id for pharmacy_order in pharmacy_orders],
+            })
+            
+            pending_order.order = order
+            pending_order.save(update_fields=['order'])
+    except InsufficientStock as e:
+        return fail_pending_order(request, pending_order, f"Not enough stock for {e}.")
+    except Medicine.DoesNotExist:
+        return fail_pending_order(request, pending_order, "One or more medicines are no longer available.")
     
     # Log the successful order for earnings tracking
     log_user_action(
@@ -5743,66 +5715,10 @@ def process_payment(request):
         request=request
     )
     
-    # Create Order Items and Update Stock
-    for item_data in pending_order['cart_items']:
-        try:
-            medicine = Medicine.objects.get(id=item_data['medicine_id'])
-            if medicine.quantity < item_data['quantity']:
-                messages.error(request, f"Not enough stock for {medicine.brand_name}.")
-                order.delete()  # Clean up the order
-                return redirect('view_cart')
-            
-            OrderItem.objects.create(
-                order=order,
-                medicine=medicine,
-                quantity=item_data['quantity'],
-                price_at_order=Decimal(str(item_data['price']))
-            )
-            medicine.quantity -= item_data['quantity']
-            medicine.save()
-        except Medicine.DoesNotExist:
-            messages.error(request, "One or more medicines are no longer available.")
-            order.delete()  # Clean up the order
-            return redirect('view_cart')
-    
-    # Create Transaction with card details
-    transaction = Transaction.objects.create(
-        order=order,
-        transaction_id=f"MW-{uuid.uuid4().hex[:8].upper()}",
-        amount=Decimal(str(pending_order['total_amount'])),
-        card_name=card_name,
-        card_number=card_number[-4:].rjust(len(card_number), '*'),  # Store only last 4 digits
-        card_cvv='***'  # Don't store actual CVV
-    )
-    
-    # Clear cart items
-    cart_item_ids = [item['id'] for item in pending_order['cart_items']]
-    Cart.objects.filter(id__in=cart_item_ids).delete()
-    
-    # Create notifications for pharmacists whose medicines were ordered
-    from .models import Notification
-    pharmacists_notified = set()
-    for item_data in pending_order['cart_items']:
-        try:
-            medicine = Medicine.objects.get(id=item_data['medicine_id'])
-            pharmacist = medicine.pharmacist
-            if pharmacist and pharmacist.id not in pharmacists_notified:
-                Notification.objects.create(
-                    pharmacist=pharmacist,
-                    notification_type='order_status',
-                    title='New Order Received',
-                    message=f'A new order #{order.id} has been placed for medicines from your pharmacy.',
-                    related_id=order.id
-                )
-                pharmacists_notified.add(pharmacist.id)
-        except Medicine.DoesNotExist:
-            pass
-    
     # Clear session data
-    if 'pending_order' in request.session:
-        del request.session['pending_order']
+    request.session.pop('pending_order_token', None)
     
-    messages.success(request, "Payment successful! Your order has been placed.")
+    messages.success(request, "Your order has been placed! We're confirming your payment.")
     return redirect('view_order_receipt', order_id=order.id)
 
 def generate_receipt_pdf(request, order_id):
@@ -75,6 +75,9 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "mediwise.wsgi.application"
+# Production is served over ASGI (start.sh) so live event streams
+# (main/events.py) hold a coroutine, not a worker, per open page
+ASGI_APPLICATION = "mediwise.asgi.application"
 
 
 # Database
@@ -88,6 +91,32 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/6.0/topics/cache/
+# Shared by every worker and management command, so the counters and
+# summaries one process writes through are the ones the others read.
+# Redis when REDIS_URL is set, else a table in the main database
+# (created by ``createcachetable`` in build.sh).
+
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'mediwise_cache',
+            # One entry per active cart and notification recipient; the
+            # default of 300 would cull them continuously
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
@@ -131,6 +160,31 @@ STATICFILES_FINDERS = [
 ]
 
 
+# Card payments are captured asynchronously after the order is created.
+# The simulator stands in for a gateway; raise its latency, failure_rate
+# and timeout_rate to load-test checkout. Run `manage.py settle_stale_payments`
+# from cron every few minutes to fail captures lost to a restart.
+PAYMENT_BACKEND = {
+    'BACKEND': 'main.payments.SimulatedPaymentBackend',
+    'OPTIONS': {
+        'latency': 0.2,
+        'jitter': 0.1,
+        'failure_rate': 0.0,
+        'timeout_rate': 0.0,
+    },
+    'CAPTURE_TIMEOUT': 10,
+    'ASYNC': True,
+    'WORKERS': 4,
+}
+
+# Notifications are written to an outbox with the change that causes them
+# and turned into Notification rows by a background dispatcher; run
+# `manage.py dispatch_outbox` from cron to catch up after restarts.
+NOTIFICATION_OUTBOX = {
+    'ASYNC': True,
+    'BATCH_SIZE': 500,
+}
+
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
@@ -0,0 +1,12 @@
+#!/usr/bin/env bash
+
+# Exit on error
+set -o errexit
+
+# Serve over ASGI: live event streams (main/events.py) wait as coroutines
+# instead of holding a worker each. Every worker process runs its own
+# LISTEN connection, so use a direct (unpooled) DATABASE_URL on Neon.
+exec gunicorn mediwise.asgi:application \
+    --worker-class uvicorn_worker.UvicornWorker \
+    --workers "${WEB_CONCURRENCY:-2}" \
+    --bind "0.0.0.0:${PORT:-8000}"